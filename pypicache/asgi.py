@@ -0,0 +1,428 @@
+"""An asyncio (ASGI) version of the server
+
+Serves the same routes as pypicache.server without tying up a worker
+per request: the event loop only ever waits on sockets, while blocking
+work (disk access and the requests based PyPI client) runs on a thread
+pool one chunk at a time. Run it with any ASGI server, e.g. uvicorn via
+``python -m pypicache.main --server asgi``.
+
+Response bodies are pulled on a pool of their own, and requests for a
+file another request is downloading wait on the event loop rather than
+in a thread, so a burst of such requests can't take every thread the
+download itself needs.
+
+Python 3 only.
+
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import json
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+import jinja2
+from werkzeug.datastructures import Headers
+from werkzeug.formparser import parse_form_data
+from werkzeug.http import http_date, parse_range_header
+from werkzeug.security import safe_join
+
+from pypicache import exceptions
+from pypicache import metrics
+from pypicache import server
+from pypicache import simple
+from pypicache import uploads
+
+CHUNK_SIZE = 64 * 1024
+
+PACKAGE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Sentinel marking the end of an iterator run in a thread
+DONE = object()
+
+# Seconds between checks on a download another request is making
+WAIT_INTERVAL = 0.05
+MAX_WAIT_INTERVAL = 1.0
+
+class Request(object):
+    """The bits of an ASGI http scope the handlers need
+
+    """
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = dict((key, values[-1]) for key, values in parse_qs(scope.get("query_string", b"").decode("latin-1")).items())
+        self.headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope.get("headers", [])])
+
+    def if_none_match(self, etag):
+        """Checks a quoted ETag against If-None-Match
+
+        """
+        return etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+
+    async def spool_body(self):
+        """Reads the request body into a temporary file
+
+        :returns: (file, size)
+
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                break
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        size = body.tell()
+        body.seek(0)
+        return body, size
+
+    def iter_body(self, loop):
+        """Yields the request body in a worker thread as it arrives
+
+        Each chunk is received on the event loop, so only one is held at
+        a time however large the body.
+
+        """
+        while True:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), loop).result()
+            if message["type"] == "http.disconnect":
+                return
+            if message.get("body"):
+                yield message["body"]
+            if not message.get("more_body", False):
+                return
+
+def next_chunk(iterator):
+    return next(iterator, DONE)
+
+class AsyncApp(object):
+    """ASGI application serving a package cache
+
+    :param workers: Threads available for blocking work
+    :param stream_workers: Threads reading response bodies, defaults to workers
+    :param offload: A server.FileOffload to let a front end web server send stored files
+
+    """
+    def __init__(self, pypi, package_store, package_cache, workers=32, stream_workers=None, offload=None):
+        self.log = logging.getLogger("pypicache.asgi")
+        self.pypi = pypi
+        self.package_store = package_store
+        self.package_cache = package_cache
+        self.offload = offload
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stream_executor = ThreadPoolExecutor(max_workers=stream_workers or workers)
+        self.templates = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(PACKAGE_ROOT, "templates")),
+            autoescape=True,
+        )
+        self.routes = [
+            ("GET", r"/", self.index),
+            ("GET", r"/static/(?P<path>.+)", self.static),
+            ("GET", r"/simple/?", self.simple_index),
+            ("GET", r"/simple/(?P<package>[^/]+)/(?P<version>[^/]*)", self.simple_package_info),
+            ("GET", r"/stats/", self.stats),
+            ("GET", r"/metrics", self.metrics),
+            ("GET", r"/local/?", self.local_index),
+            ("GET", r"/local/(?P<package>[^/]+)/(?P<version>[^/]*)", self.local_package_info),
+            ("GET", r"/packages/(?P<package>[^/]+)/(?P<filename>[^/]+)", self.get_file),
+            ("GET", r"/packages/source/(?P<firstletter>[^/]+)/(?P<package>[^/]+)/(?P<filename>[^/]+)", self.get_file),
+            ("GET", r"/packages/(?P<python_version>[^/]+)/(?P<firstletter>[^/]+)/(?P<package>[^/]+)/(?P<filename>[^/]+)", self.get_file),
+            ("POST", r"/uploadpackage/", self.post_uploadpackage),
+            ("POST", r"/requirements.txt", self.post_requirements_txt),
+            ("GET", r"/requirements.txt/(?P<job_id>[^/]+)", self.get_requirements_job),
+        ]
+        # Routes are labelled in metrics like server's, e.g. /packages/<package>/<filename>
+        self.routes = [
+            (method, re.compile(pattern + "$"), handler, re.sub(r"\(\?P<(\w+)>[^)]*\)", r"<\1>", pattern))
+            for method, pattern, handler in self.routes
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    self.executor.shutdown(wait=False)
+                    self.stream_executor.shutdown(wait=False)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        request = Request(scope, receive)
+        started = time.time()
+        route = "unmatched"
+        response_started = False
+        async def timed_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+                server.REQUEST_SECONDS.labels(route, request.method, message["status"]).observe(time.time() - started)
+            await send(message)
+        allowed = False
+        for method, pattern, handler, route_name in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            allowed = True
+            if method != request.method and not (method == "GET" and request.method == "HEAD"):
+                continue
+            route = route_name
+            try:
+                await handler(request, timed_send, **match.groupdict())
+            except Exception:
+                self.log.exception("Error handling {0} {1}".format(request.method, request.path))
+                if response_started:
+                    # Too late for an error response, let the server drop
+                    # the connection so the client sees a truncated body
+                    raise
+                await self.respond(timed_send, b"Internal Server Error", status=500, content_type="text/plain")
+            return
+        if allowed:
+            await self.respond(timed_send, b"Method Not Allowed", status=405, content_type="text/plain")
+        else:
+            await self.respond(timed_send, b"Not Found", status=404, content_type="text/plain")
+
+    def run(self, func, *args, **kwargs):
+        """Runs blocking work on the thread pool
+
+        """
+        return asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def pump(self, func, *args):
+        """Runs a step of sending a response body on its own thread pool
+
+        """
+        return asyncio.get_running_loop().run_in_executor(self.stream_executor, functools.partial(func, *args))
+
+    async def start_response(self, send, status=200, headers=None, content_type=None, content_length=None):
+        headers = Headers(headers or [])
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        if content_length is not None:
+            headers["Content-Length"] = str(content_length)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()],
+        })
+
+    async def respond(self, send, body, status=200, headers=None, content_type="text/html; charset=utf-8"):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        await self.start_response(send, status, headers, content_type, len(body))
+        await send({"type": "http.response.body", "body": body})
+
+    async def respond_json(self, send, data, status=200):
+        await self.respond(send, json.dumps(data), status=status, content_type="application/json")
+
+    async def render(self, send, template, **context):
+        body = await self.run(self.templates.get_template(template).render, **context)
+        await self.respond(send, body)
+
+    async def stream(self, request, send, chunks, status=200, headers=None, content_type=None, content_length=None):
+        """Sends an iterable of chunks, pulling each one on the stream pool
+
+        The iterable is always closed, so abandoned downloads are cleaned up.
+
+        """
+        iterator = iter(chunks)
+        try:
+            await self.start_response(send, status, headers, content_type, content_length)
+            if request.method != "HEAD":
+                while True:
+                    chunk = await self.pump(next_chunk, iterator)
+                    if chunk is DONE:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(iterator, "close"):
+                await self.pump(iterator.close)
+
+    async def send_file(self, request, send, fp, content_type):
+        """Sends an open file with ETag and Range support
+
+        Offloaded to a front end server if one is configured, and sent
+        with the ASGI zero copy extension if the server supports it.
+
+        :returns: The number of bytes of the file sent
+
+        """
+        try:
+            header = None if self.offload is None else self.offload.get_header(fp)
+            if header is not None:
+                await self.respond(send, b"", headers=[header], content_type=content_type)
+                return 0
+            stat = os.fstat(fp.fileno())
+            size = stat.st_size
+            etag = '"{0}-{1}"'.format(int(stat.st_mtime), size)
+            headers = Headers([
+                ("ETag", etag),
+                ("Last-Modified", http_date(stat.st_mtime)),
+                ("Accept-Ranges", "bytes"),
+            ])
+            if request.if_none_match(etag):
+                await self.start_response(send, 304, headers)
+                await send({"type": "http.response.body", "body": b""})
+                return 0
+            status = 200
+            start, length = 0, size
+            file_range = parse_range_header(request.headers.get("Range"))
+            if file_range is not None:
+                byte_range = file_range.range_for_length(size)
+                if byte_range is None:
+                    headers["Content-Range"] = "bytes */{0}".format(size)
+                    await self.respond(send, b"", status=416, headers=headers, content_type=None)
+                    return 0
+                start, end = byte_range
+                length = end - start
+                status = 206
+                headers["Content-Range"] = "bytes {0}-{1}/{2}".format(start, end - 1, size)
+            if "http.response.zerocopysend" in request.scope.get("extensions", {}):
+                await self.start_response(send, status, headers, content_type, length)
+                if request.method != "HEAD":
+                    await send({"type": "http.response.zerocopysend", "file": fp, "offset": start, "count": length})
+                    return length
+                await send({"type": "http.response.body", "body": b""})
+                return 0
+            await self.pump(fp.seek, start)
+            def chunks():
+                remaining = length
+                while remaining > 0:
+                    chunk = fp.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            await self.stream(request, send, chunks(), status, headers, content_type, length)
+            return length if request.method != "HEAD" else 0
+        finally:
+            fp.close()
+
+    async def index(self, request, send):
+        await self.render(send, "index.html")
+
+    async def static(self, request, send, path):
+        filename = safe_join(os.path.join(PACKAGE_ROOT, "static"), path)
+        if filename is None or not os.path.isfile(filename):
+            return await self.respond(send, b"Not Found", status=404, content_type="text/plain")
+        fp = await self.run(open, filename, "rb")
+        await self.send_file(request, send, fp, mimetypes.guess_type(filename)[0] or "application/octet-stream")
+
+    async def send_page(self, request, send, page):
+        """Sends a precomputed page, compressed if the client allows
+
+        """
+        encoding, body, etag = page.encode(request.headers.get("Accept-Encoding"))
+        etag = '"{0}"'.format(etag)
+        headers = Headers([("ETag", etag), ("Vary", "Accept, Accept-Encoding")])
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        if request.if_none_match(etag):
+            await self.start_response(send, 304, headers)
+            return await send({"type": "http.response.body", "body": b""})
+        await self.respond(send, body, headers=headers, content_type=page.content_type)
+
+    async def simple_index(self, request, send):
+        media_type = simple.negotiate(request.headers.get("Accept"))
+        page = await self.run(self.package_cache.get_simple_root, media_type)
+        await self.send_page(request, send, page)
+
+    async def simple_package_info(self, request, send, package, version=''):
+        media_type = simple.negotiate(request.headers.get("Accept"))
+        try:
+            page = await self.run(self.package_cache.get_simple_page, package, version, media_type)
+        except exceptions.NotFound:
+            return await self.respond(send, b"Not Found", status=404, content_type="text/plain")
+        await self.send_page(request, send, page)
+
+    async def stats(self, request, send):
+        await self.respond_json(send, await self.run(self.package_cache.stats))
+
+    async def metrics(self, request, send):
+        body = await self.run(metrics.REGISTRY.render)
+        await self.respond(send, body, content_type=metrics.CONTENT_TYPE)
+
+    async def local_index(self, request, send):
+        etag = '"{0}"'.format(await self.run(server.local_index_etag, self.package_store, request.scope.get("query_string", b"")))
+        headers = Headers([("ETag", etag)])
+        if request.if_none_match(etag):
+            await self.start_response(send, 304, headers)
+            return await send({"type": "http.response.body", "body": b""})
+        context = await self.run(server.local_index_context, self.package_store, request.args)
+        chunks = server.buffer_chunks(self.templates.get_template("local_index.html").generate(**context))
+        await self.stream(request, send, chunks, headers=headers, content_type="text/html; charset=utf-8")
+
+    async def local_package_info(self, request, send, package, version=''):
+        files = await self.run(lambda: server.filter_version(self.package_store.list_files(package), version))
+        if not files:
+            return await self.simple_package_info(request, send, package, version)
+        await self.render(send, "simple_package.html", package=package, files=files)
+
+    async def get_file(self, request, send, package, filename, python_version=None, firstletter=None):
+        self.log.debug("Request to get package with: {0} {1} {2} {3}".format(firstletter, package, filename, python_version))
+        interval = WAIT_INTERVAL
+        while True:
+            try:
+                content = await self.run(self.package_cache.get_file, package, filename, python_version=python_version, blocking=False)
+            except exceptions.NotFound:
+                return await self.respond(send, b"Not Found", status=404, content_type="text/plain")
+            if content is not None:
+                break
+            # Another request is downloading it, wait without holding a thread
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, MAX_WAIT_INTERVAL)
+        content_type = server.guess_content_type(filename)
+        if hasattr(content, "read"):
+            server.BYTES_SERVED.inc(await self.send_file(request, send, content, content_type))
+        else:
+            await self.stream(request, send, metrics.CountedChunks(content, server.BYTES_SERVED), content_type=content_type)
+
+    async def parse_form(self, request):
+        body, size = await request.spool_body()
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+            "CONTENT_LENGTH": str(size),
+            "wsgi.input": body,
+        }
+        stream, form, files = await self.run(parse_form_data, environ)
+        return form, files
+
+    async def post_uploadpackage(self, request, send):
+        chunks = request.iter_body(asyncio.get_running_loop())
+        status, data = await self.run(uploads.handle_upload, self.package_store, request.headers.get("Content-Type"), chunks)
+        await self.respond_json(send, data, status=status)
+
+    async def post_requirements_txt(self, request, send):
+        form, files = await self.parse_form(request)
+        if "requirements" not in files:
+            return await self.respond_json(send, {"error": True, "message": "Missing requirements data."}, status=400)
+        attached = dict((os.path.basename(upload.filename or ""), upload.stream) for _, upload in files.items(multi=True))
+        def include(name):
+            return attached.get(os.path.basename(name))
+        requirements_fp = files["requirements"].stream
+        if request.args.get("async"):
+            job = await self.run(self.package_cache.start_requirements_txt, requirements_fp, include=include)
+            return await self.respond_json(send, {"job": job.id, "status": "/requirements.txt/{0}".format(job.id)}, status=202)
+        report = await self.run(self.package_cache.cache_requirements_txt, requirements_fp, include=include)
+        await self.respond_json(send, report)
+
+    async def get_requirements_job(self, request, send, job_id):
+        try:
+            status = await self.run(self.package_cache.get_requirements_job, job_id)
+        except exceptions.NotFound:
+            return await self.respond(send, b"Not Found", status=404, content_type="text/plain")
+        await self.respond_json(send, status)
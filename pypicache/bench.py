@@ -0,0 +1,438 @@
+"""Benchmarks the cache against a fake upstream
+
+Starts a local fake PyPI (simple pages, the JSON API and generated
+package files, with configurable latency and bandwidth), runs the cache
+in a subprocess pointed at it and drives pip-like traffic through it:
+
+- cold: fetch a simple page, follow a link and download the file, for
+  packages the cache hasn't seen
+- warm: the same downloads again, served from the cache
+- warmup: POST a requirements.txt and wait for the files to be cached
+- large: concurrent downloads of large files
+
+Each scenario reports requests per second, p50/p99 latency, throughput
+and the requests it caused upstream. The cache's peak RSS is reported
+once it has exited. Results can be saved as JSON and compared with an
+earlier run to spot regressions.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import math
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+from pypicache import simple
+
+CHUNK_SIZE = 64 * 1024
+
+def percentile(values, fraction):
+    """Returns the nearest rank percentile of a list of numbers
+
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(math.ceil(fraction * len(values))) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+def iter_content(filename, size):
+    """Yields the generated content of a fake package file
+
+    Content is derived from the filename so it is the same every time
+    without being held in memory.
+
+    """
+    block = (hashlib.sha256(filename.encode("utf-8")).hexdigest().encode("ascii") * (CHUNK_SIZE // 64 + 1))[:CHUNK_SIZE]
+    remaining = size
+    while remaining > 0:
+        chunk = block[:min(remaining, CHUNK_SIZE)]
+        remaining -= len(chunk)
+        yield chunk
+
+class FakePackage(object):
+    def __init__(self, name, version, size):
+        self.name = name
+        self.version = version
+        self.size = size
+        self.filename = "{0}-{1}.tar.gz".format(name, version)
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        for chunk in iter_content(self.filename, size):
+            md5.update(chunk)
+            sha256.update(chunk)
+        self.md5 = md5.hexdigest()
+        self.sha256 = sha256.hexdigest()
+
+class FakeUpstream(object):
+    """A minimal PyPI serving generated packages
+
+    :param packages: FakePackages to serve
+    :param latency: Seconds to wait before answering each request
+    :param bandwidth: Bytes per second to send package files at, None for unlimited
+
+    """
+    def __init__(self, packages, latency=0.0, bandwidth=None, host="127.0.0.1", port=0):
+        self.log = logging.getLogger("pypicache.bench")
+        self.packages = {}
+        for package in packages:
+            self.packages.setdefault(package.name, {})[package.filename] = package
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.counters = dict(simple=0, json=0, files=0, bytes=0, not_found=0)
+        self.server = make_server(host, port, self.wsgi_app, threaded=True)
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/".format(*self.server.server_address[:2])
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-upstream")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def wsgi_app(self, environ, start_response):
+        request = Request(environ)
+        if self.latency:
+            time.sleep(self.latency)
+        response = self.dispatch(request.path)
+        if response.status_code == 404:
+            self.count("not_found")
+        return response(environ, start_response)
+
+    def dispatch(self, path):
+        match = re.match(r"^/simple/([^/]+)/$", path)
+        if match:
+            return self.simple_page(match.group(1))
+        match = re.match(r"^/pypi/([^/]+)/(?:([^/]+)/)?json$", path)
+        if match:
+            return self.json_page(*match.groups())
+        match = re.match(r"^/(?:files|packages/source/[^/]+)/([^/]+)/([^/]+)$", path)
+        if match:
+            return self.package_file(*match.groups())
+        return Response("Not Found", status=404)
+
+    def simple_page(self, name):
+        files = self.packages.get(name)
+        if files is None:
+            return Response("Not Found", status=404)
+        self.count("simple")
+        links = "\n".join(
+            '<a href="../../files/{0}/{1}#sha256={2}">{1}</a><br/>'.format(name, package.filename, package.sha256)
+            for package in sorted(files.values(), key=lambda package: package.filename)
+        )
+        body = "<html><body><h1>Links for {0}</h1>\n{1}\n</body></html>".format(name, links)
+        return Response(body, content_type="text/html")
+
+    def json_page(self, name, version=None):
+        files = self.packages.get(name)
+        if files is None:
+            return Response("Not Found", status=404)
+        self.count("json")
+        releases = {}
+        for package in files.values():
+            releases.setdefault(package.version, []).append(dict(
+                filename=package.filename,
+                url="{0}files/{1}/{2}".format(self.url, name, package.filename),
+                packagetype="sdist",
+                size=package.size,
+                md5_digest=package.md5,
+                digests=dict(md5=package.md5, sha256=package.sha256),
+            ))
+        if version is None:
+            # The project page also lists every release
+            data = dict(info=dict(name=name, version=sorted(releases)[-1]), releases=releases)
+            data["urls"] = releases[data["info"]["version"]]
+        elif version in releases:
+            data = dict(info=dict(name=name, version=version), urls=releases[version])
+        else:
+            return Response("Not Found", status=404)
+        return Response(json.dumps(data), content_type="application/json")
+
+    def package_file(self, name, filename):
+        package = self.packages.get(name, {}).get(filename)
+        if package is None:
+            return Response("Not Found", status=404)
+        self.count("files")
+        def chunks():
+            started = time.time()
+            sent = 0
+            for chunk in iter_content(package.filename, package.size):
+                yield chunk
+                sent += len(chunk)
+                if self.bandwidth:
+                    delay = started + float(sent) / self.bandwidth - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+            self.count("bytes", sent)
+        response = Response(chunks(), content_type="application/x-tar", direct_passthrough=True)
+        response.content_length = package.size
+        return response
+
+class LoadGenerator(object):
+    """Runs tasks concurrently, timing every request they make
+
+    A task is a callable taking the LoadGenerator, which makes its
+    requests with get().
+
+    """
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.bytes = 0
+
+    @property
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
+    def get(self, url):
+        """Fetches a URL, reading the whole body
+
+        :returns: The body if it is small, for following links
+
+        """
+        started = time.time()
+        size = 0
+        body = []
+        try:
+            response = self.session.get(url, stream=True, timeout=300)
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size <= 1024 * 1024:
+                    body.append(chunk)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        elapsed = time.time() - started
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.bytes += size
+            if not ok:
+                self.errors += 1
+        return b"".join(body) if ok else None
+
+    def run(self, tasks):
+        """Runs the tasks and summarises the requests they made
+
+        """
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for future in [executor.submit(task, self) for task in tasks]:
+                future.result()
+        seconds = time.time() - started
+        return dict(
+            requests=len(self.latencies),
+            errors=self.errors,
+            seconds=seconds,
+            req_per_s=len(self.latencies) / seconds if seconds else 0.0,
+            mb_per_s=self.bytes / seconds / 1024 / 1024 if seconds else 0.0,
+            p50=percentile(self.latencies, 0.5),
+            p99=percentile(self.latencies, 0.99),
+            bytes=self.bytes,
+        )
+
+def pip_install(base_url, package):
+    """Returns a task fetching a package the way pip does
+
+    """
+    def task(load):
+        page_url = "{0}simple/{1}/".format(base_url, package)
+        page = load.get(page_url)
+        if page is None:
+            return
+        links = simple.parse_links(page, page_url)
+        if links:
+            load.get(links[-1]["url"])
+    return task
+
+class Proxy(object):
+    """Runs the cache in a subprocess with the prefork launcher
+
+    :param args: Extra command line options, e.g. ["--hot-size", "256M"]
+
+    """
+    def __init__(self, upstream_url, prefix, port, workers=2, threads=16, args=()):
+        self.log = logging.getLogger("pypicache.bench")
+        self.url = "http://127.0.0.1:{0}/".format(port)
+        self.command = [
+            sys.executable, "-m", "pypicache.main", "prefork",
+            "--address", "127.0.0.1",
+            "--port", str(port),
+            "--upstream", upstream_url,
+            "--workers", str(workers),
+            "--threads", str(threads),
+        ] + list(args) + [prefix]
+        self.process = None
+
+    def start(self, timeout=30):
+        self.log.info("Starting {0}".format(" ".join(self.command)))
+        self.process = subprocess.Popen(self.command)
+        deadline = time.time() + timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("The cache exited with {0}".format(self.process.returncode))
+            try:
+                requests.get(self.url, timeout=1)
+                return self
+            except requests.RequestException:
+                if time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError("The cache didn't start within {0} seconds".format(timeout))
+                time.sleep(0.1)
+
+    def stop(self):
+        """Stops the cache
+
+        :returns: Peak RSS in kilobytes of the cache's largest process
+
+        """
+        self.process.send_signal(signal.SIGTERM)
+        self.process.wait()
+        # Covers every process we've waited for, i.e. the cache and its workers
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+class Bench(object):
+    """Runs the benchmark scenarios
+
+    """
+    def __init__(self, packages=50, size=64 * 1024, large_files=4, large_size=64 * 1024 * 1024, concurrency=16, rounds=3, latency=0.02, bandwidth=None, workers=2, threads=16, port=18080, proxy_args=()):
+        self.log = logging.getLogger("pypicache.bench")
+        self.config = dict(
+            packages=packages,
+            size=size,
+            large_files=large_files,
+            large_size=large_size,
+            concurrency=concurrency,
+            rounds=rounds,
+            latency=latency,
+            bandwidth=bandwidth,
+            workers=workers,
+            threads=threads,
+            proxy_args=list(proxy_args),
+        )
+        self.small = ["bench-{0:04d}".format(i) for i in range(packages)]
+        self.warmup = ["warmup-{0:04d}".format(i) for i in range(packages)]
+        self.large = ["large-{0:02d}".format(i) for i in range(large_files)]
+        fake_packages = [FakePackage(name, version, size) for name in self.small + self.warmup for version in ("1.0", "1.1")]
+        fake_packages.extend(FakePackage(name, "1.0", large_size) for name in self.large)
+        self.upstream = FakeUpstream(fake_packages, latency=latency, bandwidth=bandwidth)
+        self.prefix = tempfile.mkdtemp("pypicache-bench")
+        self.proxy = Proxy(self.upstream.url, self.prefix, port, workers=workers, threads=threads, args=proxy_args)
+
+    def scenario(self, name, tasks, concurrency=None):
+        self.log.info("Running {0}".format(name))
+        before = self.upstream.stats()
+        result = LoadGenerator(concurrency or self.config["concurrency"]).run(tasks)
+        after = self.upstream.stats()
+        result["upstream"] = dict((key, after[key] - before[key]) for key in after)
+        result["name"] = name
+        return result
+
+    def run_warmup(self):
+        self.log.info("Running warmup")
+        before = self.upstream.stats()
+        started = time.time()
+        requirements = "".join("{0}==1.1\n".format(package) for package in self.warmup).encode("ascii")
+        # Waits for the files, async jobs are only known to the worker which started them
+        response = requests.post(self.proxy.url + "requirements.txt", files=dict(requirements=("requirements.txt", requirements)))
+        response.raise_for_status()
+        report = response.json()
+        seconds = time.time() - started
+        after = self.upstream.stats()
+        return dict(
+            name="warmup",
+            requests=1,
+            errors=len(report["failed"]),
+            seconds=seconds,
+            files=len(report["cached"]),
+            files_per_s=len(report["cached"]) / seconds if seconds else 0.0,
+            upstream=dict((key, after[key] - before[key]) for key in after),
+        )
+
+    def run(self):
+        self.upstream.start()
+        try:
+            self.proxy.start()
+            try:
+                scenarios = [self.scenario("cold", [pip_install(self.proxy.url, package) for package in self.small])]
+                scenarios.append(self.scenario("warm", [pip_install(self.proxy.url, package) for package in self.small] * self.config["rounds"]))
+                scenarios.append(self.run_warmup())
+                scenarios.append(self.scenario("large", [pip_install(self.proxy.url, package) for package in self.large], concurrency=len(self.large)))
+            finally:
+                peak_rss_kb = self.proxy.stop()
+        finally:
+            self.upstream.stop()
+            shutil.rmtree(self.prefix, ignore_errors=True)
+        return dict(
+            config=self.config,
+            started=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            peak_rss_kb=peak_rss_kb,
+            scenarios=scenarios,
+        )
+
+def format_results(results, baseline=None):
+    """Formats results as a table, with changes from a baseline run
+
+    """
+    previous = {}
+    if baseline is not None:
+        previous = dict((scenario["name"], scenario) for scenario in baseline["scenarios"])
+    def change(name, key, value):
+        old = previous.get(name, {}).get(key)
+        if not old or value is None:
+            return ""
+        return " ({0:+.0f}%)".format((value - old) * 100.0 / old)
+    lines = ["{0:<8} {1:>8} {2:>14} {3:>18} {4:>18} {5:>10} {6:>9}".format("scenario", "requests", "req/s", "p50 ms", "p99 ms", "MB/s", "upstream")]
+    for scenario in results["scenarios"]:
+        name = scenario["name"]
+        rate_key = "req_per_s" if "req_per_s" in scenario else "files_per_s"
+        rate = scenario[rate_key]
+        p50 = scenario.get("p50")
+        p99 = scenario.get("p99")
+        lines.append("{0:<8} {1:>8} {2:>14} {3:>18} {4:>18} {5:>10} {6:>9}".format(
+            name,
+            scenario["requests"],
+            "{0:.1f}{1}".format(rate, change(name, rate_key, rate)),
+            "" if p50 is None else "{0:.1f}{1}".format(p50 * 1000, change(name, "p50", p50)),
+            "" if p99 is None else "{0:.1f}{1}".format(p99 * 1000, change(name, "p99", p99)),
+            "{0:.1f}".format(scenario["mb_per_s"]) if "mb_per_s" in scenario else "",
+            sum(count for key, count in scenario["upstream"].items() if key != "bytes"),
+        ))
+    lines.append("Peak RSS: {0} kB{1}".format(results["peak_rss_kb"], "" if baseline is None else " (was {0} kB)".format(baseline["peak_rss_kb"])))
+    return "\n".join(lines)
@@ -0,0 +1,186 @@
+"""Content addressed storage for package files
+
+Blobs are stored once per sha256 under <root>/sha256/<ab>/<cd>/<digest>
+and package files are hard links to them, so the same artifact stored
+under several names, or by several package stores sharing the blob
+directory, only takes up space once.
+
+Hard links only work within a filesystem, so the blob directory should
+be on the same filesystem as the package stores using it. Files are
+copied if it isn't.
+
+"""
+
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from pypicache import disk
+
+def make_link(source, path, replace=True):
+    """Atomically makes path a hard link to source, replacing anything there
+
+    Falls back to copying across filesystems.
+
+    :param replace: If False an existing file at path is left alone and
+        OSError with EEXIST raised
+
+    """
+    prefix = os.path.dirname(path)
+    # os.link won't replace an existing file, so a racing mktemp is harmless
+    temp = tempfile.mktemp(dir=prefix, prefix=".link-")
+    try:
+        os.link(source, temp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copyfile(source, temp)
+    try:
+        if replace:
+            os.rename(temp, path)
+            return
+        os.link(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+    os.remove(temp)
+
+class BlobStore(object):
+    """Stores files by their sha256 digest
+
+    :param root: Directory for blobs, may be shared by several package stores
+
+    """
+    def __init__(self, root):
+        self.log = logging.getLogger("pypicache.blobs")
+        self.root = root
+
+    def get_path(self, sha256):
+        return os.path.join(self.root, "sha256", sha256[:2], sha256[2:4], sha256)
+
+    def make_temp_file(self):
+        """Returns a temporary file which can be renamed into the blob store
+
+        """
+        prefix = os.path.join(self.root, "tmp")
+        disk.makedirs(prefix)
+        return tempfile.NamedTemporaryFile(dir=prefix, prefix="upload-", delete=False)
+
+    def add(self, temp_path, sha256, path, replace=True):
+        """Stores a fully written temporary file and links path to its blob
+
+        Content which is already stored is linked to the existing blob
+        and the temporary file thrown away, so adds are idempotent. If
+        the blob is released just as we link to it, the temporary file
+        becomes the blob instead.
+
+        :param replace: If False an existing file at path is left alone
+            and OSError with EEXIST raised
+
+        :returns: path of the blob
+
+        """
+        blob_path = self.get_path(sha256)
+        try:
+            while True:
+                try:
+                    make_link(blob_path, path, replace)
+                    return blob_path
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                disk.makedirs(os.path.dirname(blob_path))
+                # Blobs are shared, nobody gets to modify them in place
+                os.chmod(temp_path, 0o444)
+                try:
+                    os.link(temp_path, blob_path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    # Somebody else stored it first, link to theirs
+                    continue
+                disk.fsync_dir(os.path.dirname(blob_path))
+                # The temporary file's link keeps the new blob from being
+                # released until path links to it too
+                make_link(temp_path, path, replace)
+                return blob_path
+        finally:
+            try:
+                os.remove(temp_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def adopt(self, path, sha256):
+        """Moves an existing file into the store, leaving a link behind
+
+        If the content is already stored the file is replaced with a link
+        to the stored blob, freeing its space.
+
+        :returns: True if the file's space was freed
+
+        """
+        blob_path = self.get_path(sha256)
+        if os.path.exists(blob_path):
+            if os.path.samefile(blob_path, path):
+                return False
+            make_link(blob_path, path)
+            return True
+        disk.makedirs(os.path.dirname(blob_path))
+        make_link(path, blob_path)
+        return False
+
+    def release(self, sha256):
+        """Removes a blob if no package files link to it any more
+
+        Racing adds of the same content cope with the blob going away
+        (see add).
+
+        """
+        path = self.get_path(sha256)
+        try:
+            if os.stat(path).st_nlink == 1:
+                os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def quarantine(self, sha256, destination):
+        """Moves a corrupt blob out of the way
+
+        Package files still linking to it keep the corrupt content until
+        they are quarantined themselves.
+
+        """
+        try:
+            os.rename(self.get_path(sha256), destination)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def iter_blob_paths(self):
+        for root, dirs, files in os.walk(os.path.join(self.root, "sha256")):
+            for filename in files:
+                yield os.path.join(root, filename)
+
+    def gc(self, grace=3600):
+        """Removes blobs no package file links to any more
+
+        :param grace: Leave blobs changed in the last grace seconds alone,
+            they may be about to be linked
+        :returns: (blobs removed, bytes freed)
+
+        """
+        removed = freed = 0
+        cutoff = time.time() - grace
+        for path in self.iter_blob_paths():
+            stat = os.stat(path)
+            if stat.st_nlink == 1 and stat.st_ctime < cutoff:
+                self.log.info("Removing unused blob {0}".format(path))
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
@@ -1,6 +1,22 @@
 import logging
+import threading
+import time
 
+from pypicache import digests
 from pypicache import exceptions
+from pypicache import metrics
+from pypicache import simple
+from pypicache import store
+from pypicache import warmup
+
+CACHE_REQUESTS = metrics.Counter("pypicache_cache_requests_total", "Package file lookups by cache layer and result", ["layer", "result"])
+GET_FILE_SECONDS = metrics.Histogram("pypicache_get_file_seconds", "Time to start sending a package file, by where it came from", ["source"])
+FETCHED_BYTES = metrics.Counter("pypicache_upstream_bytes_total", "Bytes of package files downloaded from upstream")
+DOWNLOADS_IN_PROGRESS = metrics.Gauge("pypicache_downloads_in_progress", "Package files being downloaded from upstream")
+
+# Seconds between recounting stored packages for metrics, listing a
+# shared store's packages can take many requests
+PACKAGE_COUNT_TTL = 300
 
 class PackageCache(object):
     """A proxying cache for python packages
@@ -9,58 +25,304 @@ class PackageCache(object):
 
     Tries to mirror the PyPI structure
     """
-    def __init__(self, package_store, pypi):
+    def __init__(self, package_store, pypi, page_cache=None, warmup_workers=8, warmup_per_host=4, artifact_filter=None, evictor=None, scrubber=None, hot_files=None, negative_cache=None):
         self.log = logging.getLogger("packagecache")
         self.pypi = pypi
         self.package_store = package_store
+        self.page_cache = page_cache
+        self.evictor = evictor
+        self.scrubber = scrubber
+        self.hot_files = hot_files
+        self.negative_cache = negative_cache
+        if hot_files is not None:
+            package_store.add_listener(hot_files.invalidate)
+        if negative_cache is not None:
+            package_store.add_listener(negative_cache.invalidate)
+        self.tiers_lock = threading.Lock()
+        # Where package files were served from
+        self.tiers = dict(memory=0, disk=0, upstream=0)
+        # (recount after, number of packages)
+        self.package_count = (0, 0)
+        metrics.REGISTRY.set_collector("cache", self.collect_metrics)
+        self.simple_index = simple.SimpleIndex(self)
+        self.warmup = warmup.Warmup(
+            self,
+            workers=warmup_workers,
+            per_host=warmup_per_host,
+            artifact_filter=artifact_filter,
+        )
+
+    def check_misses(self, kind, package, detail=""):
+        """Raises NotFound if the lookup recently found nothing
+
+        """
+        if self.negative_cache is None:
+            return
+        message = self.negative_cache.get(kind, package, detail)
+        if message is not None:
+            CACHE_REQUESTS.labels("negative", "hit").inc()
+            raise exceptions.NotFound(message)
+
+    def remember_miss(self, kind, package, detail, error):
+        if self.negative_cache is not None:
+            self.negative_cache.add(kind, package, detail, str(error))
+
+    def file_miss_key(self, filename, python_version=None, url=None):
+        """Negative cache detail for a file download
+
+        A file missing from one python version's path or one upstream
+        location may still be found with another.
+
+        """
+        return " ".join((filename, python_version or "", url or ""))
+
+    def get_simple_package_info(self, package, version=''):
+        """Fetches a simple index page for a package from PyPI
+
+        Uses the page cache if one is configured.
+
+        """
+        self.check_misses("upstream-page", package, version)
+        try:
+            if self.page_cache is None:
+                return self.pypi.get_simple_package_info(package, version)
+            return self.page_cache.get(package, version)
+        except exceptions.NotFound as e:
+            self.remember_miss("upstream-page", package, version, e)
+            raise
+
+    def get_simple_page(self, package, version='', media_type=simple.HTML):
+        """Returns the simple index page served for a package
+
+        With a page cache the page is generated locally, listing stored
+        and upstream files with links back to this server. Otherwise the
+        PyPI page is passed through as HTML.
+
+        :param media_type: simple.HTML, simple.HTML_V1 or simple.JSON_V1
+        :returns: simple.Page
+        :raises NotFound: If the package isn't known
+
+        """
+        if self.page_cache is None:
+            return simple.Page(self.get_simple_package_info(package, version))
+        self.check_misses("page", package, version)
+        try:
+            return self.simple_index.get_page(package, version, media_type)
+        except exceptions.NotFound as e:
+            self.remember_miss("page", package, version, e)
+            raise
+
+    def get_simple_root(self, media_type=simple.HTML):
+        """Returns the simple index page listing every stored package
+
+        :returns: simple.Page
+
+        """
+        return self.simple_index.get_root(media_type)
+
+    def stats(self):
+        """Returns a dict of cache statistics
+
+        """
+        stats = dict(upstream=self.pypi.stats())
+        if self.page_cache is not None:
+            stats["simple_pages"] = self.page_cache.stats()
+        if self.evictor is not None:
+            stats["eviction"] = self.evictor.stats()
+        if self.scrubber is not None:
+            stats["scrub"] = self.scrubber.stats()
+        if self.hot_files is not None:
+            stats["hot_files"] = self.hot_files.stats()
+        if self.negative_cache is not None:
+            stats["misses"] = self.negative_cache.stats()
+        with self.tiers_lock:
+            stats["tiers"] = dict(self.tiers)
+        return stats
+
+    def collect_metrics(self):
+        """Reports the state of the cache as metrics
 
-    def get_file(self, package, filename, python_version=None):
+        """
+        gauges = [("pypicache_store_packages", "Packages in the store", self.count_packages())]
+        if self.evictor is not None:
+            gauges.append(("pypicache_store_bytes", "Size of the store's package files when eviction last checked", self.evictor.counters["size"]))
+        if self.hot_files is not None:
+            stats = self.hot_files.stats()
+            gauges.append(("pypicache_hot_files", "Package files served from memory", stats["entries"]))
+            gauges.append(("pypicache_hot_files_bytes", "Size of the package files served from memory", stats["size"]))
+        if self.page_cache is not None:
+            gauges.append(("pypicache_simple_pages_cached", "Upstream simple pages held in memory", self.page_cache.stats()["entries"]))
+        return [(name, "gauge", help, [({}, value)]) for name, help, value in gauges]
+
+    def count_packages(self):
+        """Returns the number of stored packages, recounted every PACKAGE_COUNT_TTL seconds
+
+        """
+        expires, count = self.package_count
+        if expires < time.time():
+            count = len(self.package_store.list_packages())
+            self.package_count = (time.time() + PACKAGE_COUNT_TTL, count)
+        return count
+
+    def count_tier(self, tier):
+        with self.tiers_lock:
+            self.tiers[tier] += 1
+
+    def get_stored_file(self, package, filename):
+        """Opens a stored file, from memory if it is hot
+
+        :raises NotFound: If the file isn't stored
+
+        """
+        if self.hot_files is not None:
+            hot = self.hot_files.get(package, filename)
+            if hot is not None:
+                self.package_store.touch(package, filename)
+                self.count_tier("memory")
+                CACHE_REQUESTS.labels("memory", "hit").inc()
+                return hot
+            CACHE_REQUESTS.labels("memory", "miss").inc()
+        try:
+            fp = self.package_store.get_file(package, filename)
+        except exceptions.NotFound:
+            CACHE_REQUESTS.labels("store", "miss").inc()
+            raise
+        self.count_tier("disk")
+        CACHE_REQUESTS.labels("store", "hit").inc()
+        if self.hot_files is None:
+            return fp
+        hot = self.hot_files.offer(package, filename, fp)
+        if hot is None:
+            return fp
+        fp.close()
+        return hot
+
+    def get_file(self, package, filename, python_version=None, url=None, expected=None, blocking=True):
         """Fetches a package file
 
         Attempts to use the local cache before falling back to PyPI.
+        Files fetched from PyPI are streamed back as they arrive while
+        being written to the local cache.
 
-        :returns: package file data
+        Only one download of a given file happens at a time, across
+        threads and processes sharing the package store. Concurrent
+        requests for the same file wait for that download and then read
+        the cached copy.
 
-        - TODO: Change to returning a iterable
+        Downloads are checked against the digests upstream publishes for
+        the file and only stored if they match.
+
+        :param url: Upstream location of the file, if known
+        :param expected: dict of md5 and/or sha256 hex digests the file
+            should have, if known
+        :param blocking: Wait for another download of the file to finish,
+            otherwise None is returned while one is in progress
+        :returns: An open file for cached packages, otherwise an
+            iterable of package data chunks.
+        :raises NotFound: If the file is neither stored nor upstream,
+            straight away if that was found out recently
+        :raises CorruptFileError: Once the chunks run out, if the download
+            didn't match the expected digests
 
         """
-        def get():
-            return self.package_store.get_file(package, filename).read()
+        requested = self.file_miss_key(filename, python_version, url)
+        self.check_misses("file", package, requested)
+        started = time.time()
+        try:
+            fp = self.get_stored_file(package, filename)
+        except exceptions.NotFound:
+            pass
+        else:
+            GET_FILE_SECONDS.labels("store").observe(time.time() - started)
+            return fp
+        lock = self.package_store.lock(package, filename)
+        if not lock.acquire(blocking=False):
+            if not blocking:
+                return None
+            self.log.info("Waiting for another download of {0}: {1}".format(package, filename))
+            lock.acquire()
         try:
-            return get()
+            fp = self.get_stored_file(package, filename)
         except exceptions.NotFound:
-            # TODO change to iterating over a http response
-            content = self.pypi.get_file(package, filename, python_version=python_version)
-            self.package_store.add_file(package, filename, content)
-            return get()
+            pass
+        except BaseException:
+            lock.release()
+            raise
+        else:
+            # Somebody else downloaded it while we waited
+            lock.release()
+            return fp
+        try:
+            if url is None and self.page_cache is not None:
+                link = self.simple_index.find_upstream_link(package, filename)
+                if link is not None:
+                    url = link["url"]
+                    expected = expected or digests.expected_digests(link)
+            elif url is not None:
+                url, url_digests = digests.split_url(url)
+                expected = expected or url_digests
+            resolved = self.file_miss_key(filename, python_version, url)
+            if resolved != requested:
+                self.check_misses("file", package, resolved)
+            try:
+                content = self.pypi.get_file(package, filename, python_version=python_version, url=url)
+            except exceptions.NotFound as e:
+                self.remember_miss("file", package, requested, e)
+                self.remember_miss("file", package, resolved, e)
+                raise
+            chunks = self.package_store.tee_file(package, filename, content, expected=expected or None)
+            chunks = metrics.CountedChunks(chunks, FETCHED_BYTES, DOWNLOADS_IN_PROGRESS)
+            self.count_tier("upstream")
+        except BaseException:
+            lock.release()
+            raise
+        GET_FILE_SECONDS.labels("upstream").observe(time.time() - started)
+        return store.LockedIterator(chunks, lock)
+
+    def cache_file(self, package, filename, python_version=None, url=None, expected=None):
+        """Makes sure a package file is in the local cache
 
-    def cache_requirements_txt(self, requirements_fp):
+        Like get_file but doesn't hand back the package data.
+
+        """
+        content = self.get_file(package, filename, python_version=python_version, url=url, expected=expected)
+        try:
+            if not hasattr(content, "read"):
+                for chunk in content:
+                    pass
+        finally:
+            content.close()
+
+    def cache_requirements_txt(self, requirements_fp, include=None):
         """Take a requirements.txt file and cache packages
 
         This will parse a given requirements file, looking for packages
         to cache. This will only handle definitive versions, not
-        relative ones.
+        relative ones. The sdist and wheels chosen by the artifact
+        filter are fetched concurrently.
 
         :parm requirements_fp: File object containing a requirements.txt
+        :param include: Callable returning the lines of a -r include, or None
+        :returns: dict of cached, unparseable and failed entries
+
+        """
+        return self.warmup.run(requirements_fp, include=include)
+
+    def start_requirements_txt(self, requirements_fp, include=None):
+        """Like cache_requirements_txt but returns without waiting
+
+        :returns: warmup.Job tracking progress
+
+        """
+        return self.warmup.start(requirements_fp, include=include)
+
+    def get_requirements_job(self, job_id):
+        """Returns the status of a job started by start_requirements_txt
+
+        :raises NotFound: for unknown jobs
 
         """
-        processing_info = {
-            "cached": [],
-            "unparseable": [],
-            "failed": [],
-        }
-        for line in (line.strip() for line in requirements_fp):
-            self.log.debug("Examining requirement {0!r}".format(line))
-            if "==" in line:
-                package, version = line.split("==")
-                try:
-                    for url in (url for url in self.pypi.get_urls(package, version) if url["packagetype"] == "sdist"):
-                        self.log.debug("Looking at {0!r}".format(url))
-                        self.get_file(package, url["filename"])
-                        processing_info["cached"].append(url["filename"])
-                except exceptions.NotFound:
-                    processing_info["failed"].append(line)
-            else:
-                self.log.debug("Don't know how to handle {0!r}".format(line))
-                processing_info["unparseable"].append(line)
-        return processing_info
+        job = self.warmup.get_job(job_id)
+        if job is None:
+            raise exceptions.NotFound("Unknown job {0}".format(job_id))
+        return job.status()
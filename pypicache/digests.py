@@ -0,0 +1,198 @@
+"""Persistent index of package file digests
+
+Hashing every archive whenever a package is listed gets expensive
+quickly, so digests are kept in a small sqlite database next to the
+packages. Entries are keyed by path and are only recomputed when a
+file's size or mtime changes.
+
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+# Forward compatible with python 3
+try:
+    from urllib.parse import urldefrag
+except ImportError:
+    from urlparse import urldefrag
+
+from pypicache import exceptions
+
+CHUNK_SIZE = 64 * 1024
+
+ALGORITHMS = ("md5", "sha256")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    md5 TEXT NOT NULL,
+    sha256 TEXT NOT NULL
+)
+"""
+
+def hash_file(path):
+    """Compute the md5 and sha256 of a file in a single pass
+
+    :returns: dict with md5 and sha256 hex digests
+
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+    return dict(md5=md5.hexdigest(), sha256=sha256.hexdigest())
+
+def expected_digests(info):
+    """Picks the digests a file should have out of upstream file info
+
+    :param info: url dict from the PyPI JSON API, or a link parsed from
+        a simple page
+    :returns: dict of algorithm to hex digest, possibly empty
+
+    """
+    expected = {}
+    for algorithm, digest in (info.get("digests") or {}).items():
+        if algorithm in ALGORITHMS and digest:
+            expected[algorithm] = digest.lower()
+    if info.get("md5_digest"):
+        expected.setdefault("md5", info["md5_digest"].lower())
+    for algorithm in ALGORITHMS:
+        if info.get(algorithm):
+            expected.setdefault(algorithm, info[algorithm].lower())
+    return expected
+
+def split_url(url):
+    """Splits a digest fragment, e.g. #sha256=..., off a file URL
+
+    :returns: (url, dict of algorithm to hex digest)
+
+    """
+    url, fragment = urldefrag(url)
+    algorithm, _, digest = fragment.partition("=")
+    if algorithm in ALGORITHMS and digest:
+        return url, {algorithm: digest.lower()}
+    return url, {}
+
+def verify(expected, actual, name):
+    """Checks digests worked out while writing a file against those expected
+
+    :param expected: dict of algorithm to hex digest, may be None or empty
+    :param actual: dict with md5 and sha256 hex digests
+    :raises CorruptFileError: If any expected digest doesn't match
+
+    """
+    for algorithm, digest in (expected or {}).items():
+        if algorithm in actual and actual[algorithm] != digest:
+            raise exceptions.CorruptFileError("{0} has {1} {2}, expected {3}".format(name, algorithm, actual[algorithm], digest))
+
+class DigestIndex(object):
+    """Caches file digests in a sqlite database
+
+    Safe to share between threads (each thread gets its own connection)
+    and between processes (sqlite handles the locking).
+
+    """
+    def __init__(self, path):
+        self.log = logging.getLogger("pypicache.digests")
+        self.path = path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            prefix = os.path.dirname(self.path)
+            if prefix and not os.path.isdir(prefix):
+                os.makedirs(prefix)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute(SCHEMA)
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def get(self, key, path):
+        """Get the digests for a file, hashing it only if it has changed
+
+        :param key: Index key for the file (usually a path relative to the store)
+        :param path: Location of the file on disk
+        :returns: dict with md5 and sha256 hex digests
+
+        """
+        stat = os.stat(path)
+        row = self.connection.execute(
+            "SELECT size, mtime, md5, sha256 FROM digests WHERE path = ?", (key,)
+        ).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+            return dict(md5=row[2], sha256=row[3])
+        self.log.debug("Hashing {0!r}".format(path))
+        return self.update(key, path)
+
+    def update(self, key, path, digests=None):
+        """Record the digests for a file
+
+        :param digests: Precomputed digests, if None the file is hashed
+        :returns: dict with md5 and sha256 hex digests
+
+        """
+        if digests is None:
+            digests = hash_file(path)
+        stat = os.stat(path)
+        with self.connection as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO digests (path, size, mtime, md5, sha256) VALUES (?, ?, ?, ?, ?)",
+                (key, stat.st_size, stat.st_mtime, digests["md5"], digests["sha256"])
+            )
+        return dict(md5=digests["md5"], sha256=digests["sha256"])
+
+    def lookup(self, key):
+        """Returns what was recorded for a file without looking at it
+
+        :returns: dict of size, mtime, md5 and sha256, or None
+
+        """
+        row = self.connection.execute(
+            "SELECT size, mtime, md5, sha256 FROM digests WHERE path = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(size=row[0], mtime=row[1], md5=row[2], sha256=row[3])
+
+    def total_size(self, distinct=False):
+        """Returns the total size of the indexed files
+
+        :param distinct: Count identical content once, for stores whose
+            identical files are links to one blob
+
+        """
+        if distinct:
+            query = "SELECT sum(size) FROM (SELECT DISTINCT sha256, size FROM digests)"
+        else:
+            query = "SELECT sum(size) FROM digests"
+        return self.connection.execute(query).fetchone()[0] or 0
+
+    def remove(self, key):
+        with self.connection as connection:
+            connection.execute("DELETE FROM digests WHERE path = ?", (key,))
+
+    def rebuild(self, files):
+        """Rebuild the index from scratch
+
+        :param files: Iterable of (key, path) pairs to hash
+        :returns: Number of files indexed
+
+        """
+        with self.connection as connection:
+            connection.execute("DELETE FROM digests")
+        count = 0
+        for key, path in files:
+            self.update(key, path)
+            count += 1
+        self.log.info("Indexed {0} files in {1}".format(count, self.path))
+        return count
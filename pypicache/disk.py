@@ -2,86 +2,480 @@
 
 """
 
+import errno
+import fcntl
 import hashlib
-from glob import glob
 import logging
 import os
-import re
+import tempfile
+import time
 
+from pypicache import digests
 from pypicache import exceptions
+from pypicache import metrics
+from pypicache import names
+from pypicache import store
 
-class DiskPackageStore(object):
-    def __init__(self, prefix):
+CHUNK_SIZE = 64 * 1024
+
+FILES_WRITTEN = metrics.Counter("pypicache_store_files_written_total", "Package files written to the store")
+BYTES_WRITTEN = metrics.Counter("pypicache_store_bytes_written_total", "Bytes of package files written to the store")
+
+def iter_chunks(content):
+    """Yields chunks of data from a string, file object or iterable of strings
+
+    """
+    if isinstance(content, bytes):
+        yield content
+    elif hasattr(content, "read"):
+        for chunk in iter(lambda: content.read(CHUNK_SIZE), b""):
+            yield chunk
+    else:
+        for chunk in content:
+            yield chunk
+
+def makedirs(path):
+    """Creates a directory and its parents if they don't exist
+
+    Copes with other processes creating the same directories.
+
+    """
+    if os.path.isdir(path):
+        return
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def fsync_dir(path):
+    """Makes renames and new links in a directory survive a crash
+
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # Not supported everywhere, e.g. on some network filesystems
+        pass
+    finally:
+        os.close(fd)
+
+class FileLock(object):
+    """An exclusive lock backed by flock()
+
+    Each acquire opens its own file descriptor, so the lock excludes
+    other threads in this process as well as other processes.
+
+    :param remove: Delete the lock file on release, for locks on things
+        which come and go (e.g. package files) so lock files don't pile up
+
+    """
+    def __init__(self, path, remove=False):
+        self.path = path
+        self.remove = remove
+        self.fp = None
+
+    def acquire(self, blocking=True):
+        """Acquire the lock
+
+        :param blocking: Wait for the lock if somebody else holds it
+        :returns: True if the lock was acquired
+
+        """
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            makedirs(os.path.dirname(self.path))
+            fp = open(self.path, "a")
+            try:
+                fcntl.flock(fp.fileno(), flags)
+            except (IOError, OSError) as e:
+                fp.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            # The holder we waited for may have removed the file, in
+            # which case we locked a file nobody else will look at
+            try:
+                current = os.stat(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    fp.close()
+                    raise
+                current = None
+            locked = os.fstat(fp.fileno())
+            if current is not None and (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino):
+                self.fp = fp
+                return True
+            fp.close()
+
+    def release(self):
+        if self.fp is not None:
+            if self.remove:
+                # Unlink while still holding the lock, so waiters notice
+                try:
+                    os.remove(self.path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class DiskPackageStore(store.PackageStore):
+    """Stores packages under <prefix>/packages/<firstletter>/<package>/<filename>
+
+    :param blob_store: Optional blobs.BlobStore, package files are then
+        hard links to content addressed blobs
+    :param access_log: Optional eviction.AccessLog to record reads and
+        pinned files in
+
+    """
+    def __init__(self, prefix, blob_store=None, access_log=None):
+        store.PackageStore.__init__(self)
         self.log = logging.getLogger("pypicache.disk")
         self.prefix = prefix
+        self.blob_store = blob_store
+        self.access_log = access_log
+        self.digests = digests.DigestIndex(os.path.join(self.prefix, "digests.sqlite"))
+        self.index = names.PackageIndex(os.path.join(self.prefix, "packages"))
+
+    def get_digests(self, path):
+        """Returns the md5 and sha256 digests of a stored file
+
+        Uses the digest index, so files are only hashed when new or changed.
+
+        """
+        return self.digests.get(os.path.relpath(path, self.prefix), path)
+
+    def iter_file_paths(self):
+        """Yields the path of every stored package file
+
+        """
+        for root, dirs, files in os.walk(os.path.join(self.prefix, "packages")):
+            for filename in files:
+                yield os.path.join(root, filename)
+
+    def rebuild_index(self):
+        """Rebuilds the digest index by rehashing every stored file
+
+        :returns: Number of files indexed
+
+        """
+        return self.digests.rebuild(
+            (os.path.relpath(path, self.prefix), path) for path in self.iter_file_paths()
+        )
+
+    def migrate_to_blobs(self):
+        """Moves every stored file into the blob store, in place
+
+        Files with identical content end up sharing one blob. Safe to
+        run again, e.g. after an interruption.
+
+        :returns: (files migrated, bytes freed)
+
+        """
+        if self.blob_store is None:
+            raise ValueError("No blob store configured")
+        count = freed = 0
+        for path in self.iter_file_paths():
+            key = os.path.relpath(path, self.prefix)
+            file_digests = self.digests.get(key, path)
+            if self.blob_store.adopt(path, file_digests["sha256"]):
+                freed += os.path.getsize(path)
+            # The link may have a different mtime
+            self.digests.update(key, path, file_digests)
+            count += 1
+        return count, freed
 
     def get_file_path(self, package, filename):
         firstletter = package[0]
         return os.path.join(self.prefix, "packages/{0}/{1}/{2}".format(firstletter, package, filename))
 
+    def lock(self, package, filename):
+        """Returns a lock for writing the given package file
+
+        Lock files live under <prefix>/locks and are shared by every
+        process using the same prefix. Every spelling of a package gets
+        the same lock, and lock files are removed again on release.
+
+        """
+        path = os.path.join(self.prefix, "locks", names.normalize(package), "{0}.lock".format(filename.lower()))
+        return FileLock(path, remove=True)
+
     def list_files(self, package):
         firstletter = package[0]
         prefix = os.path.join(self.prefix, "packages/{0}/{1}".format(firstletter, package))
         self.log.debug("Using package prefix {0!r}".format(prefix))
         # Try fishing for correct name
         if not os.path.isdir(prefix):
-            self.log.info("Fishing for package matching {0}".format(package))
-            g = None
-            def normalize(package_name):
-                return package_name.lower().replace('-', '_')
-            for my_package in self.list_packages():
-                if normalize(my_package) == normalize(package):
-                    g = self.list_files(my_package)
-                    break
-            if g is not None:
-                for i in g:
+            my_package = self.index.find_package(package)
+            if my_package is not None and my_package != package:
+                self.log.info("Found package {0} matching {1}".format(my_package, package))
+                for i in self.list_files(my_package):
                     yield i
-                return
+            return
         for root, dirs, files in os.walk(prefix, topdown=False):
             self.log.info("Examining {0} for files".format((root, dirs, files)))
             for filename in files:
                 abspath = os.path.join(root, filename)
-                yield dict(
+                info = dict(
                     package=package,
                     firstletter=firstletter,
                     filename=filename,
-                    md5=hashlib.md5(open(abspath).read()).hexdigest()
                 )
+                info.update(self.get_digests(abspath))
+                yield info
+
+    def list_filenames(self, package):
+        return sorted(self.index.list_filenames(package).values())
+
+    def find_package(self, package):
+        return self.index.find_package(package)
+
+    def list_packages(self, prefix="", offset=0, limit=None):
+        if not prefix and not offset and limit is None:
+            return self.index.list_packages()
+        return self.index.query(prefix, offset, limit)
+
+    def packages_etag(self):
+        return self.index.fingerprint()
 
-    def list_packages(self):
-        path = os.path.join(self.prefix, "packages/?/*")
-        self.log.info("Listing packages in {0}".format(path))
-        for packagename in sorted(glob(path)):
-            if not os.path.isdir(packagename):
-                continue
-            yield os.path.basename(packagename)
+    def find_file_path(self, package, filename):
+        """Returns the path of a stored file, ignoring differences in spelling
+
+        :raises NotFound: If the file isn't stored
+
+        """
+        path = self.get_file_path(package, filename)
+        if os.path.isfile(path):
+            return path
+        found = self.index.find_file(package, filename)
+        if found is None:
+            raise exceptions.NotFound("Package {0}: {1} not found in {2}".format(package, filename, path))
+        return self.get_file_path(*found)
+
+    def stat(self, package, filename):
+        path = self.find_file_path(package, filename)
+        stat = os.stat(path)
+        info = dict(size=stat.st_size, mtime=stat.st_mtime)
+        info.update(self.get_digests(path))
+        return info
 
     def get_file(self, package, filename):
         path = self.get_file_path(package, filename)
         try:
-            return open(path, "rb")
+            fp = open(path, "rb")
         except IOError:
-            self.log.info("Fishing for package file matching {0}: {1}".format(package, filename))
-            # Try fishing for the file with different cases
-            for my_package in self.list_packages():
-                if package.lower() == my_package.lower():
-                    for fileinfo in self.list_files(my_package):
-                        my_filename = fileinfo["filename"]
-                        if my_filename.lower() == filename.lower():
-                            return self.get_file(my_package, my_filename)
+            # Try finding the file with different cases
+            found = self.index.find_file(package, filename)
+            if found is not None and found != (package, filename):
+                self.log.info("Found package file {0} matching {1}: {2}".format(found, package, filename))
+                return self.get_file(*found)
             raise exceptions.NotFound("Package {0}: {1} not found in {2}".format(package, filename, path))
+        if self.access_log is not None:
+            self.access_log.record(os.path.relpath(path, self.prefix))
+        return fp
 
-    def add_file(self, package, filename, content):
-        path = self.get_file_path(package, filename)
-        if os.path.isfile(path):           
-            if not re.search(r'-(dev|SNAPSHOT)\.(zip|tar.gz|tar.bz2)$', filename):
+    def touch(self, package, filename):
+        if self.access_log is None:
+            return
+        try:
+            path = self.find_file_path(package, filename)
+        except exceptions.NotFound:
+            return
+        self.access_log.record(os.path.relpath(path, self.prefix))
+
+    def check_overwrite(self, path, filename):
+        """Raises NotOverwritingError if the file can't be replaced
+
+        Only development snapshots can be overwritten.
+
+        """
+        if os.path.isfile(path):
+            if not store.is_snapshot(filename):
                 raise exceptions.NotOverwritingError("Not overwriting {0}".format(path))
-        prefix = os.path.dirname(path)
-        if not os.path.isdir(prefix):
-            self.log.debug("Making directories {0}".format(prefix))
-            os.makedirs(prefix)
-        with open(path, "wb") as output:
-            # TODO this is working around a difference in file obj vs string somewhere
-            if hasattr(content, "read"):
-                content = content.read()
-            output.write(content)
+
+    def make_temp_file(self):
+        """Returns a temporary file on the same filesystem as the packages
+
+        Files are written here first and then renamed into place so
+        partial files never appear in the store.
+
+        """
+        if self.blob_store is not None:
+            return self.blob_store.make_temp_file()
+        prefix = os.path.join(self.prefix, "tmp")
+        makedirs(prefix)
+        return tempfile.NamedTemporaryFile(dir=prefix, prefix="upload-", delete=False)
+
+    def tee_file(self, package, filename, content, expected=None):
+        """Writes a file to the store, yielding the data as it is written
+
+        The file only appears in the store once all of the content has
+        been written, synced to disk and checked against the expected
+        digests. If the iteration is abandoned (e.g. the client went
+        away) or the content is corrupt the partial file is thrown away.
+
+        :param content: A string, file object or iterable of strings
+        :param expected: dict of md5 and/or sha256 hex digests the file should have
+        :returns: generator of data chunks
+        :raises CorruptFileError: At the end, if the digests don't match
+
+        """
+        path = self.get_file_path(package, filename)
+        self.check_overwrite(path, filename)
+        output = self.make_temp_file()
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            for chunk in iter_chunks(content):
+                output.write(chunk)
+                md5.update(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                yield chunk
+            actual = dict(md5=md5.hexdigest(), sha256=sha256.hexdigest())
+            digests.verify(expected, actual, filename)
+            output.flush()
+            os.fsync(output.fileno())
+            output.close()
+            makedirs(os.path.dirname(path))
+            self.publish(output.name, actual["sha256"], path, filename)
+            fsync_dir(os.path.dirname(path))
+            self.index.add(package, filename)
+        except BaseException:
+            output.close()
+            if os.path.exists(output.name):
+                os.remove(output.name)
+            # Let a streamed download go, file objects belong to the caller
+            if hasattr(content, "close") and not hasattr(content, "read"):
+                content.close()
+            raise
+        self.digests.update(os.path.relpath(path, self.prefix), path, actual)
+        FILES_WRITTEN.inc()
+        BYTES_WRITTEN.inc(size)
+        self.notify(package, filename)
+
+    def publish(self, temp_path, sha256, path, filename):
+        """Moves a fully written temporary file into place
+
+        Another writer may have published the file since check_overwrite
+        was run, so only snapshots replace an existing file.
+
+        :raises NotOverwritingError: If the file appeared meanwhile
+
+        """
+        replace = store.is_snapshot(filename)
+        try:
+            if self.blob_store is not None:
+                self.blob_store.add(temp_path, sha256, path, replace=replace)
+            elif replace:
+                os.rename(temp_path, path)
+            else:
+                os.link(temp_path, path)
+                os.remove(temp_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            raise exceptions.NotOverwritingError("Not overwriting {0}".format(path))
+
+    def add_file(self, package, filename, content, pinned=False, expected=None):
+        """Writes a file to the store
+
+        :param content: A string, file object or iterable of strings
+        :param pinned: Never evict the file (e.g. for uploaded packages)
+        :param expected: dict of md5 and/or sha256 hex digests the file should have
+
+        """
+        for chunk in self.tee_file(package, filename, content, expected=expected):
+            pass
+        if pinned:
+            self.pin(package, filename)
+
+    def pin(self, package, filename):
+        """Protects a file from eviction
+
+        """
+        if self.access_log is not None:
+            self.access_log.pin(os.path.relpath(self.get_file_path(package, filename), self.prefix))
+
+    def remove_file(self, package, filename):
+        """Removes a file from the store
+
+        Files being written are left alone.
+
+        :returns: True if the file was removed
+
+        """
+        lock = self.lock(package, filename)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            path = self.get_file_path(package, filename)
+            key = os.path.relpath(path, self.prefix)
+            sha256 = None
+            if self.blob_store is not None:
+                sha256 = self.get_digests(path)["sha256"]
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+            self.log.info("Removed {0}".format(path))
+            self.digests.remove(key)
+            if self.access_log is not None:
+                self.access_log.forget(key)
+            if sha256 is not None:
+                self.blob_store.release(sha256)
+        finally:
+            lock.release()
+        self.notify(package, filename)
+        return True
+
+    def quarantine_file(self, package, filename, reason):
+        """Moves a corrupt file out of the store, into <prefix>/quarantine
+
+        With a blob store the blob goes too, so the next download of the
+        content writes a fresh one rather than linking to the corrupt one.
+
+        :returns: True if the file was moved
+
+        """
+        lock = self.lock(package, filename)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            path = self.get_file_path(package, filename)
+            key = os.path.relpath(path, self.prefix)
+            recorded = self.digests.lookup(key)
+            destination = os.path.join(self.prefix, "quarantine", "{0}.{1}".format(key, int(time.time())))
+            makedirs(os.path.dirname(destination))
+            try:
+                os.rename(path, destination)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return False
+            self.log.error("Quarantined {0} as {1}: {2}".format(path, destination, reason))
+            self.digests.remove(key)
+            if self.access_log is not None:
+                self.access_log.forget(key)
+            if self.blob_store is not None and recorded is not None:
+                self.blob_store.quarantine(recorded["sha256"], destination + ".blob")
+        finally:
+            lock.release()
+        self.notify(package, filename)
+        return True
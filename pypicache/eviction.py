@@ -0,0 +1,263 @@
+"""Keeps a package store within a disk quota
+
+Reads of stored files are counted in memory (see AccessLog.record) and
+written to a small sqlite database in batches. An Evictor thread
+periodically flushes the counts and, if the store has grown past its
+quota, removes the least recently (LRU) or least frequently (LFU) used
+files until it is back under a low watermark. Pinned files, such as
+locally uploaded packages, are never evicted.
+
+The store's size is read from its digest index, which every process
+sharing the store updates as files are added and removed, so the store
+is only walked on the first check and when it looks to be over quota.
+
+"""
+
+import collections
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from pypicache import disk
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS access (
+    path TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    pinned INTEGER NOT NULL
+)
+"""
+
+POLICIES = ("lru", "lfu")
+
+SIZE_UNITS = dict(k=1024, m=1024 ** 2, g=1024 ** 3, t=1024 ** 4)
+
+def parse_size(value):
+    """Parses a size like 500M or 20G into bytes
+
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$", str(value), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Can't parse size {0!r}".format(value))
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS.get(unit.lower(), 1))
+
+class AccessLog(object):
+    """Records file accesses, batching them in memory
+
+    record() only touches memory, flush() writes everything recorded
+    since the last flush in one transaction. Safe to share between
+    threads and processes like digests.DigestIndex.
+
+    """
+    def __init__(self, path):
+        self.log = logging.getLogger("pypicache.eviction")
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # key -> [hits, last access]
+        self.pending = {}
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            prefix = os.path.dirname(self.path)
+            if prefix and not os.path.isdir(prefix):
+                os.makedirs(prefix)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute(SCHEMA)
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def record(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [1, now]
+            else:
+                entry[0] += 1
+                entry[1] = now
+
+    def flush(self):
+        """Writes the recorded accesses to the database
+
+        :returns: Number of files written
+
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        with self.connection as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO access (path, hits, last_access, pinned) VALUES (?, 0, 0, 0)",
+                [(key,) for key in pending],
+            )
+            connection.executemany(
+                "UPDATE access SET hits = hits + ?, last_access = max(last_access, ?) WHERE path = ?",
+                [(hits, last_access, key) for key, (hits, last_access) in pending.items()],
+            )
+        return len(pending)
+
+    def pin(self, key):
+        """Protects a file from eviction
+
+        """
+        with self.connection as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO access (path, hits, last_access, pinned) VALUES (?, 0, ?, 1)",
+                (key, time.time()),
+            )
+            connection.execute("UPDATE access SET pinned = 1 WHERE path = ?", (key,))
+
+    def forget(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+        with self.connection as connection:
+            connection.execute("DELETE FROM access WHERE path = ?", (key,))
+
+    def get_all(self):
+        """Returns a dict of key to (hits, last access, pinned)
+
+        """
+        rows = self.connection.execute("SELECT path, hits, last_access, pinned FROM access")
+        return dict((row[0], (row[1], row[2], bool(row[3]))) for row in rows)
+
+class Evictor(object):
+    """Evicts files from a package store once it goes over quota
+
+    :param package_store: DiskPackageStore to keep in check, with an AccessLog
+    :param max_bytes: Quota for the store's package files
+    :param policy: "lru" or "lfu"
+    :param interval: Seconds between flushing access counts and checking
+        the quota
+    :param low_watermark: Fraction of the quota to evict down to, so
+        evictions happen in batches rather than on every check
+
+    """
+    def __init__(self, package_store, max_bytes, policy="lru", interval=60, low_watermark=0.9):
+        if policy not in POLICIES:
+            raise ValueError("Unknown eviction policy {0!r}".format(policy))
+        self.log = logging.getLogger("pypicache.eviction")
+        self.package_store = package_store
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.interval = interval
+        self.low_watermark = low_watermark
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counters = dict(runs=0, evicted_files=0, evicted_bytes=0, size=0)
+
+    def stats(self):
+        return dict(self.counters, max_bytes=self.max_bytes, policy=self.policy)
+
+    def sort_key(self, accesses):
+        def key(item):
+            path, stat = item
+            hits, last_access, pinned = accesses.get(os.path.relpath(path, self.package_store.prefix), (0, stat.st_mtime, False))
+            if self.policy == "lfu":
+                return (hits, last_access)
+            return last_access
+        return key
+
+    def run_once(self):
+        """Flushes access counts and evicts files if the store is over quota
+
+        Only one process sharing a store evicts at a time, others just
+        flush their access counts.
+
+        :returns: (files evicted, bytes freed)
+
+        """
+        access_log = self.package_store.access_log
+        access_log.flush()
+        lock = disk.FileLock(os.path.join(self.package_store.prefix, "locks", "evictor.lock"))
+        if not lock.acquire(blocking=False):
+            return 0, 0
+        try:
+            return self.evict()
+        finally:
+            lock.release()
+
+    def scan(self):
+        """Walks the store, working out its size
+
+        :returns: (list of (path, stat), Counter of links per inode, total size)
+
+        """
+        files = []
+        # Hard links to the same content (see blobs) only take space once
+        links = collections.Counter()
+        sizes = {}
+        for path in self.package_store.iter_file_paths():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            inode = (stat.st_dev, stat.st_ino)
+            links[inode] += 1
+            sizes[inode] = stat.st_size
+            files.append((path, stat))
+        return files, links, sum(sizes.values())
+
+    def evict(self):
+        first_run = self.counters["runs"] == 0
+        self.counters["runs"] += 1
+        if not first_run:
+            total = self.package_store.digests.total_size(distinct=self.package_store.blob_store is not None)
+            self.counters["size"] = total
+            if total <= self.max_bytes:
+                return 0, 0
+        # Files the index doesn't know about yet count too
+        files, links, total = self.scan()
+        self.counters["size"] = total
+        if total <= self.max_bytes:
+            return 0, 0
+        target = self.max_bytes * self.low_watermark
+        self.log.info("Store is {0} bytes, over its quota of {1}, evicting down to {2}".format(total, self.max_bytes, int(target)))
+        accesses = self.package_store.access_log.get_all()
+        evicted = freed = 0
+        candidates = [item for item in files if not accesses.get(os.path.relpath(item[0], self.package_store.prefix), (0, 0, False))[2]]
+        candidates.sort(key=self.sort_key(accesses))
+        packages_dir = os.path.join(self.package_store.prefix, "packages")
+        for path, stat in candidates:
+            if total - freed <= target:
+                break
+            parts = os.path.relpath(path, packages_dir).split(os.sep)
+            package, filename = parts[-2], parts[-1]
+            if not self.package_store.remove_file(package, filename):
+                continue
+            evicted += 1
+            inode = (stat.st_dev, stat.st_ino)
+            links[inode] -= 1
+            if links[inode] == 0:
+                freed += stat.st_size
+        self.counters["evicted_files"] += evicted
+        self.counters["evicted_bytes"] += freed
+        self.log.info("Evicted {0} files, freeing {1} bytes".format(evicted, freed))
+        return evicted, freed
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.log.exception("Eviction failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="evictor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.package_store.access_log.flush()
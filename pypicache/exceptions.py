@@ -19,3 +19,13 @@ class NotOverwritingError(PackageCacheError):
     """Raised when attempting to overwrite an existing file
 
     """
+
+class CorruptFileError(PackageCacheError):
+    """Raised when a file's content doesn't match its expected digests
+
+    """
+
+class InvalidUploadError(PackageCacheError):
+    """Raised when an upload is malformed or names a file which isn't a package
+
+    """
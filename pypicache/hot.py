@@ -0,0 +1,224 @@
+"""An in-memory tier for small, frequently downloaded files
+
+A handful of files (pip, setuptools, wheel, internal libraries) make up
+most downloads. Once a stored file has been read admit_hits times it is
+memory mapped and later requests are served from the mapping, skipping
+the open and read calls on the package store.
+
+Mappings are read only views of the files in the package store, so the
+memory behind them is the operating system's page cache, shared by
+every worker process serving the same files rather than copied into
+each one.
+
+"""
+
+import collections
+import logging
+import mmap
+import os
+import threading
+
+from pypicache import lru
+from pypicache import names
+from pypicache import store
+
+class HotEntry(object):
+    """A mapped file, closed once it is evicted and no longer being read
+
+    """
+    def __init__(self, fp, name=None):
+        self.fp = fp
+        self.name = name
+        stat = os.fstat(fp.fileno())
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mapping = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.lock = threading.Lock()
+        self.users = 0
+        self.evicted = False
+
+    def open(self):
+        with self.lock:
+            self.users += 1
+        return HotFile(self)
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            done = self.evicted and self.users == 0
+        if done:
+            self.close()
+
+    def evict(self):
+        with self.lock:
+            self.evicted = True
+            done = self.users == 0
+        if done:
+            self.close()
+
+    def close(self):
+        self.mapping.close()
+        self.fp.close()
+
+class HotFile(object):
+    """A read only file object over a mapped file
+
+    Supports what the servers need of a file: read, seek, tell, name
+    (for offloading to a front end server) and fileno (for fstat, and for
+    sendfile from the page cache).
+
+    """
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry.name
+        self.position = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        end = self.entry.size if size is None or size < 0 else min(self.position + size, self.entry.size)
+        data = self.entry.mapping[self.position:end]
+        self.position = max(self.position, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.entry.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.entry.fp.fileno()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.entry.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class HotFileCache(object):
+    """Keeps memory mappings of the most downloaded small files
+
+    :param max_bytes: Total size of the mapped files
+    :param max_entries: Maximum number of mapped files
+    :param max_file_size: Larger files are never mapped
+    :param admit_hits: Reads of a file before it is mapped, so one off
+        downloads don't push out popular files
+
+    """
+    def __init__(self, max_bytes, max_entries=1000, max_file_size=16 * 1024 * 1024, admit_hits=2):
+        self.log = logging.getLogger("pypicache.hot")
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+        self.admit_hits = admit_hits
+        self.lock = threading.Lock()
+        # key -> HotEntry, least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        # Read counts of files which aren't mapped yet
+        self.candidates = lru.LRUCache(max_entries=max_entries * 8)
+        self.counters = dict(hits=0, misses=0, admitted=0, evicted=0)
+
+    def get_key(self, package, filename):
+        return names.normalize(package), filename.lower()
+
+    def get(self, package, filename):
+        """Opens a mapped file
+
+        :returns: A HotFile, or None if the file isn't mapped
+
+        """
+        key = self.get_key(package, filename)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries[key] = entry
+            self.counters["hits"] += 1
+            return entry.open()
+
+    def offer(self, package, filename, fp):
+        """Counts a read of a stored file, mapping it once it is hot enough
+
+        :param fp: The open stored file, left open for the caller
+        :returns: A HotFile to read instead of fp, or None
+
+        """
+        if not hasattr(fp, "fileno") or store.is_snapshot(filename):
+            # Snapshots can be replaced by other processes behind our back
+            return None
+        key = self.get_key(package, filename)
+        hits = self.candidates.get(key, 0) + 1
+        if hits < self.admit_hits:
+            self.candidates.set(key, hits)
+            return None
+        self.candidates.delete(key)
+        try:
+            size = os.fstat(fp.fileno()).st_size
+        except (OSError, ValueError):
+            return None
+        if size == 0 or size > self.max_file_size or size > self.max_bytes:
+            return None
+        try:
+            entry = HotEntry(os.fdopen(os.dup(fp.fileno()), "rb"), name=getattr(fp, "name", None))
+        except (OSError, ValueError, EnvironmentError) as e:
+            self.log.warning("Can't map {0}: {1}: {2}".format(package, filename, e))
+            return None
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+                old.evict()
+            self.entries[key] = entry
+            self.size += entry.size
+            self.counters["admitted"] += 1
+            self.shrink()
+            return entry.open()
+
+    def shrink(self):
+        while self.entries and (self.size > self.max_bytes or len(self.entries) > self.max_entries):
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.counters["evicted"] += 1
+            entry.evict()
+
+    def invalidate(self, package, filename):
+        """Drops a file which has changed, suitable as a store listener
+
+        """
+        key = self.get_key(package, filename)
+        self.candidates.delete(key)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+                entry.evict()
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                entry.evict()
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self.entries), size=self.size, max_bytes=self.max_bytes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = float(stats["hits"]) / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,259 @@
+"""A preforking launcher for running the server in production
+
+The master process binds the listening socket and forks worker
+processes which each serve it with a fixed pool of threads. Workers
+share the socket and the package store on disk.
+
+- SIGTERM/SIGINT: stop accepting connections, let in flight requests
+  (e.g. large downloads) finish for up to graceful_timeout seconds,
+  then exit.
+- SIGHUP: start a fresh set of workers (re-running the app factory, so
+  configuration and in-memory state are rebuilt) and gracefully retire
+  the old ones, without ever closing the listening socket.
+
+"""
+
+import errno
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+# Forward compatible with python 3
+try:
+    import queue
+    queue  # shut pyflakes up
+except ImportError:
+    import Queue as queue
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+class PooledRequestHandler(WSGIRequestHandler):
+    # Don't let idle keep-alive connections hold a thread forever
+    timeout = 60
+
+    def make_environ(self):
+        environ = WSGIRequestHandler.make_environ(self)
+        if hasattr(self.connection, "sendfile"):
+            environ["pypicache.sendfile"] = self.sendfile
+        return environ
+
+    def sendfile(self, fp, offset, count):
+        """Sends part of a file straight to the client
+
+        Uses os.sendfile where possible, so the data is copied by the
+        kernel without passing through Python.
+
+        """
+        self.wfile.flush()
+        self.connection.sendfile(fp, offset, count)
+
+class PooledWSGIServer(BaseWSGIServer):
+    """A WSGI server handling requests on a fixed pool of threads
+
+    While every thread is busy the accept loop blocks, leaving new
+    connections in the listen backlog for other workers to pick up.
+
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, fd=None):
+        BaseWSGIServer.__init__(self, host, port, app, handler=PooledRequestHandler, fd=fd)
+        self.requests = queue.Queue(maxsize=threads)
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.work, name="worker-{0}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self, timeout):
+        """Waits for queued and in flight requests to finish
+
+        :returns: True if everything finished within timeout
+
+        """
+        for thread in self.threads:
+            self.requests.put(None)
+        deadline = time.time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.time()))
+        return not any(thread.is_alive() for thread in self.threads)
+
+def bind_socket(host, port, backlog=1024, reuse_port=False):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+class Launcher(object):
+    """Preforks workers serving a WSGI application
+
+    :param app_factory: Callable returning the WSGI app, called in each
+        worker after forking
+    :param workers: Number of worker processes
+    :param threads: Request threads per worker
+    :param graceful_timeout: Seconds to let in flight requests finish
+        when a worker is stopped
+    :param reuse_port: Give each worker its own SO_REUSEPORT socket so
+        the kernel balances connections, rather than sharing one socket
+
+    """
+    def __init__(self, app_factory, host="0.0.0.0", port=8080, workers=4, threads=8, graceful_timeout=30, reuse_port=False):
+        self.log = logging.getLogger("pypicache.launcher")
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.graceful_timeout = graceful_timeout
+        self.reuse_port = reuse_port
+        self.socket = None
+        # pid -> generation
+        self.children = {}
+        self.generation = 0
+        self.running = False
+        self.reload_requested = False
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return pid
+        # In the worker
+        status = 0
+        try:
+            self.run_worker()
+        except Exception:
+            self.log.exception("Worker failed")
+            status = 1
+        finally:
+            os._exit(status)
+
+    def run_worker(self):
+        # Reloads are the master's business
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        if self.reuse_port:
+            self.socket = bind_socket(self.host, self.port, reuse_port=True)
+        server = PooledWSGIServer(self.host, self.port, self.app_factory(), threads=self.threads, fd=self.socket.fileno())
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever() which is running in this thread
+            threading.Thread(target=server.shutdown).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        self.log.info("Worker {0} serving on {1}:{2}".format(os.getpid(), self.host, self.port))
+        server.serve_forever()
+        self.log.info("Worker {0} draining".format(os.getpid()))
+        if not server.drain(self.graceful_timeout):
+            self.log.warning("Worker {0} gave up waiting for requests to finish".format(os.getpid()))
+
+    def signal_workers(self, signum, generations=None):
+        for pid, generation in list(self.children.items()):
+            if generations is None or generation in generations:
+                try:
+                    os.kill(pid, signum)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+
+    def reap(self):
+        """Collects exited workers
+
+        :returns: list of (pid, generation) of exited workers
+
+        """
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            if pid in self.children:
+                exited.append((pid, self.children.pop(pid)))
+        return exited
+
+    def reload(self):
+        """Starts a new generation of workers and retires the old one
+
+        """
+        old = set(self.children.values())
+        self.generation += 1
+        self.log.info("Reloading, starting worker generation {0}".format(self.generation))
+        for i in range(self.workers):
+            self.spawn_worker()
+        self.signal_workers(signal.SIGTERM, old)
+
+    def stop(self):
+        self.log.info("Stopping {0} workers".format(len(self.children)))
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout + 5
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        if self.children:
+            self.log.warning("Killing {0} workers".format(len(self.children)))
+            self.signal_workers(signal.SIGKILL)
+            while self.children:
+                self.reap()
+                time.sleep(0.1)
+
+    def run(self):
+        """Binds the socket and supervises workers until told to stop
+
+        """
+        if not self.reuse_port:
+            # Otherwise each worker binds its own socket, the master
+            # mustn't hold one as it would never accept from it
+            self.socket = bind_socket(self.host, self.port)
+        self.running = True
+        def stop(signum, frame):
+            self.running = False
+        def reload(signum, frame):
+            self.reload_requested = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload)
+        self.log.info("Listening on {0}:{1} with {2} workers of {3} threads".format(self.host, self.port, self.workers, self.threads))
+        for i in range(self.workers):
+            self.spawn_worker()
+        try:
+            while self.running:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                for pid, generation in self.reap():
+                    if generation == self.generation and self.running:
+                        self.log.warning("Worker {0} died, restarting".format(pid))
+                        self.spawn_worker()
+                time.sleep(0.2)
+        finally:
+            self.stop()
+            if self.socket is not None:
+                self.socket.close()
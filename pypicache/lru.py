@@ -0,0 +1,60 @@
+"""A small thread safe LRU cache with optional expiry
+
+"""
+
+import collections
+import threading
+import time
+
+class LRUCache(object):
+    """Keeps up to max_entries items, discarding the least recently used
+
+    :param max_entries: Maximum number of items to hold
+    :param ttl: Seconds after which an item expires, None to never expire
+
+    """
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self.items[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store an item
+
+        :param ttl: Override the cache's ttl for this item
+
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (expires, value)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self.items)
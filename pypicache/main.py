@@ -1,40 +1,443 @@
 import argparse
+import json
 import logging
+import os
+import shlex
+import sys
 
+from pypicache import blobs
 from pypicache import cache
 from pypicache import disk
+from pypicache import eviction
+from pypicache import hot
+from pypicache import launcher
+from pypicache import metrics
+from pypicache import negative
+from pypicache import pages
 from pypicache import pypi
+from pypicache import requirements
+from pypicache import s3
+from pypicache import scrub
 from pypicache import server
+from pypicache import store
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="A PYPI cache",
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+def configure_logging(debug):
+    loglevel = logging.DEBUG if debug else logging.INFO
+
+    logging.basicConfig(
+        level=loglevel,
+        format="%(asctime)s [%(levelname)s] [%(processName)s-%(threadName)s] [%(name)s] [%(filename)s:%(lineno)d] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S%z"
     )
+
+def add_store_arguments(parser):
+    """Adds the options for the package store and upstream, shared by every command using them
+
+    """
     parser.add_argument("prefix", help="Package prefix, e.g. /tmp/packages")
-    parser.add_argument("--address", default="0.0.0.0", help="Address to bind to.")
-    parser.add_argument("--port", default=8080, type=int, help="Port to listen on.")
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
-    parser.add_argument("--reload", default=False, action="store_true", help="Turn on automatic reloading on code changes.")
-    parser.add_argument("--processes", default=1, type=int, help="Number of processes to run")
     parser.add_argument("--upstream", default="http://pypi.python.org/", help="Upstream package server to use")
-    args = parser.parse_args()
+    parser.add_argument("--blob-dir", default=None, help="Store package files as hard links to content addressed blobs in this folder, e.g. /tmp/packages/blobs. Can be shared by several prefixes on one filesystem.")
+    parser.add_argument("--s3-bucket", default=None, help="Keep package files in this S3 bucket, shared with other caches. The prefix becomes a local cache in front of it.")
+    parser.add_argument("--s3-prefix", default="", help="Key prefix for package files in the S3 bucket, e.g. pypicache/")
+    parser.add_argument("--s3-endpoint-url", default=None, help="Endpoint of an S3 compatible store other than AWS, e.g. http://localhost:9000")
+    parser.add_argument("--s3-part-size", default=8 * 1024 * 1024, type=eviction.parse_size, help="Upload files to S3 in parts of this size, e.g. 16M. The minimum is 5M.")
+    parser.add_argument("--pool-size", default=10, type=int, help="Upstream connections to keep open per host.")
+    parser.add_argument("--connect-timeout", default=5.0, type=float, help="Seconds to wait when connecting upstream.")
+    parser.add_argument("--read-timeout", default=30.0, type=float, help="Seconds to wait for data from upstream.")
+    parser.add_argument("--retries", default=3, type=int, help="Retries for upstream connection errors and 5xx responses.")
+    parser.add_argument("--retry-backoff", default=0.5, type=float, help="Exponential backoff factor between upstream retries.")
+    parser.add_argument("--simple-ttl", default=300, type=int, help="Seconds to cache upstream simple index pages before revalidating.")
+    parser.add_argument("--simple-cache-size", default=1000, type=int, help="Number of simple index pages to keep in memory.")
+    parser.add_argument("--metadata-ttl", default=300, type=int, help="Seconds to cache upstream project metadata (versions and files) for.")
+    parser.add_argument("--metadata-cache-size", default=1000, type=int, help="Number of projects to keep upstream metadata for in memory.")
+    parser.add_argument("--warmup-python-tags", default="py2,py3", help="Comma separated wheel python tags to cache from a requirements.txt or sync, * for any.")
+    parser.add_argument("--warmup-abis", default="none", help="Comma separated wheel ABI tags to cache from a requirements.txt or sync, * for any.")
+    parser.add_argument("--warmup-platforms", default="any", help="Comma separated wheel platform tags (e.g. manylinux*) to cache from a requirements.txt or sync, * for any.")
+    parser.add_argument("--warmup-no-sdist", default=False, action="store_true", help="Don't cache sdists from a requirements.txt or sync.")
 
-    loglevel = logging.DEBUG if args.debug else logging.INFO
+def add_cache_arguments(parser):
+    """Adds the options for configuring the package cache a server runs
 
-    logging.basicConfig(
-        level=loglevel,
-        format="%(asctime)s [%(levelname)s] [%(processName)s-%(threadName)s] [%(name)s] [%(filename)s:%(lineno)d] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S%z"
+    """
+    add_store_arguments(parser)
+    parser.add_argument("--address", default="0.0.0.0", help="Address to bind to.")
+    parser.add_argument("--port", default=8080, type=int, help="Port to listen on.")
+    parser.add_argument("--max-size", default=None, type=eviction.parse_size, help="Evict package files once the cache grows past this size, e.g. 50G. Uploaded packages are never evicted.")
+    parser.add_argument("--eviction-policy", default="lru", choices=eviction.POLICIES, help="Evict the least recently (lru) or least frequently (lfu) used files first.")
+    parser.add_argument("--eviction-interval", default=60, type=int, help="Seconds between checking the cache size and saving access counts.")
+    parser.add_argument("--offload", default=None, choices=sorted(server.FileOffload.HEADERS), help="Let a front end web server send stored files, with X-Sendfile (Apache, lighttpd) or X-Accel-Redirect (nginx).")
+    parser.add_argument("--offload-uri-prefix", default="/_pypicache/", help="Internal nginx location serving the package prefix, for --offload x-accel-redirect.")
+    parser.add_argument("--scrub-rate", default=None, type=eviction.parse_size, help="Reread stored files in the background at up to this many bytes per second, e.g. 10M, quarantining any which no longer match their digests.")
+    parser.add_argument("--scrub-interval", default=86400, type=int, help="Seconds between background passes over the stored files.")
+    parser.add_argument("--hot-size", default=None, type=eviction.parse_size, help="Serve frequently downloaded small files from memory mappings of up to this total size, e.g. 512M.")
+    parser.add_argument("--hot-entries", default=1000, type=int, help="Maximum number of files to serve from memory.")
+    parser.add_argument("--hot-max-file-size", default=16 * 1024 * 1024, type=eviction.parse_size, help="Larger files are never served from memory.")
+    parser.add_argument("--hot-admit-hits", default=2, type=int, help="Downloads of a file before it is served from memory.")
+    parser.add_argument("--negative-ttl", default=60, type=int, help="Seconds to remember packages and files which weren't found, locally or upstream. 0 turns this off.")
+    parser.add_argument("--negative-cache-size", default=10000, type=int, help="Number of misses to remember.")
+    parser.add_argument("--warmup-workers", default=8, type=int, help="Concurrent downloads when caching a requirements.txt.")
+    parser.add_argument("--warmup-per-host", default=4, type=int, help="Concurrent downloads per upstream host when caching a requirements.txt.")
+
+def make_blob_store(blob_dir):
+    if blob_dir is None:
+        return None
+    return blobs.BlobStore(blob_dir)
+
+def make_artifact_filter(args):
+    return requirements.ArtifactFilter(
+        python_tags=requirements.parse_patterns(args.warmup_python_tags),
+        abis=requirements.parse_patterns(args.warmup_abis),
+        platforms=requirements.parse_patterns(args.warmup_platforms),
+        sdist=not args.warmup_no_sdist,
+    )
+
+def make_upstream(args):
+    """Builds the upstream PyPI client from parsed options
+
+    """
+    pool = pypi.HTTPPool(
+        pool_size=args.pool_size,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        retries=args.retries,
+        backoff=args.retry_backoff,
+    )
+    return pypi.PyPI(
+        pypi_server=args.upstream,
+        pool=pool,
+        metadata_ttl=args.metadata_ttl,
+        metadata_cache_size=args.metadata_cache_size,
+    )
+
+def make_store(args, access_log=None):
+    """Builds the package store from parsed options
+
+    :returns: (local disk store, store to use), the same unless S3 is used
+
+    """
+    local_store = package_store = disk.DiskPackageStore(args.prefix, blob_store=make_blob_store(args.blob_dir), access_log=access_log)
+    if args.s3_bucket is not None:
+        package_store = store.CachingPackageStore(
+            s3.S3PackageStore(
+                args.s3_bucket,
+                prefix=args.s3_prefix,
+                endpoint_url=args.s3_endpoint_url,
+                part_size=args.s3_part_size,
+            ),
+            local_store,
+        )
+    return local_store, package_store
+
+def make_page_cache(args, pypi_server):
+    return pages.PageCache(
+        pypi_server,
+        os.path.join(args.prefix, "simple-cache"),
+        ttl=args.simple_ttl,
+        max_entries=args.simple_cache_size,
+    )
+
+def make_cache(args):
+    """Builds the package cache a server runs from parsed options
+
+    Starts the background eviction and scrubbing threads if enabled.
+
+    :returns: (pypi, package_store, package_cache)
+
+    """
+    pypi_server = make_upstream(args)
+    access_log = None
+    if args.max_size is not None:
+        access_log = eviction.AccessLog(os.path.join(args.prefix, "access.sqlite"))
+    local_store, package_store = make_store(args, access_log=access_log)
+    evictor = None
+    if args.max_size is not None:
+        evictor = eviction.Evictor(local_store, args.max_size, policy=args.eviction_policy, interval=args.eviction_interval)
+        evictor.start()
+    scrubber = None
+    if args.scrub_rate is not None:
+        scrubber = scrub.Scrubber(local_store, rate=args.scrub_rate, interval=args.scrub_interval)
+        scrubber.start()
+    hot_files = None
+    if args.hot_size is not None:
+        hot_files = hot.HotFileCache(
+            args.hot_size,
+            max_entries=args.hot_entries,
+            max_file_size=args.hot_max_file_size,
+            admit_hits=args.hot_admit_hits,
+        )
+    negative_cache = None
+    if args.negative_ttl > 0:
+        negative_cache = negative.NegativeCache(ttl=args.negative_ttl, max_entries=args.negative_cache_size)
+    package_cache = cache.PackageCache(
+        package_store,
+        pypi_server,
+        page_cache=make_page_cache(args, pypi_server),
+        warmup_workers=args.warmup_workers,
+        warmup_per_host=args.warmup_per_host,
+        artifact_filter=make_artifact_filter(args),
+        evictor=evictor,
+        scrubber=scrubber,
+        hot_files=hot_files,
+        negative_cache=negative_cache,
     )
+    return pypi_server, package_store, package_cache
+
+def make_offload(args):
+    if args.offload is None:
+        return None
+    return server.FileOffload(args.offload, args.prefix, uri_prefix=args.offload_uri_prefix)
+
+def serve(argv):
+    parser = argparse.ArgumentParser(
+        description="A PYPI cache",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog="Other commands: {0}".format(", ".join(sorted(COMMANDS))),
+    )
+    add_cache_arguments(parser)
+    parser.add_argument("--reload", default=False, action="store_true", help="Turn on automatic reloading on code changes.")
+    parser.add_argument("--processes", default=1, type=int, help="Number of processes to run")
+    parser.add_argument("--server", default="flask", choices=["flask", "asgi"], help="Serve with the Flask development server or the asyncio (ASGI) app, which needs uvicorn.")
+    parser.add_argument("--asgi-threads", default=32, type=int, help="Threads for blocking work in the ASGI server.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
     logging.info("Debugging: {0!r}".format(args.debug))
     logging.info("Reloading: {0!r}".format(args.reload))
 
-    pypi_server = pypi.PyPI(pypi_server=args.upstream)
-    package_store = disk.DiskPackageStore(args.prefix)
-    package_cache = cache.PackageCache(package_store, pypi_server)
-    app = server.configure_app(pypi_server, package_store, package_cache, debug=args.debug)
+    pypi_server, package_store, package_cache = make_cache(args)
+    if args.server == "asgi":
+        try:
+            import uvicorn
+        except ImportError:
+            parser.error("--server asgi needs uvicorn installed")
+        from pypicache import asgi
+        app = asgi.AsyncApp(pypi_server, package_store, package_cache, workers=args.asgi_threads, offload=make_offload(args))
+        uvicorn.run(app, host=args.address, port=args.port, log_level="debug" if args.debug else "info")
+        return
+    app = server.configure_app(pypi_server, package_store, package_cache, debug=args.debug, offload=make_offload(args))
     app.run(host=args.address, port=args.port, debug=args.debug, use_reloader=args.reload, processes=args.processes)
 
+def prefork(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main prefork",
+        description="Run the cache with preforked worker processes. SIGTERM drains in flight requests before exiting, SIGHUP replaces the workers without dropping connections.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_cache_arguments(parser)
+    parser.add_argument("--workers", default=4, type=int, help="Number of worker processes.")
+    parser.add_argument("--threads", default=8, type=int, help="Request threads per worker.")
+    parser.add_argument("--graceful-timeout", default=30, type=int, help="Seconds to let in flight requests finish when stopping a worker.")
+    parser.add_argument("--reuse-port", default=False, action="store_true", help="Give each worker its own SO_REUSEPORT socket.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+    # Each worker writes its metrics here for /metrics to merge
+    metrics.REGISTRY.share(os.path.join(args.prefix, "metrics"), clear=True)
+
+    def app_factory():
+        metrics.REGISTRY.start_flushing()
+        pypi_server, package_store, package_cache = make_cache(args)
+        return server.configure_app(pypi_server, package_store, package_cache, debug=args.debug, offload=make_offload(args))
+
+    launcher.Launcher(
+        app_factory,
+        host=args.address,
+        port=args.port,
+        workers=args.workers,
+        threads=args.threads,
+        graceful_timeout=args.graceful_timeout,
+        reuse_port=args.reuse_port,
+    ).run()
+
+def rebuild_index(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main rebuild-index",
+        description="Rebuild the digest index by rehashing every stored package file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("prefix", help="Package prefix, e.g. /tmp/packages")
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+    package_store = disk.DiskPackageStore(args.prefix)
+    count = package_store.rebuild_index()
+    logging.info("Rebuilt digest index for {0} files in {1}".format(count, args.prefix))
+
+def scrub_store(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main scrub",
+        description="Reread every stored package file and quarantine those which no longer match their recorded digests",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("prefix", help="Package prefix, e.g. /tmp/packages")
+    parser.add_argument("--blob-dir", default=None, help="Blob folder, if the prefix uses one")
+    parser.add_argument("--rate", default=None, type=eviction.parse_size, help="Bytes per second to read at most, e.g. 50M.")
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+    package_store = disk.DiskPackageStore(args.prefix, blob_store=make_blob_store(args.blob_dir))
+    quarantined = scrub.Scrubber(package_store, rate=args.rate).run_once()
+    logging.info("Quarantined {0} corrupt files in {1}".format(len(quarantined), args.prefix))
+    if quarantined:
+        sys.exit(1)
+
+def migrate_blobs(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main migrate-blobs",
+        description="Convert existing package folders to content addressed storage in place, sharing one blob for identical files",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("prefix", nargs="+", help="Package prefixes, e.g. /tmp/packages")
+    parser.add_argument("--blob-dir", required=True, help="Blob folder, on the same filesystem as the prefixes")
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+    blob_store = make_blob_store(args.blob_dir)
+    for prefix in args.prefix:
+        package_store = disk.DiskPackageStore(prefix, blob_store=blob_store)
+        count, freed = package_store.migrate_to_blobs()
+        logging.info("Migrated {0} files in {1}, freeing {2} bytes".format(count, prefix, freed))
+
+def gc_blobs(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main gc-blobs",
+        description="Remove blobs which no package file uses any more (e.g. replaced -dev snapshots)",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("blob_dir", help="Blob folder")
+    parser.add_argument("--grace", default=3600, type=int, help="Leave blobs written in the last this many seconds alone.")
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+    removed, freed = make_blob_store(args.blob_dir).gc(grace=args.grace)
+    logging.info("Removed {0} unused blobs, freeing {1} bytes".format(removed, freed))
+
+def bench(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main bench",
+        description="Benchmark the cache against a local fake PyPI",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--packages", default=50, type=int, help="Packages for the cold, warm and warmup scenarios.")
+    parser.add_argument("--size", default="64k", type=eviction.parse_size, help="Size of their files.")
+    parser.add_argument("--large-files", default=4, type=int, help="Files downloaded concurrently in the large scenario.")
+    parser.add_argument("--large-size", default="64M", type=eviction.parse_size, help="Size of the large files.")
+    parser.add_argument("--concurrency", default=16, type=int, help="Concurrent clients.")
+    parser.add_argument("--rounds", default=3, type=int, help="Times the warm scenario downloads every package.")
+    parser.add_argument("--latency", default=0.02, type=float, help="Seconds the fake PyPI waits before answering.")
+    parser.add_argument("--bandwidth", default=None, type=eviction.parse_size, help="Bytes per second the fake PyPI sends each file at, e.g. 10M.")
+    parser.add_argument("--workers", default=2, type=int, help="Worker processes for the cache.")
+    parser.add_argument("--threads", default=16, type=int, help="Request threads per worker.")
+    parser.add_argument("--port", default=18080, type=int, help="Port to run the cache on.")
+    parser.add_argument("--cache-args", default="", help="Extra options for the cache, e.g. \"--hot-size 256M\".")
+    parser.add_argument("--output", default=None, help="Save the results as JSON to this file.")
+    parser.add_argument("--compare", default=None, help="Show changes from results saved by an earlier run.")
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging logging and output.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+
+    from pypicache import bench as benchmarks
+    results = benchmarks.Bench(
+        packages=args.packages,
+        size=args.size,
+        large_files=args.large_files,
+        large_size=args.large_size,
+        concurrency=args.concurrency,
+        rounds=args.rounds,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        workers=args.workers,
+        threads=args.threads,
+        port=args.port,
+        proxy_args=shlex.split(args.cache_args),
+    ).run()
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    print(benchmarks.format_results(results, baseline))
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+def sync(argv):
+    parser = argparse.ArgumentParser(
+        prog="pypicache.main sync",
+        description="Mirror packages into the cache ahead of time, fetching only the files it doesn't have. Run it again with the same packages to resume an interrupted sync.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    add_store_arguments(parser)
+    parser.add_argument("packages", nargs="*", help="Requirement specifiers, e.g. \"django>=4.2,<5\". A bare name mirrors every release.")
+    parser.add_argument("-r", "--requirement", action="append", default=[], help="Mirror the packages in a requirements.txt, Pipfile.lock or poetry.lock. Can be given more than once.")
+    parser.add_argument("--lock-dir", action="append", default=[], help="Mirror the packages in every lock file (*.txt, Pipfile.lock, poetry.lock) under a folder.")
+    parser.add_argument("--latest", default=None, type=int, help="Only mirror this many of the newest matching releases of each package.")
+    parser.add_argument("--pre", default=False, action="store_true", help="Include pre-releases not named exactly.")
+    parser.add_argument("--workers", default=16, type=int, help="Concurrent downloads.")
+    parser.add_argument("--per-host", default=8, type=int, help="Concurrent downloads per upstream host.")
+    parser.add_argument("--checkpoint", default=None, help="File recording the sync's progress. Defaults to sync-checkpoint.jsonl in the prefix.")
+    parser.add_argument("--replan", default=False, action="store_true", help="Look the packages up again rather than resuming the checkpoint's plan.")
+    args = parser.parse_args(argv)
+
+    configure_logging(args.debug)
+
+    from pypicache import sync as mirror
+    specs = []
+    for text in args.packages:
+        spec = mirror.parse_spec(text)
+        if spec is None:
+            parser.error("Can't parse requirement {0!r}".format(text))
+        specs.append(spec)
+    lock_files = list(args.requirement)
+    for path in args.lock_dir:
+        lock_files.extend(mirror.find_lock_files(path))
+    unparseable = []
+    for path in lock_files:
+        found, skipped = mirror.read_lock_file(path)
+        specs.extend(found)
+        unparseable.extend(skipped)
+    if not specs:
+        parser.error("Nothing to sync, give packages, --requirement or --lock-dir")
+
+    # A one off batch job, so no background eviction or scrubbing
+    pypi_server = make_upstream(args)
+    package_store = make_store(args)[1]
+    package_cache = cache.PackageCache(package_store, pypi_server, page_cache=make_page_cache(args, pypi_server))
+    planner = mirror.Planner(
+        pypi_server,
+        artifact_filter=make_artifact_filter(args),
+        latest=args.latest,
+        prereleases=args.pre,
+        workers=args.workers,
+    )
+    checkpoint = mirror.Checkpoint(args.checkpoint or os.path.join(args.prefix, "sync-checkpoint.jsonl"))
+    report = mirror.Sync(package_cache, workers=args.workers, per_host=args.per_host, checkpoint=checkpoint).run(planner, specs, resume=not args.replan)
+    report["unparseable"] = unparseable
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if report["failed"] or report["unresolved"]:
+        sys.exit(1)
+
+COMMANDS = {
+    "bench": bench,
+    "gc-blobs": gc_blobs,
+    "migrate-blobs": migrate_blobs,
+    "prefork": prefork,
+    "rebuild-index": rebuild_index,
+    "scrub": scrub_store,
+    "sync": sync,
+}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    return serve(argv)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,364 @@
+"""Minimal Prometheus metrics
+
+Counters, gauges and histograms, with optional labels, rendered in the
+Prometheus text format by /metrics. Updating a metric takes a lock and
+a dict lookup, so instrumenting hot paths is cheap.
+
+Each process keeps its own metrics. Preforked workers share them by
+writing snapshots to a folder (see Registry.share), which the process
+answering /metrics merges: counters and histograms are summed over
+every worker that has run, gauges over the workers still alive.
+
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+INF = float("inf")
+
+# Seconds, from fast cache hits to slow upstream downloads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_value(value):
+    if value == INF:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('{0}="{1}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+class Child(object):
+    """A metric with its label values filled in
+
+    """
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric.update(self.key, amount)
+
+    def dec(self, amount=1):
+        self.metric.update(self.key, -amount)
+
+    def set(self, value):
+        self.metric.set_value(self.key, value)
+
+    def observe(self, value):
+        self.metric.observe_value(self.key, value)
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # label values -> value
+        self.values = {}
+        self.children = {}
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError("{0} needs labels {1}".format(self.name, self.labelnames))
+            child = self.children.setdefault(key, Child(self, key))
+        return child
+
+    def update(self, key, amount):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def inc(self, amount=1):
+        self.update((), amount)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def samples(self, values):
+        for key, value in values:
+            yield self.name, self.labelnames, key, value
+
+class Counter(Metric):
+    type = "counter"
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def dec(self, amount=1):
+        self.update((), -amount)
+
+    def set(self, value):
+        self.set_value((), value)
+
+    def set_value(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets)) + (INF,)
+        Metric.__init__(self, name, help, labelnames, registry)
+
+    def observe(self, value):
+        self.observe_value((), value)
+
+    def observe_value(self, key, value):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), [list(entry[0]), entry[1], entry[2]]] for key, entry in self.values.items()]
+
+    def time(self, *labels):
+        """Times a block of code, e.g. ``with HISTOGRAM.time("label"):``
+
+        """
+        return Timer(self.labels(*labels) if labels else self)
+
+    def samples(self, values):
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield self.name + "_bucket", names, tuple(key) + (format_value(bound),), cumulative
+            yield self.name + "_sum", self.labelnames, key, total
+            yield self.name + "_count", self.labelnames, key, count
+
+class Timer(object):
+    def __init__(self, target):
+        self.target = target
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.target.observe(time.time() - self.started)
+
+def merge(metric, snapshots):
+    """Sums the values of a metric from several processes
+
+    """
+    merged = {}
+    for values in snapshots:
+        for key, value in values:
+            key = tuple(key)
+            if metric.type == "histogram":
+                entry = merged.setdefault(key, [[0] * len(metric.buckets), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], value[0])]
+                entry[1] += value[1]
+                entry[2] += value[2]
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return sorted(merged.items())
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+class Registry(object):
+    """Holds the metrics of a process
+
+    """
+    def __init__(self):
+        self.log = logging.getLogger("pypicache.metrics")
+        self.lock = threading.Lock()
+        self.metrics = {}
+        # name -> callable returning [(name, type, help, [(labels dict, value)])]
+        self.collectors = {}
+        self.shared_dir = None
+        self.flusher = None
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+
+    def set_collector(self, name, collector):
+        """Adds (or replaces) a callable reporting metrics worked out at scrape time
+
+        """
+        with self.lock:
+            self.collectors[name] = collector
+
+    def share(self, path, clear=False):
+        """Shares metrics with other processes through snapshots in a folder
+
+        :param clear: Throw away snapshots left by earlier runs
+
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if clear:
+            for filename in os.listdir(path):
+                if filename.endswith(".json"):
+                    os.remove(os.path.join(path, filename))
+        self.shared_dir = path
+
+    def start_flushing(self, interval=5):
+        """Writes this process's snapshot every interval seconds
+
+        """
+        if self.shared_dir is None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except Exception:
+                    self.log.exception("Failed to write metrics")
+        self.flusher = threading.Thread(target=run, name="metrics")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def snapshot(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+    def flush(self):
+        """Writes this process's snapshot to the shared folder
+
+        """
+        output = tempfile.NamedTemporaryFile("w", dir=self.shared_dir, prefix=".metrics-", delete=False)
+        try:
+            with output:
+                json.dump(self.snapshot(), output)
+            os.rename(output.name, os.path.join(self.shared_dir, "{0}.json".format(os.getpid())))
+        except BaseException:
+            if os.path.exists(output.name):
+                os.remove(output.name)
+            raise
+
+    def load_snapshots(self):
+        """Returns [(alive, snapshot)] for every process sharing metrics
+
+        """
+        self.flush()
+        snapshots = []
+        for filename in os.listdir(self.shared_dir):
+            if not filename.endswith(".json") or filename.startswith("."):
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, filename)) as fp:
+                    snapshot = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            snapshots.append((pid_alive(int(filename[:-len(".json")])), snapshot))
+        return snapshots
+
+    def render(self):
+        """Renders every metric in the Prometheus text format
+
+        """
+        if self.shared_dir is None:
+            snapshots = [(True, self.snapshot())]
+        else:
+            snapshots = self.load_snapshots()
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+            collectors = list(self.collectors.values())
+        lines = []
+        for metric in metrics:
+            values = merge(metric, [
+                snapshot.get(metric.name, [])
+                for alive, snapshot in snapshots
+                if alive or metric.type != "gauge"
+            ])
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+            for name, labelnames, key, value in metric.samples(values):
+                lines.append("{0}{1} {2}".format(name, format_labels(labelnames, key), format_value(value)))
+        for collector in collectors:
+            try:
+                collected = collector()
+            except Exception:
+                self.log.exception("Failed to collect metrics")
+                continue
+            for name, type, help, samples in collected:
+                lines.append("# HELP {0} {1}".format(name, help))
+                lines.append("# TYPE {0} {1}".format(name, type))
+                for labels, value in samples:
+                    names = sorted(labels)
+                    lines.append("{0}{1} {2}".format(name, format_labels(names, [labels[key] for key in names]), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class CountedChunks(object):
+    """Passes through chunks of data, counting their bytes
+
+    Closing it closes the chunks. While it is being read an optional
+    gauge counts it as in progress.
+
+    """
+    def __init__(self, chunks, counter, in_progress=None):
+        self.chunks = iter(chunks)
+        self.counter = counter
+        self.in_progress = in_progress
+        self.started = False
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.started:
+            self.started = True
+            if self.in_progress is not None:
+                self.in_progress.inc()
+        try:
+            chunk = next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+        self.counter.inc(len(chunk))
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.started and self.in_progress is not None:
+            self.in_progress.dec()
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
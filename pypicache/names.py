@@ -0,0 +1,196 @@
+"""In memory index of the packages in a store
+
+Keeps PEP 503 normalized package names and case folded filenames so
+lookups for a differently spelt package or file don't need to scan the
+packages directory.
+
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+def normalize(name):
+    """Normalize a package name as per PEP 503
+
+    """
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+class PackageIndex(object):
+    """Maps normalized package and file names to what is stored on disk
+
+    Expects packages to be laid out as <root>/<firstletter>/<package>/<filename>.
+
+    The index is built on first use, updated directly by add() and
+    picks up changes made by other processes by polling directory
+    mtimes: letter directories at most every refresh_interval seconds,
+    package directories whenever their files are looked up.
+
+    """
+    def __init__(self, root, refresh_interval=5.0):
+        self.log = logging.getLogger("pypicache.names")
+        self.root = root
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        # normalized name -> package name on disk
+        self.packages = {}
+        # sorted package names on disk
+        self.names = []
+        # sorted normalized names
+        self.normalized = []
+        # letter directory -> (mtime, package names on disk)
+        self.letters = {}
+        # package name on disk -> (mtime, {case folded filename: filename})
+        self.files = {}
+        # bumped whenever the list of packages changes
+        self.generation = 0
+        # (generation, digest of the package names)
+        self.digest = (None, None)
+        self.last_refresh = None
+
+    def refresh(self, force=False):
+        """Rescan letter directories which have changed since the last scan
+
+        """
+        with self.lock:
+            now = time.time()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+            try:
+                letters = os.listdir(self.root)
+            except OSError:
+                letters = []
+            changed = False
+            for letter in set(self.letters) - set(letters):
+                del self.letters[letter]
+                changed = True
+            for letter in letters:
+                path = os.path.join(self.root, letter)
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    continue
+                if letter in self.letters and self.letters[letter][0] == mtime:
+                    continue
+                self.log.debug("Scanning {0}".format(path))
+                names = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+                self.letters[letter] = (mtime, names)
+                changed = True
+            if changed:
+                self.rebuild()
+
+    def rebuild(self):
+        self.generation += 1
+        names = set()
+        for mtime, letter_names in self.letters.values():
+            names.update(letter_names)
+        self.names = sorted(names)
+        self.packages = {}
+        for name in self.names:
+            self.packages.setdefault(normalize(name), name)
+        self.normalized = sorted(self.packages)
+        for name in set(self.files) - names:
+            del self.files[name]
+
+    def add(self, package, filename):
+        """Record a file written to the store
+
+        """
+        with self.lock:
+            self.refresh()
+            position = bisect.bisect_left(self.names, package)
+            if position == len(self.names) or self.names[position] != package:
+                self.names.insert(position, package)
+                if normalize(package) not in self.packages:
+                    self.packages[normalize(package)] = package
+                    bisect.insort(self.normalized, normalize(package))
+                self.generation += 1
+            if package in self.files:
+                self.files[package][1][filename.lower()] = filename
+
+    def list_packages(self):
+        """Returns a sorted list of package names
+
+        """
+        with self.lock:
+            self.refresh()
+            return list(self.names)
+
+    def query(self, prefix="", offset=0, limit=None):
+        """Returns a slice of the packages in normalized name order
+
+        Only the matching names are touched, so paging through a large
+        index is cheap.
+
+        :param prefix: Only packages whose normalized name starts with this
+        :param limit: Maximum number of packages, None for all
+        :returns: list of package names on disk
+
+        """
+        with self.lock:
+            self.refresh()
+            start, end = 0, len(self.normalized)
+            prefix = normalize(prefix)
+            if prefix:
+                start = bisect.bisect_left(self.normalized, prefix)
+                end = bisect.bisect_left(self.normalized, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+            start = min(start + offset, end)
+            if limit is not None:
+                end = min(start + limit, end)
+            return [self.packages[name] for name in self.normalized[start:end]]
+
+    def fingerprint(self):
+        """Returns a digest of the package names, for use as an ETag
+
+        Unlike the generation it's the same in every process looking at
+        the same packages. It's only recalculated when packages change.
+
+        """
+        with self.lock:
+            self.refresh()
+            generation, digest = self.digest
+            if generation != self.generation:
+                digest = hashlib.sha1("\n".join(self.names).encode("utf-8")).hexdigest()
+                self.digest = (self.generation, digest)
+            return digest
+
+    def find_package(self, package):
+        """Returns the name on disk of a package, or None
+
+        """
+        with self.lock:
+            self.refresh()
+            return self.packages.get(normalize(package))
+
+    def list_filenames(self, package):
+        """Returns a map of case folded filenames to filenames on disk
+
+        """
+        with self.lock:
+            path = os.path.join(self.root, package[0], package)
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                return {}
+            if package not in self.files or self.files[package][0] != mtime:
+                self.files[package] = (mtime, dict((filename.lower(), filename) for filename in os.listdir(path)))
+            return self.files[package][1]
+
+    def find_file(self, package, filename):
+        """Finds a stored file, ignoring differences in spelling
+
+        :returns: (package, filename) as stored on disk, or None
+
+        """
+        my_package = self.find_package(package)
+        if my_package is None:
+            return None
+        my_filename = self.list_filenames(my_package).get(filename.lower())
+        if my_filename is None:
+            return None
+        return my_package, my_filename
@@ -0,0 +1,95 @@
+"""Remembers lookups which found nothing
+
+Typos, private package names and dependency confusion probes are
+requested over and over, each time scanning the store for other
+spellings and asking upstream only to get a 404. A NegativeCache
+answers those repeats from memory for a short while.
+
+Entries for a package are dropped as soon as a file is stored for it in
+this process. Other processes sharing the store don't tell us, so their
+new files are only seen once the entries expire, hence the short ttl.
+
+"""
+
+import collections
+import threading
+import time
+
+from pypicache import names
+
+class NegativeCache(object):
+    """A bounded cache of misses
+
+    :param ttl: Seconds to remember a miss for
+    :param max_entries: Maximum number of misses to remember
+
+    """
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (expires, message), oldest first
+        self.items = collections.OrderedDict()
+        # normalized package -> keys
+        self.packages = {}
+        self.counters = dict(hits=0, misses=0, added=0, invalidated=0)
+
+    def get_key(self, kind, package, detail=""):
+        return kind, names.normalize(package), detail.lower()
+
+    def get(self, kind, package, detail=""):
+        """Returns the message of a remembered miss, None if there isn't one
+
+        :param kind: What was looked up, e.g. "file" or "page"
+
+        """
+        key = self.get_key(kind, package, detail)
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and entry[0] < time.time():
+                self.remove(key)
+                entry = None
+            self.counters["misses" if entry is None else "hits"] += 1
+            return None if entry is None else entry[1]
+
+    def add(self, kind, package, detail="", message=""):
+        """Remembers a miss
+
+        """
+        key = self.get_key(kind, package, detail)
+        with self.lock:
+            self.remove(key)
+            self.items[key] = (time.time() + self.ttl, message)
+            self.packages.setdefault(key[1], set()).add(key)
+            self.counters["added"] += 1
+            while len(self.items) > self.max_entries:
+                self.remove(next(iter(self.items)))
+
+    def remove(self, key):
+        if self.items.pop(key, None) is None:
+            return
+        keys = self.packages[key[1]]
+        keys.discard(key)
+        if not keys:
+            del self.packages[key[1]]
+
+    def invalidate(self, package, filename=None):
+        """Forgets the misses of a package, suitable as a store listener
+
+        """
+        with self.lock:
+            keys = self.packages.get(names.normalize(package), ())
+            self.counters["invalidated"] += len(keys)
+            for key in list(keys):
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.packages.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.items)
+        return stats
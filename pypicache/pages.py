@@ -0,0 +1,121 @@
+"""Caches upstream simple index pages
+
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import lru
+from pypicache import metrics
+from pypicache import names
+
+PAGE_REQUESTS = metrics.Counter("pypicache_simple_pages_total", "Upstream simple page lookups by result", ["result"])
+
+class PageCache(object):
+    """Caches simple index pages fetched from PyPI
+
+    Pages are stored on disk under prefix with an in-memory LRU in front.
+    Pages younger than ttl seconds are served without contacting PyPI,
+    older pages are revalidated with a conditional request (using the
+    ETag and Last-Modified headers PyPI sent). If PyPI can't be reached
+    a stale page is served rather than failing.
+
+    """
+    def __init__(self, pypi, prefix, ttl=300, max_entries=1000):
+        self.log = logging.getLogger("pypicache.pages")
+        self.pypi = pypi
+        self.prefix = prefix
+        self.ttl = ttl
+        self.memory = lru.LRUCache(max_entries=max_entries)
+        self.lock = threading.Lock()
+        self.counters = dict(hits=0, misses=0, revalidated=0, stale=0, errors=0)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+        PAGE_REQUESTS.labels(counter).inc()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["entries"] = len(self.memory)
+        return stats
+
+    def get_path(self, package, version):
+        return os.path.join(self.prefix, names.normalize(package), "{0}.json".format(version or "_index"))
+
+    def load(self, package, version):
+        try:
+            with open(self.get_path(package, version)) as fp:
+                page = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        page["content"] = page["content"].encode("latin-1")
+        return page
+
+    def save(self, package, version, page):
+        path = self.get_path(package, version)
+        prefix = os.path.dirname(path)
+        disk.makedirs(prefix)
+        # latin-1 round trips arbitrary bytes through JSON
+        data = dict(page, content=page["content"].decode("latin-1"))
+        with tempfile.NamedTemporaryFile("w", dir=prefix, delete=False) as fp:
+            json.dump(data, fp)
+        os.rename(fp.name, path)
+
+    def get(self, package, version=''):
+        """Returns the simple index page for a package
+
+        :raises NotFound: If PyPI doesn't know the package
+        :raises RemoteError: If PyPI fails and there's no cached copy
+
+        """
+        key = (names.normalize(package), version)
+        page = self.memory.get(key)
+        if page is None:
+            page = self.load(package, version)
+        now = time.time()
+        if page is not None and now - page["fetched"] < self.ttl:
+            self.count("hits")
+            self.memory.set(key, page)
+            return page["content"]
+        try:
+            if page is None:
+                response = self.pypi.get_simple_package_page(package, version)
+            else:
+                response = self.pypi.get_simple_package_page(
+                    package,
+                    version,
+                    etag=page["etag"],
+                    last_modified=page["last_modified"],
+                )
+        except exceptions.NotFound:
+            self.memory.delete(key)
+            raise
+        except exceptions.RemoteError as e:
+            self.count("errors")
+            if page is None:
+                raise
+            self.log.warning("Serving stale page for {0} {1}: {2}".format(package, version, e))
+            self.count("stale")
+            return page["content"]
+        if response.status_code == 304:
+            self.count("revalidated")
+            page = dict(page, fetched=now)
+        else:
+            self.count("misses")
+            page = dict(
+                content=response.content,
+                etag=response.headers.get("ETag"),
+                last_modified=response.headers.get("Last-Modified"),
+                fetched=now,
+            )
+        self.memory.set(key, page)
+        self.save(package, version, page)
+        return page["content"]
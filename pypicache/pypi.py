@@ -2,57 +2,288 @@
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import threading
+import time
 
-# Forward compatible with python 3
-try:
-    import xmlrpc.client as xmlrpclib
-    xmlrpclib  # shut pyflakes up
-except ImportError:
-    import xmlrpclib
-
+from packaging.version import InvalidVersion, Version
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from pypicache import exceptions
+from pypicache import lru
+from pypicache import metrics
+from pypicache import names
+from pypicache import store
+
+UPSTREAM_SECONDS = metrics.Histogram("pypicache_upstream_request_seconds", "Time until upstream responded, by status", ["status"])
+UPSTREAM_ERRORS = metrics.Counter("pypicache_upstream_errors_total", "Failed upstream requests", ["reason"])
+
+CHUNK_SIZE = 64 * 1024
 
-def get_uri(uri):
+RETRY_STATUSES = (500, 502, 503, 504)
+
+def get_uri(uri, stream=False, headers=None, session=None, timeout=None):
     """Request the given URI and return the response
 
     Checks for 200 response and raises appropriate exceptions otherwise.
+    A 304 response is also returned, for conditional requests.
+
+    :param stream: Don't read the response body up front, use
+        response.iter_content() to read it.
+    :param headers: Extra request headers
+    :param session: requests.Session to use, defaults to a fresh connection
+    :param timeout: Timeout in seconds, or a (connect, read) tuple
 
     """
-    response = requests.get(uri)
+    if session is None:
+        session = requests
+    started = time.time()
+    try:
+        response = session.get(uri, stream=stream, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        UPSTREAM_ERRORS.labels(type(e).__name__).inc()
+        raise exceptions.RemoteError("Error requesting {0}: {1}".format(uri, e))
+    UPSTREAM_SECONDS.labels(response.status_code).observe(time.time() - started)
+    if response.status_code not in (200, 304):
+        response.close()
     if response.status_code == 404:
         raise exceptions.NotFound("Can't locate {0}: {1}".format(uri, response))
-    elif response.status_code != 200:
+    elif response.status_code not in (200, 304):
+        UPSTREAM_ERRORS.labels("status").inc()
         raise exceptions.RemoteError("Unexpected response from {0}: {1}".format(uri, response))
     return response
 
+def iter_response(response):
+    """Yields the body of a streamed response
+
+    The response is closed once the body has been read or the generator
+    is closed, so abandoned downloads give their connection back
+    straight away rather than whenever they are garbage collected.
+
+    :raises RemoteError: If the connection fails part way through
+
+    """
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            yield chunk
+    except requests.RequestException as e:
+        UPSTREAM_ERRORS.labels(type(e).__name__).inc()
+        raise exceptions.RemoteError("Error reading {0}: {1}".format(response.url, e))
+    finally:
+        response.close()
+
+def make_retry(retries, backoff):
+    """Retry connection errors and 5xx responses with exponential backoff
+
+    """
+    kwargs = dict(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    methods = frozenset(["GET", "HEAD"])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+class HTTPPool(object):
+    """A shared pool of keep-alive connections to upstream servers
+
+    requests.Session isn't guaranteed to be thread safe so each thread
+    gets its own session, but they all share one HTTPAdapter whose
+    connection pools are.
+
+    :param pool_size: Maximum connections kept per host
+    :param connect_timeout: Seconds to wait for a connection
+    :param read_timeout: Seconds to wait between bytes of a response
+    :param retries: Number of retries for connection errors and 5xx responses
+    :param backoff: Backoff factor, retries sleep backoff * 2 ** (retry - 1) seconds
+
+    """
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=30.0, retries=3, backoff=0.5):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=make_retry(retries, backoff),
+        )
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self.adapter)
+            session.mount("https://", self.adapter)
+            self.local.session = session
+        return session
+
+    def get_uri(self, uri, stream=False, headers=None):
+        return get_uri(uri, stream=stream, headers=headers, session=self.session, timeout=self.timeout)
+
+    def stats(self):
+        """Returns connection statistics for each upstream host
+
+        """
+        stats = []
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                continue
+            stats.append(dict(
+                host="{0}://{1}:{2}".format(pool.scheme, pool.host, pool.port),
+                connections=pool.num_connections,
+                requests=pool.num_requests,
+                idle=pool.pool.qsize() if pool.pool is not None else 0,
+                maxsize=pool.pool.maxsize if pool.pool is not None else 0,
+            ))
+        return stats
+
+def version_key(version):
+    try:
+        return (1, Version(version))
+    except InvalidVersion:
+        return (0, version)
+
+class ProjectMetadata(object):
+    """Fetches and caches the JSON metadata of whole projects
+
+    One request for /pypi/<project>/json answers every question about a
+    project's versions and files, rather than a request per version.
+    Projects are cached for ttl seconds, concurrent lookups of the same
+    project share one request and get_many looks projects up in parallel.
+
+    :param workers: Concurrent requests made by get_many
+
+    """
+    def __init__(self, pypi_server, pool, ttl=300, max_entries=1000, workers=8):
+        self.log = logging.getLogger("pypicache.pypi")
+        self.pypi_server = pypi_server
+        self.pool = pool
+        self.ttl = ttl
+        self.workers = workers
+        self.projects = lru.LRUCache(max_entries=max_entries, ttl=ttl)
+        self.locks = store.KeyedLocks()
+        self.lock = threading.Lock()
+        self.counters = dict(hits=0, misses=0)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats["entries"] = len(self.projects)
+        return stats
+
+    def fetch(self, project):
+        uri = "{0}pypi/{1}/json".format(self.pypi_server, project)
+        self.log.info("Fetching JSON info from {0}".format(uri))
+        data = json.loads(self.pool.get_uri(uri).content)
+        # Only keep what's used, project pages can be large
+        return dict(
+            name=data.get("info", {}).get("name", project),
+            releases=data.get("releases", {}),
+        )
+
+    def get(self, project, refresh=False):
+        """Returns a project's name and releases (version to url dicts)
+
+        :param refresh: Fetch it again even if it is cached, e.g. when
+            looking for a version which may be newer than the cached copy
+        :raises NotFound: If upstream doesn't know the project
+
+        """
+        key = names.normalize(project)
+        if not refresh:
+            data = self.projects.get(key)
+            if data is not None:
+                self.count("hits")
+                return data
+        with self.locks.lock(key):
+            data = None if refresh else self.projects.get(key)
+            if data is None:
+                self.count("misses")
+                data = self.fetch(project)
+                self.projects.set(key, data)
+            else:
+                # Fetched by another thread while we waited
+                self.count("hits")
+            return data
+
+    def get_many(self, projects, workers=None):
+        """Looks up several projects in parallel
+
+        :param workers: Concurrent requests, defaults to the workers given
+            to the constructor
+        :returns: dict of project to its data, or the PackageCacheError
+            looking it up raised
+
+        """
+        projects = list(set(projects))
+        def get(project):
+            try:
+                return self.get(project)
+            except exceptions.PackageCacheError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or self.workers, len(projects)))) as executor:
+            return dict(zip(projects, executor.map(get, projects)))
+
+    def clear(self):
+        self.projects.clear()
+
 class PyPI(object):
     """Handles requests to the real PyPI servers
 
+    :param metadata_ttl: Seconds to cache project metadata for
+    :param metadata_cache_size: Number of projects to keep metadata for
+
     """
-    def __init__(self, pypi_server="http://pypi.python.org/"):
+    def __init__(self, pypi_server="http://pypi.python.org/", pool=None, metadata_ttl=300, metadata_cache_size=1000):
         self.log = logging.getLogger("pypi")
         if not pypi_server.endswith("/"):
             pypi_server = pypi_server + "/"
         self.pypi_server = pypi_server
-        # Certain operations aren't available via the JSON api (well, at least obviously)
-        self.xmlrpc_client = xmlrpclib.ServerProxy("{0}pypi".format(self.pypi_server))
+        if pool is None:
+            pool = HTTPPool()
+        self.pool = pool
+        self.metadata = ProjectMetadata(pypi_server, pool, ttl=metadata_ttl, max_entries=metadata_cache_size)
+
+    def stats(self):
+        """Returns upstream connection pool and metadata cache statistics
+
+        """
+        return dict(pool=self.pool.stats(), metadata=self.metadata.stats())
 
-    def get_versions(self, package, show_hidden=False):
-        """Returns a list of available versions for a package
+    def get_versions(self, package, include_yanked=False):
+        """Returns a list of available versions for a package, newest first
 
-        This calls the PyPI XML-RPC API. See
-        http://wiki.python.org/moin/PyPiXmlRpc
+        Read from the project's JSON metadata (see ProjectMetadata).
 
         :param package: Name of the package
-        :param show_hidden: Show versions marked as hidden, can be very slow.
+        :param include_yanked: Include versions whose files have all been
+            yanked (PEP 592). The JSON API has no hidden releases, which
+            the old XML-RPC show_hidden argument was about.
         :returns: A list of version strings
 
         """
-        versions = self.xmlrpc_client.package_releases(package, show_hidden)
+        releases = self.metadata.get(package)["releases"]
+        versions = [
+            version for version, urls in releases.items()
+            if include_yanked or not urls or not all(url.get("yanked") for url in urls)
+        ]
+        versions.sort(key=version_key, reverse=True)
         self.log.debug("Got versions {0} for package {1!r}".format(versions, package))
         return versions
 
@@ -60,52 +291,82 @@ class PyPI(object):
         """Get a list of URLS for the given package
 
         This takes the url info returned from the PyPI JSON API and only
-        returns urls dicts.
+        returns urls dicts. The project's metadata is fetched again if
+        the version isn't in the cached copy, in case it is new.
 
         See http://wiki.python.org/moin/PyPiJson
 
+        :raises NotFound: If upstream doesn't know the package or version
+
         """
-        uri = "{server}pypi/{package}/{version}/json".format(
-            server=self.pypi_server,
-            package=package,
-            version=version,
+        releases = self.metadata.get(package)["releases"]
+        if version not in releases:
+            releases = self.metadata.get(package, refresh=True)["releases"]
+        if version not in releases:
+            raise exceptions.NotFound("Can't locate {0} version {1}".format(package, version))
+        return list(releases[version])
+
+    def get_releases(self, package):
+        """Returns the files of every release of a package
+
+        :returns: dict of version to a list of url dicts, as get_urls returns
+
+        """
+        return self.metadata.get(package)["releases"]
+
+    def get_many_releases(self, packages, workers=None):
+        """Looks up the releases of several packages in parallel
+
+        :returns: dict of package to its releases, or the PackageCacheError
+            looking it up raised
+
+        """
+        found = self.metadata.get_many(packages, workers=workers)
+        return dict(
+            (package, data if isinstance(data, exceptions.PackageCacheError) else data["releases"])
+            for package, data in found.items()
         )
-        self.log.info("Fetching JSON info from {0}".format(uri))
-        r = get_uri(uri)
-        for url in json.loads(r.content)["urls"]:
-            yield url
 
-    def get_simple_package_info(self, package, version=''):
+    def get_simple_package_uri(self, package, version=''):
         if "simple." in self.pypi_server:
             simple = ""
         else:
             simple = "simple/"
-        uri = "{0}{1}{2}/{3}".format(self.pypi_server, simple, package, version)
-        r = get_uri(uri)
-        return r.content
-        # TODO WIP in progress, trying to reproduce a simple page with links only
-        # Better still to rewrite using local urls
-        # self.log.info("Checking PyPI for links to {0}".format(package))
-        # links = []
-        # for version in self.pypi_get_versions(package):
-        #     self.log.debug("Found package {0} version {1}".format(package, version))
-        #     for url in self.pypi_get_sdist_urls(package, version):
-        #         self.log.debug("Found link {0!r}".format(url))
-        #         links.append("""<a href="{url}#md5={md5_digest}">{filename}</a>""".format(**url))
-
-        # self.log.debug("Found links {0}".format(links))
-        # return SIMPLE_PACKAGE_PAGE_TEMPLATE.format(package=package, links="\n".join(links))
-
-    def get_file(self, package, filename, python_version=None):
+        return "{0}{1}{2}/{3}".format(self.pypi_server, simple, package, version)
+
+    def get_simple_package_page(self, package, version='', etag=None, last_modified=None):
+        """Fetch a simple index page, conditionally if etag or last_modified are given
+
+        :returns: The response, with a status_code of 304 if the page is unchanged
+
         """
+        uri = self.get_simple_package_uri(package, version)
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if last_modified is not None:
+            headers["If-Modified-Since"] = last_modified
+        return self.pool.get_uri(uri, headers=headers)
+
+    def get_simple_package_info(self, package, version=''):
+        r = self.get_simple_package_page(package, version)
+        return r.content
+
+    def get_file(self, package, filename, python_version=None, url=None):
+        """Fetches a package file from PyPI
 
-        :returns: package data
+        The response is streamed, so large files are never held in memory.
+
+        :param url: Location of the file if known (e.g. from get_urls),
+            otherwise it's worked out from the package and python_version.
+        :returns: iterable of package data chunks
 
         """
-        if python_version is not None:
+        if url is not None:
+            uri = url
+        elif python_version is not None:
             uri = "{0}packages/{1}/{2}/{3}/{4}".format(self.pypi_server, python_version, package[0], package, filename)
         else:
             uri = "{0}packages/source/{1}/{2}/{3}".format(self.pypi_server, package[0], package, filename)
         self.log.debug("Fetching from {0}".format(uri))
-        r = get_uri(uri)
-        return r.content
+        return iter_response(self.pool.get_uri(uri, stream=True))
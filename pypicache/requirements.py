@@ -0,0 +1,183 @@
+"""Parses requirements files and selects which artifacts to cache
+
+"""
+
+import collections
+import fnmatch
+import logging
+import re
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.utils import InvalidWheelFilename, parse_wheel_filename
+
+log = logging.getLogger("pypicache.requirements")
+
+ParsedRequirement = collections.namedtuple("ParsedRequirement", [
+    "line",
+    "name",
+    "version",
+    "extras",
+    "marker",
+    "hashes",
+])
+
+INCLUDE_OPTIONS = ("-r", "--requirement", "-c", "--constraint")
+
+HASH_OPTION = re.compile(r"--hash[=\s]\s*(\S+)")
+
+def iter_logical_lines(lines):
+    """Joins continuation lines and strips comments and blank lines
+
+    """
+    buffered = ""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = re.sub(r"(^|\s)#.*$", "", line.rstrip("\r\n"))
+        if line.endswith("\\"):
+            buffered += line[:-1] + " "
+            continue
+        line = (buffered + line).strip()
+        buffered = ""
+        if line:
+            yield line
+    if buffered.strip():
+        yield buffered.strip()
+
+def include_name(line):
+    """Returns the file named by a -r or -c line, None for other lines
+
+    """
+    for option in INCLUDE_OPTIONS:
+        for separator in ("=", " ", "\t"):
+            if line.startswith(option + separator):
+                return line[len(option) + 1:].strip()
+    return None
+
+def parse_requirement(line):
+    """Parses a single pinned requirement line
+
+    Understands extras, environment markers and --hash options. Only
+    definitive versions (a single == or ===) are returned.
+
+    :returns: ParsedRequirement, or None if the line isn't a pinned requirement
+
+    """
+    hashes = HASH_OPTION.findall(line)
+    rest = HASH_OPTION.sub("", line).strip()
+    if rest.startswith("-"):
+        # -e, -i and friends
+        return None
+    try:
+        requirement = Requirement(rest)
+    except InvalidRequirement:
+        return None
+    specifiers = list(requirement.specifier)
+    if len(specifiers) != 1 or specifiers[0].operator not in ("==", "===") or "*" in specifiers[0].version:
+        return None
+    return ParsedRequirement(
+        line=line,
+        name=requirement.name,
+        version=specifiers[0].version,
+        extras=sorted(requirement.extras),
+        marker=str(requirement.marker) if requirement.marker else None,
+        hashes=hashes,
+    )
+
+def parse_requirements(lines, include=None, seen=None):
+    """Parses the lines of a requirements file
+
+    Environment markers are kept but not evaluated: a cache is filling
+    up for its clients' environments, not its own.
+
+    :param include: Callable taking the name of a -r/-c include and
+        returning its lines, or None if it can't be found.
+    :returns: generator of (line, ParsedRequirement or None)
+
+    """
+    if seen is None:
+        seen = set()
+    for line in iter_logical_lines(lines):
+        name = include_name(line)
+        if name is None:
+            yield line, parse_requirement(line)
+            continue
+        if name in seen:
+            continue
+        included = include(name) if include is not None else None
+        if included is None:
+            log.debug("Can't include {0!r}".format(name))
+            yield line, None
+            continue
+        seen.add(name)
+        for result in parse_requirements(included, include=include, seen=seen):
+            yield result
+
+def parse_patterns(value):
+    """Turns a comma separated option into a list of patterns, None for any
+
+    """
+    if value is None:
+        return None
+    patterns = [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+    if "*" in patterns:
+        return None
+    return patterns
+
+def matches(value, patterns):
+    if patterns is None:
+        return True
+    return any(fnmatch.fnmatch(value, pattern) for pattern in patterns)
+
+class ArtifactFilter(object):
+    """Decides which of a release's files to cache
+
+    Wheels are matched on their compatibility tags, each of python_tags,
+    abis and platforms is a list of fnmatch patterns (e.g. "manylinux*")
+    or None to accept anything.
+
+    :param sdist: Cache source distributions
+
+    """
+    def __init__(self, python_tags=("py2", "py3"), abis=("none",), platforms=("any",), sdist=True):
+        self.python_tags = python_tags
+        self.abis = abis
+        self.platforms = platforms
+        self.sdist = sdist
+
+    def wheel_matches(self, filename):
+        try:
+            name, version, build, tags = parse_wheel_filename(filename)
+        except InvalidWheelFilename:
+            log.debug("Can't parse wheel filename {0!r}".format(filename))
+            return False
+        for tag in tags:
+            if matches(tag.interpreter, self.python_tags) and matches(tag.abi, self.abis) and matches(tag.platform, self.platforms):
+                return True
+        return False
+
+    def select(self, urls, hashes=None):
+        """Picks the urls worth caching
+
+        :param urls: url dicts from the PyPI JSON API
+        :param hashes: "algorithm:digest" strings from --hash options,
+            if given only matching files are selected
+        :returns: list of url dicts
+
+        """
+        selected = []
+        for url in urls:
+            if url["packagetype"] == "sdist":
+                if not self.sdist:
+                    continue
+            elif url["packagetype"] == "bdist_wheel":
+                if not self.wheel_matches(url["filename"]):
+                    continue
+            else:
+                continue
+            if hashes:
+                digests = url.get("digests", {})
+                if not any(digests.get(algorithm) == digest for algorithm, _, digest in (h.partition(":") for h in hashes)):
+                    continue
+            selected.append(url)
+        return selected
@@ -0,0 +1,339 @@
+"""Stores packages in an S3 compatible object store
+
+Objects are laid out like disk.DiskPackageStore's files, as
+<prefix>packages/<firstletter>/<package>/<filename>, with their md5 and
+sha256 digests in the object metadata. Several cache nodes can share a
+bucket, usually each with a store.CachingPackageStore in front of it.
+
+Large files are sent as multipart uploads so they can be streamed
+through without holding them in memory. An upload only becomes visible
+once it is completed, so abandoned writes leave nothing behind.
+
+Needs boto3, or any client with the same interface.
+
+"""
+
+import calendar
+import hashlib
+import logging
+import tempfile
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from pypicache import digests
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import lru
+from pypicache import names
+from pypicache import store
+
+# S3 won't take multipart upload parts smaller than this, except the last
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+NOT_FOUND = ("404", "NoSuchKey", "NotFound")
+
+def error_code(e):
+    """Returns the S3 error code of a botocore ClientError, or None
+
+    """
+    response = getattr(e, "response", None) or {}
+    return response.get("Error", {}).get("Code")
+
+class S3PackageStore(store.PackageStore):
+    """Keeps package files in an S3 bucket
+
+    Locks are only held within this process, S3 has no locking. Nodes
+    racing to store the same file both upload it and the last one wins,
+    which is harmless for identical files.
+
+    :param bucket: Bucket name
+    :param prefix: Key prefix, e.g. "pypicache/"
+    :param client: An S3 client, by default one is made with boto3
+    :param endpoint_url: For S3 compatible stores other than AWS
+    :param part_size: Size of multipart upload parts, files smaller than
+        this are uploaded in one request
+    :param list_ttl: Seconds to cache bucket listings for
+    :param digest_cache_size: Number of files to remember the digests of,
+        so listing a package doesn't need a request per file
+
+    """
+    def __init__(self, bucket, prefix="", client=None, endpoint_url=None, part_size=8 * 1024 * 1024, list_ttl=30, digest_cache_size=100000):
+        store.PackageStore.__init__(self)
+        self.log = logging.getLogger("pypicache.s3")
+        if client is None:
+            if boto3 is None:
+                raise ImportError("boto3 is needed to store packages in S3")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.listings = lru.LRUCache(max_entries=10000, ttl=list_ttl)
+        # (key, ETag) -> digests, an object's ETag changes with its content
+        self.digests = lru.LRUCache(max_entries=digest_cache_size)
+        self.locks = store.KeyedLocks()
+
+    def get_key(self, package, filename):
+        return "{0}packages/{1}/{2}/{3}".format(self.prefix, package[0], package, filename)
+
+    def list_prefixes(self, prefix):
+        """Returns the sorted names directly under a key prefix
+
+        :returns: list of (name, is a "directory", ETag or None)
+
+        """
+        found = self.listings.get(prefix)
+        if found is not None:
+            return found
+        found = []
+        kwargs = dict(Bucket=self.bucket, Prefix=prefix, Delimiter="/")
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for common in response.get("CommonPrefixes", []):
+                found.append((common["Prefix"][len(prefix):].rstrip("/"), True, None))
+            for item in response.get("Contents", []):
+                found.append((item["Key"][len(prefix):], False, item.get("ETag")))
+            if not response.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+        found.sort()
+        self.listings.set(prefix, found)
+        return found
+
+    def forget_listings(self, package):
+        self.listings.delete("{0}packages/".format(self.prefix))
+        self.listings.delete("{0}packages/{1}/".format(self.prefix, package[0]))
+        self.listings.delete("{0}packages/{1}/{2}/".format(self.prefix, package[0], package))
+
+    def list_packages(self, prefix="", offset=0, limit=None):
+        packages = []
+        for letter, is_dir, etag in self.list_prefixes("{0}packages/".format(self.prefix)):
+            if is_dir:
+                packages.extend(name for name, is_dir, etag in self.list_prefixes("{0}packages/{1}/".format(self.prefix, letter)) if is_dir)
+        packages.sort()
+        if not prefix and not offset and limit is None:
+            return packages
+        prefix = names.normalize(prefix)
+        matching = sorted((names.normalize(package), package) for package in packages)
+        matching = [package for normalized, package in matching if normalized.startswith(prefix)]
+        end = None if limit is None else offset + limit
+        return matching[offset:end]
+
+    def packages_etag(self):
+        return hashlib.sha1("\n".join(self.list_packages()).encode("utf-8")).hexdigest()
+
+    def find_package(self, package):
+        normalized = names.normalize(package)
+        for letter in set([package[0], package[0].lower(), package[0].upper()]):
+            for name, is_dir, etag in self.list_prefixes("{0}packages/{1}/".format(self.prefix, letter)):
+                if is_dir and names.normalize(name) == normalized:
+                    return name
+        return None
+
+    def list_filenames(self, package):
+        prefix = "{0}packages/{1}/{2}/".format(self.prefix, package[0], package)
+        return [name for name, is_dir, etag in self.list_prefixes(prefix) if not is_dir]
+
+    def find_file(self, package, filename):
+        """Finds a stored file, ignoring differences in spelling
+
+        :returns: (package, filename) as stored, or None
+
+        """
+        my_package = self.find_package(package)
+        if my_package is None:
+            return None
+        for my_filename in self.list_filenames(my_package):
+            if my_filename.lower() == filename.lower():
+                return my_package, my_filename
+        return None
+
+    def head(self, package, filename):
+        """Returns the head_object response for a file, matching names loosely
+
+        :raises NotFound: If the file isn't stored
+
+        """
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(package, filename))
+        except Exception as e:
+            if error_code(e) not in NOT_FOUND:
+                raise
+        found = self.find_file(package, filename)
+        if found is None or found == (package, filename):
+            raise exceptions.NotFound("Package {0}: {1} not found in s3://{2}".format(package, filename, self.bucket))
+        return self.head(*found)
+
+    def stat(self, package, filename):
+        response = self.head(package, filename)
+        metadata = response.get("Metadata", {})
+        return dict(
+            size=response["ContentLength"],
+            mtime=calendar.timegm(response["LastModified"].utctimetuple()),
+            md5=metadata.get("md5"),
+            sha256=metadata.get("sha256"),
+        )
+
+    def get_file(self, package, filename):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.get_key(package, filename))
+        except Exception as e:
+            if error_code(e) not in NOT_FOUND:
+                raise
+            found = self.find_file(package, filename)
+            if found is None or found == (package, filename):
+                raise exceptions.NotFound("Package {0}: {1} not found in s3://{2}".format(package, filename, self.bucket))
+            self.log.info("Found package file {0} matching {1}: {2}".format(found, package, filename))
+            return self.get_file(*found)
+        return self.iter_body(response["Body"])
+
+    def iter_body(self, body):
+        try:
+            for chunk in iter(lambda: body.read(disk.CHUNK_SIZE), b""):
+                yield chunk
+        finally:
+            body.close()
+
+    def list_files(self, package):
+        """Describes the stored files of a package
+
+        Digests are only looked up (one HEAD request each) for files
+        which are new or have changed since they were last looked up.
+
+        """
+        my_package = self.find_package(package)
+        if my_package is None:
+            return
+        prefix = "{0}packages/{1}/{2}/".format(self.prefix, my_package[0], my_package)
+        for filename, is_dir, etag in self.list_prefixes(prefix):
+            if is_dir:
+                continue
+            info = dict(package=my_package, firstletter=my_package[0], filename=filename)
+            file_digests = None if etag is None else self.digests.get((prefix + filename, etag))
+            if file_digests is None:
+                try:
+                    response = self.head(my_package, filename)
+                except exceptions.NotFound:
+                    continue
+                metadata = response.get("Metadata", {})
+                file_digests = dict(md5=metadata.get("md5"), sha256=metadata.get("sha256"))
+                if response.get("ETag"):
+                    self.digests.set((prefix + filename, response["ETag"]), file_digests)
+            info.update(file_digests)
+            yield info
+
+    def check_overwrite(self, package, filename):
+        """Raises NotOverwritingError if the file can't be replaced
+
+        Only development snapshots can be overwritten.
+
+        """
+        if store.is_snapshot(filename):
+            return
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.get_key(package, filename))
+        except Exception as e:
+            if error_code(e) not in NOT_FOUND:
+                raise
+            return
+        raise exceptions.NotOverwritingError("Not overwriting s3://{0}/{1}".format(self.bucket, self.get_key(package, filename)))
+
+    def tee_file(self, package, filename, content, expected=None):
+        """Writes a file to the bucket, yielding the data as it is written
+
+        Files up to part_size are sent with a single put_object. Larger
+        ones go up as a multipart upload, which is aborted if the
+        iteration is abandoned. Objects carry their digests from the
+        moment they appear, so when the expected md5 and sha256 aren't
+        both given the parts are spooled to a temporary file and only
+        uploaded once the digests are known. Content not matching the
+        expected digests is never published.
+
+        """
+        self.check_overwrite(package, filename)
+        key = self.get_key(package, filename)
+        metadata = None
+        if expected and all(expected.get(algorithm) for algorithm in digests.ALGORITHMS):
+            metadata = dict((algorithm, expected[algorithm]) for algorithm in digests.ALGORITHMS)
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        buffered = []
+        size = 0
+        spool = None
+        upload_id = None
+        parts = []
+        try:
+            for chunk in disk.iter_chunks(content):
+                md5.update(chunk)
+                sha256.update(chunk)
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= self.part_size:
+                    if metadata is None:
+                        if spool is None:
+                            spool = tempfile.TemporaryFile()
+                        spool.write(b"".join(buffered))
+                    else:
+                        if upload_id is None:
+                            upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=metadata)["UploadId"]
+                        parts.append(self.upload_part(key, upload_id, len(parts) + 1, b"".join(buffered)))
+                    buffered = []
+                    size = 0
+                yield chunk
+            actual = dict(md5=md5.hexdigest(), sha256=sha256.hexdigest())
+            digests.verify(expected, actual, filename)
+            if spool is not None:
+                spool.write(b"".join(buffered))
+                upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=actual)["UploadId"]
+                spool.seek(0)
+                for data in iter(lambda: spool.read(self.part_size), b""):
+                    parts.append(self.upload_part(key, upload_id, len(parts) + 1, data))
+            elif upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=b"".join(buffered), Metadata=actual)
+            elif buffered:
+                parts.append(self.upload_part(key, upload_id, len(parts) + 1, b"".join(buffered)))
+            if upload_id is not None:
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    MultipartUpload=dict(Parts=parts),
+                )
+                upload_id = None
+        except BaseException:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        finally:
+            if spool is not None:
+                spool.close()
+        self.forget_listings(package)
+        self.notify(package, filename)
+
+    def upload_part(self, key, upload_id, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        return dict(ETag=response["ETag"], PartNumber=number)
+
+    def remove_file(self, package, filename):
+        lock = self.lock(package, filename)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=self.get_key(package, filename))
+            except Exception as e:
+                if error_code(e) not in NOT_FOUND:
+                    raise
+                return False
+            self.client.delete_object(Bucket=self.bucket, Key=self.get_key(package, filename))
+        finally:
+            lock.release()
+        self.forget_listings(package)
+        self.notify(package, filename)
+        return True
+
+    def lock(self, package, filename):
+        return self.locks.lock((names.normalize(package), filename.lower()))
@@ -0,0 +1,148 @@
+"""Finds stored package files which have rotted on disk
+
+Digests are recorded when a file is written (see digests.DigestIndex).
+A Scrubber thread slowly rereads every stored file, at a limited rate so
+serving isn't starved of disk bandwidth, and compares it with what was
+recorded. Corrupt files are moved to <prefix>/quarantine, so the next
+request downloads a fresh copy from upstream.
+
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from pypicache import digests
+from pypicache import disk
+from pypicache import exceptions
+
+class Scrubber(object):
+    """Checks the files of a package store against their recorded digests
+
+    :param package_store: DiskPackageStore to check
+    :param rate: Bytes per second to read at most, None for no limit
+    :param interval: Seconds between passes over the store
+
+    """
+    def __init__(self, package_store, rate=None, interval=86400):
+        self.log = logging.getLogger("pypicache.scrub")
+        self.package_store = package_store
+        self.rate = rate
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.counters = dict(passes=0, files=0, bytes=0, corrupt=0)
+
+    def stats(self):
+        return dict(self.counters, rate=self.rate, interval=self.interval)
+
+    def run_once(self):
+        """Checks every stored file once
+
+        Only one process sharing a store scrubs at a time.
+
+        :returns: list of (package, filename) quarantined
+
+        """
+        lock = disk.FileLock(os.path.join(self.package_store.prefix, "locks", "scrubber.lock"))
+        if not lock.acquire(blocking=False):
+            return []
+        try:
+            return self.scrub()
+        finally:
+            lock.release()
+
+    def scrub(self):
+        quarantined = []
+        packages_dir = os.path.join(self.package_store.prefix, "packages")
+        for path in self.package_store.iter_file_paths():
+            if self.stopped.is_set():
+                break
+            parts = os.path.relpath(path, packages_dir).split(os.sep)
+            package, filename = parts[-2], parts[-1]
+            # Skip files being written, they're checked as they're written
+            lock = self.package_store.lock(package, filename)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                reason = self.check_file(path)
+            except (IOError, OSError) as e:
+                self.log.warning("Can't check {0}: {1}".format(path, e))
+                continue
+            finally:
+                lock.release()
+            if reason is not None and self.package_store.quarantine_file(package, filename, reason):
+                self.counters["corrupt"] += 1
+                quarantined.append((package, filename))
+        self.counters["passes"] += 1
+        self.log.info("Scrubbed the store, {0} corrupt files found".format(len(quarantined)))
+        return quarantined
+
+    def check_file(self, path):
+        """Rereads a file and compares it with its recorded digests
+
+        Files without a record, or changed since it was made, are just
+        hashed and recorded.
+
+        :returns: None, or why the file is corrupt
+
+        """
+        key = os.path.relpath(path, self.package_store.prefix)
+        recorded = self.package_store.digests.lookup(key)
+        stat = os.stat(path)
+        if recorded is not None and recorded["mtime"] == stat.st_mtime and recorded["size"] != stat.st_size:
+            return "size is {0}, recorded {1}".format(stat.st_size, recorded["size"])
+        actual = self.hash_file(path)
+        if actual is None:
+            return None
+        self.counters["files"] += 1
+        if recorded is None or recorded["mtime"] != stat.st_mtime:
+            self.package_store.digests.update(key, path, actual)
+            return None
+        try:
+            digests.verify(dict(md5=recorded["md5"], sha256=recorded["sha256"]), actual, key)
+        except exceptions.CorruptFileError as e:
+            return str(e)
+        return None
+
+    def hash_file(self, path):
+        """Hashes a file no faster than the rate limit
+
+        :returns: dict with md5 and sha256 hex digests, None if stopped
+
+        """
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        started = time.time()
+        size = 0
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(digests.CHUNK_SIZE), b""):
+                md5.update(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+                self.counters["bytes"] += len(chunk)
+                if self.rate:
+                    # Sleep off any time we're ahead of the rate limit
+                    ahead = size / float(self.rate) - (time.time() - started)
+                    if ahead > 0 and self.stopped.wait(ahead):
+                        return None
+        return dict(md5=md5.hexdigest(), sha256=sha256.hexdigest())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                self.log.exception("Scrubbing failed")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="scrubber")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
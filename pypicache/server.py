@@ -1,82 +1,319 @@
+import hashlib
 import logging
 import mimetypes
-import re
+import os
+import time
+
+# Forward compatible with python 3
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 from flask import (
     abort,
     Flask,
+    g,
     jsonify,
     make_response,
     render_template,
     request,
+    Response,
+    stream_with_context,
 )
+from werkzeug.wsgi import wrap_file
 
 from pypicache import exceptions
+from pypicache import metrics
+from pypicache import simple
+from pypicache import uploads
 
 app = Flask("pypicache")
 
-def configure_app(pypi, package_store, package_cache, debug=False, testing=False):
+REQUEST_SECONDS = metrics.Histogram("pypicache_http_request_seconds", "Time until a response starts, by route", ["route", "method", "status"])
+BYTES_SERVED = metrics.Counter("pypicache_served_bytes_total", "Bytes of package files sent to clients")
+
+def configure_app(pypi, package_store, package_cache, debug=False, testing=False, offload=None):
+    """Sets up the app
+
+    :param offload: A FileOffload to let a front end web server send stored files
+
+    """
     app.debug = debug
     app.testing = testing
     app.config["pypi"] = pypi
     app.config["package_store"] = package_store
     app.config["cache"] = package_cache
+    app.config["offload"] = offload
     return app
 
+class FileOffload(object):
+    """Hands sending stored files over to a front end web server
+
+    Rather than the file's data the response carries a header naming the
+    file, which the front end serves itself (handling Range and
+    conditional requests too). For nginx, root must be served by an
+    internal location, e.g.::
+
+        location /_pypicache/ {
+            internal;
+            alias /tmp/mypackages/;
+        }
+
+    :param header: "x-sendfile" (Apache, lighttpd) or "x-accel-redirect" (nginx)
+    :param root: Folder the stored files live in
+    :param uri_prefix: nginx location root is served under, for X-Accel-Redirect
+
+    """
+    HEADERS = {"x-sendfile": "X-Sendfile", "x-accel-redirect": "X-Accel-Redirect"}
+
+    def __init__(self, header, root, uri_prefix="/_pypicache/"):
+        if header not in self.HEADERS:
+            raise ValueError("Unknown offload header {0!r}".format(header))
+        self.header = header
+        self.root = os.path.abspath(root)
+        self.uri_prefix = uri_prefix.rstrip("/") + "/"
+
+    def get_header(self, fp):
+        """Returns the (name, value) header for sending a file, or None
+
+        Only files under root can be offloaded.
+
+        """
+        path = getattr(fp, "name", None)
+        if not isinstance(path, str):
+            return None
+        path = os.path.abspath(path)
+        if not path.startswith(self.root + os.sep):
+            return None
+        if self.header == "x-sendfile":
+            return self.HEADERS[self.header], path
+        relpath = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return self.HEADERS[self.header], self.uri_prefix + quote(relpath)
+
+class SendfileBody(object):
+    """Sends part of a file with the server's sendfile, see launcher
+
+    """
+    def __init__(self, sendfile, fp, offset, count):
+        self.sendfile = sendfile
+        self.fp = fp
+        self.offset = offset
+        self.count = count
+
+    def __iter__(self):
+        # An empty write makes the server send the headers first
+        yield b""
+        self.sendfile(self.fp, self.offset, self.count)
+
+    def close(self):
+        self.fp.close()
+
+@app.before_request
+def start_timer():
+    g.started = time.time()
+
+@app.after_request
+def record_request(response):
+    started = getattr(g, "started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(time.time() - started)
+    return response
+
 @app.route("/")
 def index():
     return render_template("index.html")
 
+@app.route("/metrics")
+def get_metrics():
+    """Metrics in the Prometheus text format
+
+    """
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+def page_response(page):
+    """Sends a precomputed page, compressed if the client allows
+
+    """
+    encoding, body, etag = page.encode(request.headers.get("Accept-Encoding"))
+    response = Response(body, content_type=page.content_type)
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.vary.update(["Accept", "Accept-Encoding"])
+    response.set_etag(etag)
+    return response.make_conditional(request.environ)
+
 @app.route("/simple/")
 def simple_index():
     """The top level simple index page
 
     """
-    return render_template("simple.html", packages=app.config["package_store"].list_packages())
+    media_type = simple.negotiate(request.headers.get("Accept"))
+    return page_response(app.config["cache"].get_simple_root(media_type))
 
 @app.route("/simple/<package>/")
 @app.route("/simple/<package>/<version>")
 def pypi_simple_package_info(package, version=''):
-    return app.config["pypi"].get_simple_package_info(package, version)
+    media_type = simple.negotiate(request.headers.get("Accept"))
+    try:
+        page = app.config["cache"].get_simple_page(package, version, media_type)
+    except exceptions.NotFound:
+        return abort(404)
+    return page_response(page)
+
+@app.route("/stats/")
+def stats():
+    """Cache statistics
+
+    """
+    return jsonify(app.config["cache"].stats())
+
+def buffer_chunks(chunks, size=64 * 1024):
+    """Joins the small strings a streamed template yields into larger encoded chunks
+
+    """
+    buffered = []
+    length = 0
+    for chunk in chunks:
+        chunk = chunk.encode("utf-8")
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield b"".join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield b"".join(buffered)
+
+def stream_template(template_name, **context):
+    app.update_template_context(context)
+    chunks = app.jinja_env.get_template(template_name).generate(context)
+    return Response(stream_with_context(buffer_chunks(chunks)), content_type="text/html; charset=utf-8")
+
+def local_index_etag(package_store, query_string):
+    return "{0}-{1}".format(package_store.packages_etag(), hashlib.sha1(query_string).hexdigest())
+
+def local_index_context(package_store, args):
+    """Looks up the packages for the local index
+
+    :param args: Mapping with optional prefix, page and per_page arguments
+    :returns: template context
+
+    """
+    def int_arg(name):
+        try:
+            value = int(args.get(name))
+        except (TypeError, ValueError):
+            return None
+        return value if value > 0 else None
+    prefix = args.get("prefix", "")
+    page = int_arg("page") or 1
+    per_page = int_arg("per_page")
+    if per_page is None:
+        packages = package_store.list_packages(prefix)
+        has_next = False
+    else:
+        # One extra to see if there's a next page
+        packages = package_store.list_packages(prefix, (page - 1) * per_page, per_page + 1)
+        has_next = len(packages) > per_page
+        packages = packages[:per_page]
+    return dict(packages=packages, prefix=prefix, page=page, per_page=per_page, has_next=has_next)
 
 @app.route("/local/")
 def local_index():
     """Top level of local packages
 
+    Takes optional prefix, page and per_page arguments. The page is
+    streamed out and revalidated against the package index.
+
     """
-    return render_template("local_index.html",
-        packages=list(app.config["package_store"].list_packages()),
-    )
+    package_store = app.config["package_store"]
+    etag = local_index_etag(package_store, request.query_string)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = stream_template("local_index.html", **local_index_context(package_store, request.args))
+    response.set_etag(etag)
+    return response
 
-@app.route("/local/<package>/")
-@app.route("/local/<package>/<version>")
-def local_simple_package_info(package, version=''):
-    files = list(app.config["package_store"].list_files(package))
+def filter_version(files, version):
+    """Only keep the sdists for version, if given
+
+    """
+    files = list(files)
     if version:
         files = [f for f in files
                  if f['filename'].endswith('%s.tar.gz' % version)]
+    return files
+
+@app.route("/local/<package>/")
+@app.route("/local/<package>/<version>")
+def local_simple_package_info(package, version=''):
+    files = filter_version(app.config["package_store"].list_files(package), version)
     if not files:
-        return app.config["pypi"].get_simple_package_info(package, version)
+        return pypi_simple_package_info(package, version)
     return render_template("simple_package.html",
         package=package,
         files=files,
     )
 
+def guess_content_type(filename):
+    content_type, _ = mimetypes.guess_type(filename)
+    if content_type is None and filename.endswith(".egg"):
+        content_type = "application/zip"
+    logging.debug("Setting mime type of {0!r} to {1!r}".format(filename, content_type))
+    return content_type
+
+def file_response(fp):
+    """Sends an open file back with ETag and Range support
+
+    The data never passes through Python when a front end server is
+    configured to send files (see FileOffload), or the WSGI server can
+    sendfile() them: the launcher directly, others through
+    wsgi.file_wrapper.
+
+    """
+    offload = app.config.get("offload")
+    if offload is not None:
+        header = offload.get_header(fp)
+        if header is not None:
+            fp.close()
+            response = Response(b"")
+            response.headers[header[0]] = header[1]
+            return response
+    stat = os.fstat(fp.fileno())
+    response = Response(wrap_file(request.environ, fp), direct_passthrough=True)
+    response.content_length = stat.st_size
+    response.last_modified = int(stat.st_mtime)
+    response.set_etag("{0}-{1}".format(int(stat.st_mtime), stat.st_size))
+    response = response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    sendfile = request.environ.get("pypicache.sendfile")
+    if sendfile is not None and response.status_code in (200, 206):
+        offset, count = 0, stat.st_size
+        if response.status_code == 206:
+            offset = response.content_range.start
+            count = response.content_range.stop - offset
+        response.response = SendfileBody(sendfile, fp, offset, count)
+    return response
+
 @app.route("/packages/<package>/<filename>", methods=["GET"])
 @app.route("/packages/<python_version>/<firstletter>/<package>/<filename>", methods=["GET"])
 @app.route("/packages/source/<firstletter>/<package>/<filename>", methods=["GET"])
 def get_file(package, filename, python_version=None, firstletter=None):
     logging.debug("Request to get package with: {0} {1} {2} {3}".format(firstletter, package, filename, python_version))
     try:
-        response = make_response(app.config["cache"].get_file(package, filename, python_version=python_version))
-        content_type, _ = mimetypes.guess_type(filename)
-        if content_type is None and filename.endswith(".egg"):
-            content_type = "application/zip"
-        logging.debug("Setting mime type of {0!r} to {1!r}".format(filename, content_type))
-        response.content_type = content_type
-        return response
+        content = app.config["cache"].get_file(package, filename, python_version=python_version)
     except exceptions.NotFound:
         return abort(404)
+    if hasattr(content, "read"):
+        response = file_response(content)
+        if request.method == "GET" and response.status_code in (200, 206):
+            BYTES_SERVED.inc(response.content_length or 0)
+    else:
+        response = Response(metrics.CountedChunks(content, BYTES_SERVED), direct_passthrough=True)
+    response.content_type = guess_content_type(filename)
+    return response
 
 # @app.route("/packages/source/<firstletter>/<package>/<filename>", methods=["PUT"])
 # def put_sdist(firstletter, package, filename):
@@ -95,21 +332,16 @@ def get_file(package, filename, python_version=None, firstletter=None):
 
 @app.route("/uploadpackage/", methods=["POST"])
 def post_uploadpackage():
-    """POST a package
+    """POST packages, as multipart/form-data files or with twine
+
+    The body is streamed straight into the package store.
 
     """
-    # TODO parse package versions properly, hopefully via distutils2 style library
-    # Assume package in form <package>-<version>.tar.gz
-    fileparam = "sdist"
-    if fileparam not in request.files:
-        response = jsonify({"error": True, "message": "Missing package data."})
-        response.status_code = 400
-        return response
-    filename = request.files[fileparam].filename
-    package = re.match(r"(?P<package>(?:[^-]|-[^0-9])*)-[0-9].*\..*", filename).groupdict()["package"]
-    logging.debug("Parsed {0!r} out of {1!r}".format(package, filename))
-    app.config["package_store"].add_file(package, filename, request.files[fileparam].stream)
-    return jsonify({"uploaded": "ok"})
+    chunks = iter(lambda: request.stream.read(uploads.CHUNK_SIZE), b"")
+    status, data = uploads.handle_upload(app.config["package_store"], request.headers.get("Content-Type"), chunks)
+    response = jsonify(data)
+    response.status_code = status
+    return response
 
 @app.route("/requirements.txt", methods=["POST"])
 def POST_requirements_txt():
@@ -120,4 +352,24 @@ def POST_requirements_txt():
         response = jsonify({"error": True, "message": "Missing requirements data."})
         response.status_code = 400
         return response
-    return jsonify(app.config["cache"].cache_requirements_txt(request.files["requirements"].stream))
+    # Any other uploaded files can be pulled in with -r/-c
+    attached = dict((os.path.basename(upload.filename or ""), upload.stream) for _, upload in request.files.items(multi=True))
+    def include(name):
+        return attached.get(os.path.basename(name))
+    requirements_fp = request.files["requirements"].stream
+    if request.args.get("async"):
+        job = app.config["cache"].start_requirements_txt(requirements_fp, include=include)
+        response = jsonify({"job": job.id, "status": "/requirements.txt/{0}".format(job.id)})
+        response.status_code = 202
+        return response
+    return jsonify(app.config["cache"].cache_requirements_txt(requirements_fp, include=include))
+
+@app.route("/requirements.txt/<job_id>", methods=["GET"])
+def GET_requirements_txt_job(job_id):
+    """Progress of a requirements.txt POSTed with ?async=1
+
+    """
+    try:
+        return jsonify(app.config["cache"].get_requirements_job(job_id))
+    except exceptions.NotFound:
+        return abort(404)
@@ -0,0 +1,354 @@
+"""Generates PEP 503 and PEP 691 simple pages for cached packages
+
+Pages list the files in the local store merged with the links on the
+cached upstream page. Every link points back at /packages/... on this
+server with a sha256 fragment, so pip downloads through the cache and a
+warm cache can resolve without talking to PyPI at all.
+
+Pages are rendered as HTML or JSON depending on the Accept header and
+kept, already compressed, until the store changes.
+
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import zlib
+
+# Forward compatible with python 3
+try:
+    from html.parser import HTMLParser
+    from urllib.parse import unquote, urldefrag, urljoin, urlparse
+    HTMLParser  # shut pyflakes up
+except ImportError:
+    from HTMLParser import HTMLParser
+    from urllib import unquote
+    from urlparse import urldefrag, urljoin, urlparse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+import jinja2
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from pypicache import exceptions
+from pypicache import lru
+from pypicache import names
+
+PACKAGE_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+HTML = "text/html"
+HTML_V1 = "application/vnd.pypi.simple.v1+html"
+JSON_V1 = "application/vnd.pypi.simple.v1+json"
+
+# Accepted media types and what gets served for them, in order of preference
+MEDIA_TYPES = [
+    (HTML, HTML),
+    (HTML_V1, HTML_V1),
+    ("application/vnd.pypi.simple.latest+html", HTML_V1),
+    (JSON_V1, JSON_V1),
+    ("application/vnd.pypi.simple.latest+json", JSON_V1),
+]
+
+API_VERSION = "1.0"
+
+def negotiate(accept):
+    """Picks the media type to serve for an Accept header, as per PEP 691
+
+    Defaults to text/html.
+
+    """
+    best = parse_accept_header(accept, MIMEAccept).best_match([media_type for media_type, _ in MEDIA_TYPES])
+    return dict(MEDIA_TYPES).get(best, HTML)
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+class LinkParser(HTMLParser):
+    """Collects the anchors of a simple page
+
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self.current = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        attrs = dict(attrs)
+        if attrs.get("href"):
+            self.current = dict(attrs, text="")
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.current["text"] += data
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self.current is not None:
+            self.links.append(self.current)
+            self.current = None
+
+def parse_links(content, base_url):
+    """Parses the file links out of an upstream simple page
+
+    :param base_url: URL the page was fetched from, to resolve relative links
+    :returns: list of dicts of filename, url, md5, sha256, requires_python and yanked
+
+    """
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", "replace")
+    parser = LinkParser()
+    parser.feed(content)
+    parser.close()
+    links = []
+    for anchor in parser.links:
+        url, fragment = urldefrag(urljoin(base_url, anchor["href"]))
+        filename = anchor["text"].strip() or unquote(os.path.basename(urlparse(url).path))
+        if not filename:
+            continue
+        algorithm, _, digest = fragment.partition("=")
+        links.append(dict(
+            filename=filename,
+            url=url,
+            md5=digest if algorithm == "md5" else None,
+            sha256=digest if algorithm == "sha256" else None,
+            requires_python=anchor.get("data-requires-python"),
+            yanked=anchor.get("data-yanked"),
+        ))
+    return links
+
+def version_matches(filename, version):
+    """Checks if a distribution filename is for the given version
+
+    """
+    return re.search(r"-{0}(?=[-.](?!\d))".format(re.escape(version)), filename) is not None
+
+def json_file(info):
+    """Turns a file dict into a PEP 691 file entry
+
+    """
+    entry = dict(
+        filename=info["filename"],
+        url="/packages/{0}/{1}".format(info["package"], info["filename"]),
+        hashes=dict((algorithm, info[algorithm]) for algorithm in ("md5", "sha256") if info.get(algorithm)),
+    )
+    if info.get("requires_python"):
+        entry["requires-python"] = info["requires_python"]
+    if info.get("yanked") is not None:
+        entry["yanked"] = info["yanked"] or True
+    return entry
+
+class Page(object):
+    """A rendered page, compressed up front
+
+    gzip is always available, brotli if the brotli module is installed.
+
+    """
+    def __init__(self, body, content_type="text/html; charset=utf-8"):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        self.body = body
+        self.content_type = content_type
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.encoded = dict(gzip=gzip_compress(body))
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(body)
+
+    def encode(self, accept_encoding):
+        """Picks the best encoding the client accepts
+
+        :returns: (content encoding or None, body, etag)
+
+        """
+        accepted = parse_accept_header(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in self.encoded and accepted[encoding]:
+                return encoding, self.encoded[encoding], "{0}-{1}".format(self.etag, encoding)
+        return None, self.body, self.etag
+
+class SimpleIndex(object):
+    """Builds simple pages from the store and cached upstream pages
+
+    Rendered pages are kept in memory until the package's local files or
+    upstream page change, the root page until the package index changes.
+    The store tells us about new files straight away, files added by
+    other processes are spotted via the package index.
+
+    :param package_cache: PackageCache to build pages for
+    :param max_entries: Number of packages to keep rendered pages for
+
+    """
+    def __init__(self, package_cache, max_entries=1000):
+        self.log = logging.getLogger("pypicache.simple")
+        self.package_cache = package_cache
+        self.package_store = package_cache.package_store
+        self.pages = lru.LRUCache(max_entries=max_entries)
+        # media type -> (index generation, page)
+        self.roots = {}
+        self.upstream = lru.LRUCache(max_entries=max_entries)
+        self.templates = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(os.path.join(PACKAGE_ROOT, "templates")),
+            autoescape=True,
+        )
+        self.package_store.add_listener(self.invalidate)
+
+    def invalidate(self, package, filename=None):
+        self.pages.delete(names.normalize(package))
+
+    def get_upstream_page(self, package):
+        """Returns the cached upstream page for a package, None if PyPI doesn't know it
+
+        :raises RemoteError: If PyPI fails and there's no cached copy
+
+        """
+        try:
+            return self.package_cache.get_simple_package_info(package)
+        except exceptions.NotFound:
+            return None
+
+    def get_upstream_links(self, package, content):
+        """Returns the parsed links of an upstream page, parsing it only once
+
+        :returns: dict of case folded filename to link
+
+        """
+        key = names.normalize(package)
+        parsed = self.upstream.get(key)
+        if parsed is not None and parsed[0] == content:
+            return parsed[1]
+        base_url = self.package_cache.pypi.get_simple_package_uri(package)
+        links = dict((link["filename"].lower(), link) for link in parse_links(content, base_url))
+        self.upstream.set(key, (content, links))
+        return links
+
+    def find_upstream_link(self, package, filename):
+        """Returns PyPI's link to a file, or None if it isn't known
+
+        :returns: dict of filename, url, md5, sha256, requires_python and yanked
+
+        """
+        try:
+            content = self.get_upstream_page(package)
+        except exceptions.PackageCacheError as e:
+            self.log.info("Can't look up upstream links for {0}: {1}".format(package, e))
+            return None
+        if content is None:
+            return None
+        return self.get_upstream_links(package, content).get(filename.lower())
+
+    def get_local_files(self, package):
+        """Returns the package's name on disk and its stored filenames
+
+        """
+        my_package = self.package_store.find_package(package)
+        if my_package is None:
+            return None, ()
+        return my_package, tuple(self.package_store.list_filenames(my_package))
+
+    def get_files(self, package, local_package, upstream):
+        """Merges the stored files of a package with those on its upstream page
+
+        Stored files win, upstream only files are linked under the
+        local package name if there is one.
+
+        :returns: list of dicts of package, filename, md5, sha256, requires_python and yanked
+
+        """
+        files = {}
+        if upstream is not None:
+            for key, link in self.get_upstream_links(package, upstream).items():
+                files[key] = dict(link, package=local_package or package)
+        if local_package is not None:
+            for info in self.package_store.list_files(local_package):
+                key = info["filename"].lower()
+                link = files.get(key, {})
+                files[key] = dict(
+                    package=info["package"],
+                    filename=info["filename"],
+                    md5=info.get("md5"),
+                    sha256=info.get("sha256"),
+                    requires_python=link.get("requires_python"),
+                    yanked=link.get("yanked"),
+                )
+        return [files[key] for key in sorted(files)]
+
+    def render(self, template, media_type, data, **context):
+        """Renders a page as JSON or with a template
+
+        """
+        if media_type == JSON_V1:
+            data = dict(data, meta={"api-version": API_VERSION})
+            return Page(json.dumps(data, sort_keys=True), content_type=JSON_V1)
+        body = self.templates.get_template(template).render(**context)
+        if media_type == HTML_V1:
+            return Page(body, content_type=HTML_V1)
+        return Page(body)
+
+    def get_root(self, media_type=HTML):
+        """Returns the page listing every stored package
+
+        """
+        etag = self.package_store.packages_etag()
+        root = self.roots.get(media_type)
+        if root is not None and root[0] == etag:
+            return root[1]
+        packages = self.package_store.list_packages()
+        page = self.render(
+            "simple.html",
+            media_type,
+            dict(projects=[dict(name=package) for package in packages]),
+            packages=packages,
+        )
+        self.roots[media_type] = (etag, page)
+        return page
+
+    def get_page(self, package, version='', media_type=HTML):
+        """Returns the simple page for a package
+
+        :param version: Only list files for this version
+        :param media_type: One of HTML, HTML_V1 or JSON_V1
+        :raises NotFound: If the package is neither stored nor known to PyPI
+        :raises RemoteError: If PyPI fails and nothing is known about the package
+
+        """
+        local_package, local_files = self.get_local_files(package)
+        try:
+            upstream = self.get_upstream_page(package)
+        except exceptions.RemoteError as e:
+            if local_package is None:
+                raise
+            self.log.warning("Serving local files only for {0}: {1}".format(package, e))
+            upstream = None
+        if upstream is None and local_package is None:
+            raise exceptions.NotFound("Package {0} not found".format(package))
+        key = names.normalize(package)
+        entry = self.pages.get(key)
+        if entry is None or entry["upstream"] != upstream or entry["local_files"] != local_files:
+            entry = dict(
+                upstream=upstream,
+                local_files=local_files,
+                files=self.get_files(package, local_package, upstream),
+                pages={},
+            )
+            self.pages.set(key, entry)
+        page = entry["pages"].get((version, media_type))
+        if page is None:
+            files = entry["files"]
+            if version:
+                files = [f for f in files if version_matches(f["filename"], version)]
+            page = self.render(
+                "simple_package.html",
+                media_type,
+                dict(name=key, files=[json_file(f) for f in files]),
+                package=package,
+                files=files,
+            )
+            entry["pages"][(version, media_type)] = page
+        return page
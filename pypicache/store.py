@@ -0,0 +1,306 @@
+"""The interface package storage backends provide
+
+Files are addressed by package and filename. Backends:
+
+- disk.DiskPackageStore keeps files in a local folder
+- s3.S3PackageStore keeps them in an S3 compatible object store, so
+  several cache nodes can share them
+- CachingPackageStore puts a local disk store in front of a shared one
+
+"""
+
+import logging
+import re
+import threading
+
+from pypicache import exceptions
+
+def is_snapshot(filename):
+    """Development snapshots are the only files which can be overwritten
+
+    """
+    return re.search(r'-(dev|SNAPSHOT)\.(zip|tar.gz|tar.bz2)$', filename) is not None
+
+class PackageStore(object):
+    """Base class for package storage backends
+
+    """
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """Registers a callback to be called with (package, filename) when files are added or removed
+
+        """
+        self.listeners.append(callback)
+
+    def notify(self, package, filename):
+        for callback in self.listeners:
+            callback(package, filename)
+
+    def get_file(self, package, filename):
+        """Opens a stored file for reading
+
+        Package and file names are matched ignoring differences in spelling.
+
+        :returns: An open file, or an iterable of data chunks with a
+            close() method for backends which can't hand out files.
+        :raises NotFound: If the file isn't stored
+
+        """
+        raise NotImplementedError
+
+    def touch(self, package, filename):
+        """Records a read of a file served without get_file, e.g. from memory
+
+        """
+        pass
+
+    def stat(self, package, filename):
+        """Describes a stored file
+
+        :returns: dict of size, mtime, md5 and sha256
+        :raises NotFound: If the file isn't stored
+
+        """
+        raise NotImplementedError
+
+    def tee_file(self, package, filename, content, expected=None):
+        """Writes a file to the store, yielding the data as it is written
+
+        The file only appears once all of the content has been written
+        and matches the expected digests, abandoning the iteration throws
+        the partial file away.
+
+        :param content: A string, file object or iterable of strings
+        :param expected: dict of md5 and/or sha256 hex digests the file should have
+        :returns: generator of data chunks
+        :raises NotOverwritingError: If the file exists and can't be replaced
+        :raises CorruptFileError: If the content doesn't match the expected digests
+
+        """
+        raise NotImplementedError
+
+    def add_file(self, package, filename, content, pinned=False, expected=None):
+        """Writes a file to the store
+
+        :param content: A string, file object or iterable of strings
+        :param pinned: Never evict the file, for stores which evict
+        :param expected: dict of md5 and/or sha256 hex digests the file should have
+
+        """
+        for chunk in self.tee_file(package, filename, content, expected=expected):
+            pass
+
+    def remove_file(self, package, filename):
+        """Removes a file from the store
+
+        :returns: True if the file was removed
+
+        """
+        raise NotImplementedError
+
+    def list_files(self, package):
+        """Describes the stored files of a package
+
+        :returns: iterable of dicts of package, firstletter, filename, md5 and sha256
+
+        """
+        raise NotImplementedError
+
+    def list_filenames(self, package):
+        """Returns the sorted filenames stored for a package, cheaply
+
+        :param package: Package name as stored, see find_package
+
+        """
+        raise NotImplementedError
+
+    def find_package(self, package):
+        """Returns the stored name of a package, matched as per PEP 503, or None
+
+        """
+        raise NotImplementedError
+
+    def list_packages(self, prefix="", offset=0, limit=None):
+        """Returns a sorted list of package names
+
+        Filtering or paging sorts by normalized name.
+
+        """
+        raise NotImplementedError
+
+    def packages_etag(self):
+        """Returns a tag which changes whenever the list of packages does
+
+        """
+        raise NotImplementedError
+
+    def lock(self, package, filename):
+        """Returns a lock (with acquire(blocking) and release()) for writing a file
+
+        """
+        raise NotImplementedError
+
+class LockedIterator(object):
+    """Iterates over chunks of data while holding a lock
+
+    The lock is released once the chunks are exhausted or the iterator
+    is closed (WSGI servers call close() when a client goes away).
+
+    """
+    def __init__(self, chunks, lock):
+        self.chunks = iter(chunks)
+        self.lock = lock
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    next = __next__
+
+    def close(self):
+        try:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+        finally:
+            self.lock.release()
+
+class KeyedLocks(object):
+    """Process local locks by name, for backends without shared locking
+
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        # key -> [lock, users]
+        self.locks = {}
+
+    def lock(self, key):
+        return KeyedLock(self, key)
+
+class KeyedLock(object):
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.held = False
+
+    def acquire(self, blocking=True):
+        with self.registry.mutex:
+            entry = self.registry.locks.setdefault(self.key, [threading.Lock(), 0])
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            self.held = True
+            return True
+        self.forget()
+        return False
+
+    def forget(self):
+        with self.registry.mutex:
+            entry = self.registry.locks[self.key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.registry.locks[self.key]
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.registry.locks[self.key][0].release()
+            self.forget()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class CachingPackageStore(PackageStore):
+    """Reads through a local disk store to a shared backend
+
+    The backend is the authority, new files are written to both. Files
+    read from the backend are kept in the local store, which can be
+    size limited (see eviction) without losing anything.
+
+    :param backend: The shared PackageStore, e.g. s3.S3PackageStore
+    :param local: A disk.DiskPackageStore
+
+    """
+    def __init__(self, backend, local):
+        PackageStore.__init__(self)
+        self.log = logging.getLogger("pypicache.store")
+        self.backend = backend
+        self.local = local
+
+    def add_listener(self, callback):
+        self.backend.add_listener(callback)
+
+    def get_file(self, package, filename):
+        try:
+            return self.local.get_file(package, filename)
+        except exceptions.NotFound:
+            pass
+        content = self.backend.get_file(package, filename)
+        # Keep the local copy under the same name as the shared one
+        package = self.backend.find_package(package) or package
+        lock = self.local.lock(package, filename)
+        if not lock.acquire(blocking=False):
+            # Somebody else is already copying it
+            return content
+        try:
+            chunks = self.local.tee_file(package, filename, content)
+        except BaseException:
+            lock.release()
+            if hasattr(content, "close"):
+                content.close()
+            raise
+        return LockedIterator(chunks, lock)
+
+    def touch(self, package, filename):
+        self.local.touch(package, filename)
+
+    def stat(self, package, filename):
+        try:
+            return self.local.stat(package, filename)
+        except exceptions.NotFound:
+            return self.backend.stat(package, filename)
+
+    def tee_file(self, package, filename, content, expected=None):
+        chunks = self.backend.tee_file(package, filename, content, expected=expected)
+        try:
+            for chunk in self.local.tee_file(package, filename, chunks, expected=expected):
+                yield chunk
+        finally:
+            chunks.close()
+
+    def add_file(self, package, filename, content, pinned=False, expected=None):
+        PackageStore.add_file(self, package, filename, content, expected=expected)
+        if pinned:
+            self.local.pin(package, filename)
+
+    def remove_file(self, package, filename):
+        self.local.remove_file(package, filename)
+        return self.backend.remove_file(package, filename)
+
+    def list_files(self, package):
+        return self.backend.list_files(package)
+
+    def list_filenames(self, package):
+        return self.backend.list_filenames(package)
+
+    def find_package(self, package):
+        return self.backend.find_package(package)
+
+    def list_packages(self, prefix="", offset=0, limit=None):
+        return self.backend.list_packages(prefix, offset, limit)
+
+    def packages_etag(self):
+        return self.backend.packages_etag()
+
+    def lock(self, package, filename):
+        return self.local.lock(package, filename)
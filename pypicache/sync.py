@@ -0,0 +1,444 @@
+"""Bulk mirroring of packages into the store
+
+Fills the cache ahead of time, e.g. overnight for an air gapped mirror,
+rather than one miss or requirements.txt at a time. Packages are given
+as requirement specifiers ("django>=4.2,<5", or just "django" for every
+release) or read from lock files. Every matching file is worked out up
+front, compared with the store, and only the missing ones downloaded by
+a pool of workers.
+
+With a checkpoint file an interrupted sync can be run again with the
+same packages to pick up where it stopped: the plan is read back instead
+of asking upstream for it again, and files already fetched are skipped.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.specifiers import SpecifierSet
+from packaging.version import InvalidVersion, Version
+
+from pypicache import digests
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import names
+from pypicache import requirements
+from pypicache import warmup
+
+log = logging.getLogger("pypicache.sync")
+
+class Spec(object):
+    """The releases of a package to mirror
+
+    :param specifier: packaging SpecifierSet the versions must match
+    :param hashes: "algorithm:digest" strings, only matching files are mirrored
+
+    """
+    def __init__(self, name, specifier, hashes=(), source=None):
+        self.name = name
+        self.specifier = specifier
+        self.hashes = list(hashes)
+        self.source = source or "{0}{1}".format(name, specifier)
+
+    def __repr__(self):
+        return "Spec({0!r})".format(self.source)
+
+def parse_spec(text):
+    """Parses a requirement specifier, e.g. "django>=4.2,<5"
+
+    :returns: Spec, or None if it can't be parsed
+
+    """
+    try:
+        requirement = Requirement(text)
+    except InvalidRequirement:
+        return None
+    return Spec(requirement.name, requirement.specifier, source=text)
+
+def pinned_spec(name, version, hashes=(), source=None):
+    return Spec(name, SpecifierSet("=={0}".format(version)), hashes=hashes, source=source)
+
+def read_requirements_file(path):
+    """Reads the pinned requirements of a requirements.txt style lock file
+
+    -r and -c includes are read relative to the file.
+
+    :returns: (specs, unparseable lines)
+
+    """
+    def include(name):
+        included = os.path.join(os.path.dirname(path), name)
+        if not os.path.isfile(included):
+            return None
+        with open(included) as fp:
+            return fp.readlines()
+    specs = []
+    unparseable = []
+    with open(path) as fp:
+        lines = fp.readlines()
+    for line, requirement in requirements.parse_requirements(lines, include=include):
+        if requirement is None:
+            spec = parse_spec(line)
+            if spec is None:
+                unparseable.append(line)
+            else:
+                specs.append(spec)
+            continue
+        specs.append(pinned_spec(requirement.name, requirement.version, requirement.hashes, source=line))
+    return specs, unparseable
+
+def read_pipfile_lock(path):
+    specs = []
+    with open(path) as fp:
+        data = json.load(fp)
+    for section in ("default", "develop"):
+        for name, info in sorted(data.get(section, {}).items()):
+            version = info.get("version", "")
+            if version.startswith("=="):
+                specs.append(pinned_spec(name, version[2:], info.get("hashes", []), source="{0}{1}".format(name, version)))
+    return specs, []
+
+def read_poetry_lock(path):
+    if tomllib is None:
+        log.warning("Skipping {0}, reading poetry.lock files needs python 3.11".format(path))
+        return [], [path]
+    specs = []
+    with open(path, "rb") as fp:
+        data = tomllib.load(fp)
+    for package in data.get("package", []):
+        hashes = [f["hash"] for f in package.get("files", []) if "hash" in f]
+        specs.append(pinned_spec(package["name"], package["version"], hashes, source="{0}=={1}".format(package["name"], package["version"])))
+    return specs, []
+
+LOCK_FILE_READERS = {
+    "Pipfile.lock": read_pipfile_lock,
+    "poetry.lock": read_poetry_lock,
+}
+
+def read_lock_file(path):
+    """Reads requirements.txt style files, Pipfile.lock and poetry.lock
+
+    :returns: (specs, unparseable lines)
+
+    """
+    reader = LOCK_FILE_READERS.get(os.path.basename(path), read_requirements_file)
+    return reader(path)
+
+def find_lock_files(path):
+    """Finds the lock files in a folder and its subfolders
+
+    """
+    found = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename in LOCK_FILE_READERS or filename.endswith(".txt"):
+                found.append(os.path.join(root, filename))
+    return found
+
+def parse_version(version):
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return None
+
+class Planner(object):
+    """Works out which files the specs need
+
+    :param pypi: PyPI to look packages up on
+    :param artifact_filter: requirements.ArtifactFilter choosing the files of each release
+    :param latest: Only mirror this many of the newest matching releases of a package
+    :param prereleases: Mirror pre-releases not named exactly by a spec
+    :param workers: Concurrent package lookups
+
+    """
+    def __init__(self, pypi, artifact_filter=None, latest=None, prereleases=False, workers=8):
+        self.pypi = pypi
+        if artifact_filter is None:
+            artifact_filter = requirements.ArtifactFilter()
+        self.artifact_filter = artifact_filter
+        self.latest = latest
+        self.prereleases = prereleases
+        self.workers = workers
+
+    def select_versions(self, specs, releases):
+        """Returns the versions of a package matching any of its specs, oldest first
+
+        """
+        versions = [(parse_version(version), version) for version in releases]
+        versions = sorted((parsed, version) for parsed, version in versions if parsed is not None)
+        selected = []
+        for spec in specs:
+            # Pre-releases only when asked for, or named by the spec itself
+            prereleases = self.prereleases or any(
+                (parse_version(specifier.version.rstrip(".*")) or Version("0")).is_prerelease
+                for specifier in spec.specifier
+            )
+            matching = [
+                version for parsed, version in versions
+                if (prereleases or not parsed.is_prerelease) and spec.specifier.contains(parsed, prereleases=True)
+            ]
+            if self.latest is not None:
+                matching = matching[-self.latest:]
+            selected.extend(version for version in matching if version not in selected)
+        return selected
+
+    def plan_package(self, name, specs, releases):
+        """Returns the files to mirror for one package
+
+        :param releases: The package's releases, from PyPI.get_releases
+        :returns: list of artifact dicts
+
+        """
+        artifacts = []
+        for version in self.select_versions(specs, releases):
+            hashes = []
+            for spec in specs:
+                if spec.hashes and spec.specifier.contains(version, prereleases=True):
+                    hashes.extend(spec.hashes)
+            urls = [url for url in releases[version] if not url.get("yanked")]
+            for url in self.artifact_filter.select(urls, hashes=hashes):
+                artifacts.append(dict(
+                    package=name,
+                    version=version,
+                    filename=url["filename"],
+                    url=url.get("url"),
+                    packagetype=url["packagetype"],
+                    python_version=url.get("python_version"),
+                    size=url.get("size"),
+                    digests=url.get("digests", {}),
+                ))
+        return artifacts
+
+    def plan(self, specs):
+        """Works out the files for every spec, looking packages up in parallel
+
+        :returns: (artifacts, list of specs which failed or matched nothing)
+
+        """
+        by_package = {}
+        for spec in specs:
+            by_package.setdefault(names.normalize(spec.name), []).append(spec)
+        found = self.pypi.get_many_releases([package_specs[0].name for package_specs in by_package.values()], workers=self.workers)
+        artifacts = []
+        unresolved = []
+        for key, package_specs in sorted(by_package.items()):
+            name = package_specs[0].name
+            releases = found[name]
+            package_artifacts = None
+            if isinstance(releases, exceptions.PackageCacheError):
+                log.warning("Can't look up {0}: {1}".format(name, releases))
+            else:
+                package_artifacts = self.plan_package(name, package_specs, releases)
+            if not package_artifacts:
+                unresolved.extend(spec.source for spec in package_specs)
+                continue
+            artifacts.extend(package_artifacts)
+        return artifacts, unresolved
+
+class Checkpoint(object):
+    """Records a sync's plan and progress so an interrupted sync can resume
+
+    A file of JSON lines: the plan, then a line for each file as it is
+    fetched or fails. Lines are flushed as they are written so a killed
+    sync only loses the downloads it was in the middle of.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fp = None
+
+    def load(self):
+        """Reads an earlier sync's progress
+
+        :returns: (specs, planned artifacts, filenames already fetched),
+            specs and artifacts are None if there's no plan
+
+        """
+        specs = artifacts = None
+        done = set()
+        if not os.path.exists(self.path):
+            return specs, artifacts, done
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Cut short by a crash
+                    continue
+                if entry.get("plan") is not None:
+                    specs = entry.get("specs", [])
+                    artifacts = entry["plan"]
+                    done = set()
+                elif entry.get("done"):
+                    done.add(entry["done"])
+        return specs, artifacts, done
+
+    def start(self, specs, artifacts, done=()):
+        """Starts a fresh checkpoint file, carrying over finished files
+
+        :param specs: The sources of the specs the plan was made for
+
+        """
+        with self.lock:
+            disk.makedirs(os.path.dirname(os.path.abspath(self.path)))
+            self.fp = open(self.path + ".tmp", "w")
+            self.fp.write(json.dumps({"specs": sorted(specs), "plan": artifacts}) + "\n")
+            for filename in sorted(done):
+                self.fp.write(json.dumps({"done": filename}) + "\n")
+            self.fp.flush()
+            os.rename(self.path + ".tmp", self.path)
+
+    def record(self, filename, error=None):
+        entry = {"done": filename} if error is None else {"failed": filename, "error": error}
+        with self.lock:
+            self.fp.write(json.dumps(entry) + "\n")
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+class Sync(object):
+    """Downloads the files of a plan which aren't in the store yet
+
+    :param package_cache: PackageCache to fill
+    :param workers: Concurrent downloads
+    :param per_host: Maximum concurrent downloads from any one upstream host
+    :param checkpoint: Optional Checkpoint to resume from and record progress in
+    :param progress_interval: Seconds between progress log messages
+
+    """
+    def __init__(self, package_cache, workers=16, per_host=8, checkpoint=None, progress_interval=10):
+        self.log = logging.getLogger("pypicache.sync")
+        self.package_cache = package_cache
+        self.package_store = package_cache.package_store
+        self.workers = workers
+        self.per_host = per_host
+        self.checkpoint = checkpoint
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.hosts = warmup.HostLimiter(per_host)
+
+    def stored_filenames(self, package):
+        stored = self.package_store.find_package(package)
+        if stored is None:
+            return set()
+        return set(filename.lower() for filename in self.package_store.list_filenames(stored))
+
+    def missing(self, artifacts, done=()):
+        """Returns the artifacts which still need downloading
+
+        """
+        done = set(done)
+        stored = {}
+        missing = []
+        for artifact in artifacts:
+            if artifact["filename"] in done:
+                continue
+            key = names.normalize(artifact["package"])
+            if key not in stored:
+                stored[key] = self.stored_filenames(artifact["package"])
+            if artifact["filename"].lower() not in stored[key]:
+                missing.append(artifact)
+        return missing
+
+    def plan(self, planner, specs, resume=True):
+        """Returns the plan, from the checkpoint if resuming a sync of the same specs
+
+        :returns: (artifacts, filenames already fetched, unresolved specs)
+
+        """
+        if self.checkpoint is not None and resume:
+            planned_specs, artifacts, done = self.checkpoint.load()
+            if artifacts is not None and planned_specs == sorted(spec.source for spec in specs):
+                self.log.info("Resuming sync of {0} files, {1} already fetched".format(len(artifacts), len(done)))
+                return artifacts, done, []
+        artifacts, unresolved = planner.plan(specs)
+        return artifacts, set(), unresolved
+
+    def run(self, planner, specs, resume=True):
+        """Mirrors the files the specs need
+
+        :param resume: Carry on from the checkpoint's plan, if there is one
+        :returns: dict report
+
+        """
+        started = time.time()
+        artifacts, done, unresolved = self.plan(planner, specs, resume=resume)
+        if self.checkpoint is not None:
+            self.checkpoint.start([spec.source for spec in specs], artifacts, done)
+        missing = self.missing(artifacts, done)
+        report = dict(
+            planned=len(artifacts),
+            present=len(artifacts) - len(missing),
+            fetched=0,
+            bytes=0,
+            failed=[],
+            unresolved=unresolved,
+        )
+        total_bytes = sum(artifact.get("size") or 0 for artifact in missing)
+        self.log.info("Fetching {0} of {1} files ({2} bytes)".format(len(missing), len(artifacts), total_bytes))
+        progress = dict(logged=time.time())
+        def fetch(artifact):
+            error = self.fetch(artifact)
+            with self.lock:
+                if error is None:
+                    report["fetched"] += 1
+                    report["bytes"] += artifact.get("size") or 0
+                else:
+                    report["failed"].append(dict(filename=artifact["filename"], error=error))
+                now = time.time()
+                if now - progress["logged"] >= self.progress_interval:
+                    progress["logged"] = now
+                    self.log.info("Fetched {0} of {1} files, {2} of {3} bytes, {4} failed".format(
+                        report["fetched"], len(missing), report["bytes"], total_bytes, len(report["failed"]),
+                    ))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for result in executor.map(fetch, missing):
+                    pass
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+        report["seconds"] = time.time() - started
+        return report
+
+    def fetch(self, artifact):
+        """Downloads one file into the store
+
+        :returns: None, or an error message
+
+        """
+        url = artifact.get("url")
+        try:
+            with self.hosts.get(url or self.package_cache.pypi.pypi_server):
+                self.package_cache.cache_file(
+                    artifact["package"],
+                    artifact["filename"],
+                    python_version=None if artifact["packagetype"] == "sdist" else artifact.get("python_version"),
+                    url=url,
+                    expected=digests.expected_digests(artifact),
+                )
+        except exceptions.PackageCacheError as e:
+            self.log.warning("Failed to fetch {0}: {1}".format(artifact["filename"], e))
+            error = str(e)
+        else:
+            error = None
+        if self.checkpoint is not None:
+            self.checkpoint.record(artifact["filename"], error)
+        return error
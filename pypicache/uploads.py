@@ -0,0 +1,286 @@
+"""Streams uploaded packages into a package store
+
+Uploads are multipart/form-data bodies, as sent by curl -F, by the old
+/uploadpackage/ form and by twine (the distutils upload protocol, with
+``:action=file_upload``). The body is parsed as it arrives and each file
+part goes straight into PackageStore.add_file, which hashes it on the
+fly and only publishes it once it is complete, so however large the
+package only one chunk of it is in memory at a time.
+
+Every file part in a request is stored, in order. Digests given in
+``md5_digest`` and ``sha256_digest`` fields before a file part (twine
+sends them first) are checked against it.
+
+"""
+
+import logging
+import os
+import re
+
+from packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from werkzeug.http import parse_options_header
+
+from pypicache import digests
+from pypicache import exceptions
+
+CHUNK_SIZE = 64 * 1024
+
+# Form fields are small (twine's largest is the long description)
+MAX_FIELD_SIZE = 8 * 1024 * 1024
+MAX_HEADER_SIZE = 16 * 1024
+
+# Parts twine sends which aren't packages
+IGNORED_FILE_FIELDS = ("gpg_signature",)
+
+log = logging.getLogger("pypicache.uploads")
+
+def parse_package_name(filename):
+    """Works out which package an uploaded file belongs to
+
+    Wheels must follow the wheel naming rules. Sdists are parsed with
+    the standard rules too, falling back to everything before the first
+    "-<digit>" for older names (e.g. foo-bar-1.0-dev.tar.gz or eggs).
+
+    :returns: The package name as spelled in the filename
+    :raises InvalidUploadError: If the filename isn't a package's
+
+    """
+    if filename.endswith(".whl"):
+        try:
+            parse_wheel_filename(filename)
+        except InvalidWheelFilename as e:
+            raise exceptions.InvalidUploadError(str(e))
+        return filename.split("-")[0]
+    try:
+        parse_sdist_filename(filename)
+    except (InvalidSdistFilename, ValueError):
+        pass
+    else:
+        return filename.rpartition("-")[0]
+    match = re.match(r"^(?P<package>(?:[^-]|-[^0-9])+)-[0-9].*\.[A-Za-z0-9]+$", filename)
+    if match is None:
+        raise exceptions.InvalidUploadError("Can't work out the package of {0!r}".format(filename))
+    log.debug("Parsed {0!r} out of {1!r}".format(match.group("package"), filename))
+    return match.group("package")
+
+class Part(object):
+    """One part of a multipart body
+
+    Its data has to be read (or skipped with drain) before the next
+    part is looked at.
+
+    """
+    def __init__(self, parser, headers):
+        self.parser = parser
+        self.headers = headers
+        disposition, options = parse_options_header(headers.get("content-disposition", ""))
+        self.name = options.get("name")
+        self.filename = options.get("filename")
+        if self.filename is not None:
+            # Some clients send the full path, with either kind of slash
+            self.filename = os.path.basename(self.filename.replace("\\", "/"))
+        self.finished = False
+
+    def iter_data(self):
+        """Yields the part's data in chunks
+
+        """
+        return self.parser.iter_data(self)
+
+    def read(self, limit):
+        data = []
+        size = 0
+        for chunk in self.iter_data():
+            size += len(chunk)
+            if size > limit:
+                raise exceptions.InvalidUploadError("Form field {0!r} is over {1} bytes".format(self.name, limit))
+            data.append(chunk)
+        return b"".join(data)
+
+    def drain(self):
+        for chunk in self.iter_data():
+            pass
+
+class MultipartParser(object):
+    """Parses a multipart/form-data body as it streams in
+
+    :param chunks: Iterable of strings making up the body
+    :param boundary: The boundary from the request's Content-Type
+
+    """
+    def __init__(self, chunks, boundary):
+        self.chunks = iter(chunks)
+        self.delimiter = b"\r\n--" + boundary
+        # Pretend the body starts with a line break, so the first
+        # boundary looks like all the others
+        self.buffer = b"\r\n"
+
+    def read_more(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += chunk
+                return
+        raise exceptions.InvalidUploadError("Form data ended early")
+
+    def iter_data(self, part):
+        """Yields data up to the next boundary
+
+        A tail that could be the start of the boundary is held back until
+        more data shows whether it is.
+
+        """
+        keep = len(self.delimiter) - 1
+        while not part.finished:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                data = self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                part.finished = True
+                if data:
+                    yield data
+                return
+            if len(self.buffer) > keep:
+                data = self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+                yield data
+            self.read_more()
+
+    def read_headers(self):
+        while True:
+            index = self.buffer.find(b"\r\n\r\n")
+            if index >= 0:
+                break
+            if len(self.buffer) > MAX_HEADER_SIZE:
+                raise exceptions.InvalidUploadError("Form part headers are too long")
+            self.read_more()
+        lines = self.buffer[:index].decode("utf-8", "replace").split("\r\n")
+        self.buffer = self.buffer[index + 4:]
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(":")
+            if name.strip():
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def __iter__(self):
+        """Yields the parts of the body in order
+
+        """
+        # Skip the preamble
+        Part(self, {}).drain()
+        while True:
+            while len(self.buffer) < 2:
+                self.read_more()
+            if self.buffer.startswith(b"--"):
+                # Closing boundary, ignore the epilogue
+                return
+            # Skip the rest of the boundary line (e.g. trailing whitespace)
+            # but keep its line break, so a part without headers still
+            # has a blank line ending them
+            while b"\r\n" not in self.buffer:
+                self.read_more()
+            self.buffer = self.buffer[self.buffer.index(b"\r\n"):]
+            part = Part(self, self.read_headers())
+            yield part
+            part.drain()
+
+def get_boundary(content_type):
+    """Returns the multipart boundary of a Content-Type, or None
+
+    """
+    mimetype, options = parse_options_header(content_type or "")
+    if mimetype != "multipart/form-data" or not options.get("boundary"):
+        return None
+    return options["boundary"].encode("latin-1")
+
+class Upload(object):
+    """Stores the packages in one upload request
+
+    :param package_store: Where to put the packages
+    :param content_type: The request's Content-Type
+    :param chunks: Iterable of strings making up the request body
+
+    """
+    def __init__(self, package_store, content_type, chunks):
+        self.package_store = package_store
+        self.content_type = content_type
+        self.chunks = iter(chunks)
+        # Filenames stored so far
+        self.stored = []
+
+    def run(self):
+        """Stores every file in the body
+
+        :returns: list of stored filenames
+        :raises InvalidUploadError: If the body is malformed, has no files
+            or names a file which isn't a package
+        :raises NotOverwritingError: If a file is already stored
+        :raises CorruptFileError: If a file doesn't match its digests
+
+        """
+        boundary = get_boundary(self.content_type)
+        if boundary is None:
+            raise exceptions.InvalidUploadError("Missing package data.")
+        fields = {}
+        for part in MultipartParser(self.chunks, boundary):
+            if part.filename is None:
+                fields[part.name] = part.read(MAX_FIELD_SIZE).decode("utf-8", "replace")
+                continue
+            if part.name in IGNORED_FILE_FIELDS or not part.filename:
+                continue
+            action = fields.get(":action", "file_upload")
+            if action != "file_upload":
+                raise exceptions.InvalidUploadError("Unsupported action {0!r}".format(action))
+            # Digests only describe the file that follows them
+            expected = digests.expected_digests(dict(
+                md5_digest=fields.pop("md5_digest", None),
+                sha256=fields.pop("sha256_digest", None),
+            ))
+            self.store(part, expected)
+        if not self.stored:
+            raise exceptions.InvalidUploadError("Missing package data.")
+        return self.stored
+
+    def store(self, part, expected):
+        package = parse_package_name(part.filename)
+        package = self.package_store.find_package(package) or package
+        log.info("Storing upload of {0}: {1}".format(package, part.filename))
+        # Downloads of the file take the same lock, so only one writer runs
+        lock = self.package_store.lock(package, part.filename)
+        lock.acquire()
+        try:
+            self.package_store.add_file(package, part.filename, part.iter_data(), pinned=True, expected=expected or None)
+        finally:
+            lock.release()
+        self.stored.append(part.filename)
+
+def handle_upload(package_store, content_type, chunks):
+    """Stores uploaded packages, working out the response for the servers
+
+    Files before a failing one stay stored. The rest of the body is read
+    and thrown away, so the connection can be reused.
+
+    :returns: (status, dict to send as JSON)
+
+    """
+    upload = Upload(package_store, content_type, chunks)
+    try:
+        upload.run()
+    except exceptions.NotOverwritingError as e:
+        status, message = 409, str(e)
+    except (exceptions.InvalidUploadError, exceptions.CorruptFileError) as e:
+        status, message = 400, str(e)
+    else:
+        return 200, {"uploaded": "ok", "files": upload.stored}
+    log.info("Rejected upload: {0}".format(message))
+    for chunk in upload.chunks:
+        pass
+    data = {"error": True, "message": message}
+    if upload.stored:
+        data["files"] = upload.stored
+    return status, data
@@ -0,0 +1,210 @@
+"""Concurrent caching of the packages in requirements files
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+import uuid
+
+# Forward compatible with python 3
+try:
+    from urllib.parse import urlparse
+    urlparse  # shut pyflakes up
+except ImportError:
+    from urlparse import urlparse
+
+from pypicache import digests
+from pypicache import exceptions
+from pypicache import lru
+from pypicache import requirements
+
+class HostLimiter(object):
+    """Limits concurrent downloads from each upstream host
+
+    :param per_host: Maximum concurrent downloads from any one host
+
+    """
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get(self, uri):
+        """Returns the semaphore to hold while downloading from a URI
+
+        """
+        host = urlparse(uri).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.semaphores[host]
+
+class Job(object):
+    """Tracks the progress of caching a requirements file
+
+    The final report has the same shape PackageCache.cache_requirements_txt
+    has always returned: lists of cached, unparseable and failed entries.
+
+    """
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.started = time.time()
+        self.ended = None
+        self.pending = 0
+        self.requirements = 0
+        self.files = 0
+        self.files_done = 0
+        self.report = {
+            "cached": [],
+            "unparseable": [],
+            "failed": [],
+        }
+
+    def add_task(self):
+        with self.lock:
+            self.pending += 1
+
+    def task_done(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.ended = time.time()
+                self.finished.set()
+
+    def record(self, key, value):
+        with self.lock:
+            if value not in self.report[key]:
+                self.report[key].append(value)
+
+    def wait(self, timeout=None):
+        """Waits for the job to finish and returns the report
+
+        """
+        self.finished.wait(timeout)
+        return self.report
+
+    def status(self):
+        with self.lock:
+            return dict(
+                job=self.id,
+                status="finished" if self.finished.is_set() else "running",
+                started=self.started,
+                ended=self.ended,
+                requirements=self.requirements,
+                files=self.files,
+                files_done=self.files_done,
+                report=dict((key, list(value)) for key, value in self.report.items()),
+            )
+
+class Warmup(object):
+    """Caches the packages named in requirements files using a pool of workers
+
+    :param package_cache: PackageCache to fill
+    :param workers: Number of concurrent workers
+    :param per_host: Maximum concurrent downloads from any one upstream host
+    :param max_jobs: Number of finished jobs to remember for status requests
+    :param artifact_filter: requirements.ArtifactFilter choosing which
+        files of each release to cache, defaults to sdists and pure
+        python wheels
+
+    """
+    def __init__(self, package_cache, workers=8, per_host=4, max_jobs=100, artifact_filter=None):
+        self.log = logging.getLogger("pypicache.warmup")
+        self.package_cache = package_cache
+        if artifact_filter is None:
+            artifact_filter = requirements.ArtifactFilter()
+        self.artifact_filter = artifact_filter
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.per_host = per_host
+        self.hosts = HostLimiter(per_host)
+        self.jobs = lru.LRUCache(max_entries=max_jobs)
+
+    def submit(self, job, func, *args):
+        job.add_task()
+        def run():
+            try:
+                func(job, *args)
+            except Exception:
+                self.log.exception("Error running {0} for job {1}".format(func.__name__, job.id))
+            finally:
+                job.task_done()
+        self.executor.submit(run)
+
+    def start(self, requirements_fp, include=None):
+        """Starts caching the packages in a requirements file
+
+        The file (and any -r includes) is read immediately, the packages
+        are fetched in the background.
+
+        :param include: Callable returning the lines of a -r include, or None
+        :returns: Job tracking the progress
+
+        """
+        job = Job()
+        self.jobs.set(job.id, job)
+        seen = set()
+        job.add_task()
+        for line, requirement in requirements.parse_requirements(requirements_fp, include=include):
+            self.log.debug("Examining requirement {0!r}".format(line))
+            if requirement is None:
+                self.log.debug("Don't know how to handle {0!r}".format(line))
+                job.record("unparseable", line)
+                continue
+            key = (requirement.name.lower(), requirement.version, tuple(requirement.hashes))
+            if key in seen:
+                continue
+            seen.add(key)
+            job.requirements += 1
+            self.submit(job, self.cache_requirement, requirement)
+        job.task_done()
+        return job
+
+    def run(self, requirements_fp, include=None):
+        """Caches the packages in a requirements file, waiting for them all
+
+        :returns: dict of cached, unparseable and failed entries
+
+        """
+        return self.start(requirements_fp, include=include).wait()
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cache_requirement(self, job, requirement):
+        try:
+            urls = self.artifact_filter.select(
+                self.package_cache.pypi.get_urls(requirement.name, requirement.version),
+                hashes=requirement.hashes,
+            )
+        except exceptions.PackageCacheError as e:
+            self.log.info("Failed to look up {0!r}: {1}".format(requirement.line, e))
+            job.record("failed", requirement.line)
+            return
+        for url in urls:
+            self.log.debug("Looking at {0!r}".format(url))
+            with job.lock:
+                job.files += 1
+            self.submit(job, self.cache_url, requirement, url)
+
+    def cache_url(self, job, requirement, url):
+        try:
+            with self.hosts.get(url.get("url") or self.package_cache.pypi.pypi_server):
+                self.package_cache.cache_file(
+                    requirement.name,
+                    url["filename"],
+                    python_version=None if url["packagetype"] == "sdist" else url.get("python_version"),
+                    url=url.get("url"),
+                    expected=digests.expected_digests(url),
+                )
+        except exceptions.PackageCacheError as e:
+            self.log.info("Failed to cache {0!r}: {1}".format(url["filename"], e))
+            job.record("failed", requirement.line)
+        else:
+            job.record("cached", url["filename"])
+        finally:
+            with job.lock:
+                job.files_done += 1
@@ -8,6 +8,11 @@ setup(
     author_email='mick@twomeylee.name',
     url='http://readthedocs.org/projects/pypicache/',
     packages=['pypicache'],
+    entry_points={
+        'console_scripts': [
+            'pypicache = pypicache.main:main',
+        ]
+    },
     package_data={
         'pypicache': [
             'static/*/*',
@@ -15,13 +20,21 @@ setup(
         ]
     },
     install_requires=[
-        'certifi==0.0.8',
-        'chardet==2.1.1',
+        'certifi==2018.1.18',
+        'chardet==3.0.4',
+        'click==6.7',
         'distribute==0.6.34',
-        'Flask==0.9',
-        'Jinja2==2.6',
-        'requests==1.1.0',
-        'Werkzeug==0.8.3',
+        'Flask==0.12.4',
+        'futures==3.2.0; python_version < "3"',
+        'idna==2.6',
+        'itsdangerous==0.24',
+        'Jinja2==2.10',
+        'MarkupSafe==1.0',
+        'packaging==20.9',
+        'pyparsing==2.4.7',
+        'requests==2.18.4',
+        'urllib3==1.22',
+        'Werkzeug==0.14.1',
     ]
     
 )
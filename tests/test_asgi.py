@@ -0,0 +1,219 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from pypicache import asgi
+from pypicache import cache
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import metrics
+from pypicache import pypi
+from pypicache import server
+from pypicache import simple
+
+def make_file(content):
+    fp = tempfile.TemporaryFile()
+    fp.write(content)
+    fp.seek(0)
+    return fp
+
+class Response(object):
+    def __init__(self, messages):
+        start = messages[0]
+        self.status = start["status"]
+        self.headers = dict((key.decode("latin-1"), value.decode("latin-1")) for key, value in start["headers"])
+        self.body = b"".join(message.get("body", b"") for message in messages[1:])
+
+    @property
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+class ConcurrentDownloadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.store = disk.DiskPackageStore(self.prefix)
+        self.cache = cache.PackageCache(self.store, self.mock_pypi)
+        self.app = asgi.AsyncApp(self.mock_pypi, self.store, self.cache, workers=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def test_waiters_dont_starve_the_download(self):
+        def slow_download(*args, **kwargs):
+            for chunk in (b"--package", b"-data--"):
+                time.sleep(0.1)
+                yield chunk
+        self.mock_pypi.get_file.side_effect = slow_download
+        async def fetch():
+            messages = []
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+            async def send(message):
+                messages.append(message)
+            scope = {"type": "http", "method": "GET", "path": "/packages/mypackage/mypackage-1.0.tar.gz", "query_string": b"", "headers": []}
+            await self.app(scope, receive, send)
+            return Response(messages).body
+        async def fetch_all():
+            return await asyncio.wait_for(asyncio.gather(*[fetch() for i in range(5)]), 10)
+        self.assertEqual(asyncio.run(fetch_all()), [b"--package-data--"] * 5)
+        self.assertEqual(self.mock_pypi.get_file.call_count, 1)
+
+class AsyncAppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_packagecache = mock.Mock(spec=cache.PackageCache)
+        self.mock_packagestore = mock.Mock(spec=disk.DiskPackageStore)
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.app = asgi.AsyncApp(self.mock_pypi, self.mock_packagestore, self.mock_packagecache, workers=2)
+
+    def request(self, path, method="GET", headers=(), body=b"", query_string=b""):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query_string,
+            "headers": [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers],
+        }
+        messages = []
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+        async def send(message):
+            messages.append(message)
+        asyncio.run(self.app(scope, receive, send))
+        return Response(messages)
+
+    def multipart(self, field, filename, content):
+        boundary = "----pypicacheboundary"
+        body = (
+            "--{0}\r\nContent-Disposition: form-data; name=\"{1}\"; filename=\"{2}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).format(boundary, field, filename).encode("latin-1") + content + "\r\n--{0}--\r\n".format(boundary).encode("latin-1")
+        return [("Content-Type", "multipart/form-data; boundary={0}".format(boundary))], body
+
+    def test_index(self):
+        response = self.request("/")
+        self.assertEqual(response.status, 200)
+        self.assertIn(b"PyPI Cache", response.body)
+
+    def test_static(self):
+        response = self.request("/static/css/bootstrap.css")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["content-type"], "text/css")
+        self.assertEqual(self.request("/static/../asgi.py").status, 404)
+
+    def test_simple_package(self):
+        page = simple.Page(b"<html>links</html>")
+        self.mock_packagecache.get_simple_page.return_value = page
+        response = self.request("/simple/mypackage/")
+        self.assertEqual(response.body, b"<html>links</html>")
+        response = self.request("/simple/mypackage/", headers=[("If-None-Match", '"{0}"'.format(page.etag))])
+        self.assertEqual(response.status, 304)
+        self.mock_packagecache.get_simple_page.side_effect = exceptions.NotFound("Unknown package")
+        self.assertEqual(self.request("/simple/missing/").status, 404)
+
+    def test_packages_cached(self):
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.request("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b"--package-data--")
+        self.assertEqual(response.headers["content-type"], "application/x-tar")
+        self.assertEqual(response.headers["content-length"], "16")
+        self.mock_packagecache.get_file.assert_called_with("mypackage", "mypackage-1.0.tar.gz", python_version=None, blocking=False)
+
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.request("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers=[("If-None-Match", response.headers["etag"])])
+        self.assertEqual(response.status, 304)
+
+    def test_metrics(self):
+        served = server.BYTES_SERVED.values.get((), 0)
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        self.request("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertEqual(server.BYTES_SERVED.values[()] - served, 16)
+        response = self.request("/metrics")
+        self.assertEqual(response.headers["content-type"], metrics.CONTENT_TYPE)
+        self.assertIn(
+            'pypicache_http_request_seconds_count{route="/packages/source/<firstletter>/<package>/<filename>",method="GET",status="200"}',
+            response.body.decode("utf-8"),
+        )
+
+    def test_packages_range(self):
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.request("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers=[("Range", "bytes=2-8")])
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.body, b"package")
+        self.assertEqual(response.headers["content-range"], "bytes 2-8/16")
+
+    def test_packages_zerocopysend(self):
+        fp = make_file(b"--package-data--")
+        self.mock_packagecache.get_file.return_value = fp
+        messages = []
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": "/packages/source/m/mypackage/mypackage-1.0.tar.gz",
+            "headers": [(b"range", b"bytes=2-8")],
+            "extensions": {"http.response.zerocopysend": {}},
+        }
+        async def send(message):
+            messages.append(message)
+        asyncio.run(self.app(scope, None, send))
+        self.assertEqual(messages[0]["status"], 206)
+        self.assertEqual(messages[1], {"type": "http.response.zerocopysend", "file": fp, "offset": 2, "count": 7})
+
+    def test_packages_streamed(self):
+        self.mock_packagecache.get_file.return_value = iter([b"--package", b"-data--"])
+        response = self.request("/packages/2.7/m/mypackage/mypackage-1.0-py2.7.egg")
+        self.assertEqual(response.body, b"--package-data--")
+        self.assertEqual(response.headers["content-type"], "application/zip")
+        self.mock_packagecache.get_file.assert_called_with("mypackage", "mypackage-1.0-py2.7.egg", python_version="2.7", blocking=False)
+
+    def test_packages_notfound(self):
+        self.mock_packagecache.get_file.side_effect = exceptions.NotFound("Unknown package")
+        self.assertEqual(self.request("/packages/source/m/mypackage/mypackage-1.1.tar.gz").status, 404)
+
+    def test_error_before_response(self):
+        self.mock_packagecache.get_file.side_effect = IOError("Disk went away")
+        self.assertEqual(self.request("/packages/source/m/mypackage/mypackage-1.0.tar.gz").status, 500)
+
+    def test_error_after_response_started(self):
+        def chunks():
+            yield b"--package"
+            raise IOError("Disk went away")
+        self.mock_packagecache.get_file.return_value = chunks()
+        messages = []
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+        async def send(message):
+            messages.append(message)
+        scope = {"type": "http", "method": "GET", "path": "/packages/source/m/mypackage/mypackage-1.0.tar.gz", "query_string": b"", "headers": []}
+        self.assertRaises(IOError, asyncio.run, self.app(scope, receive, send))
+        self.assertEqual([message["type"] for message in messages if message["type"] == "http.response.start"], ["http.response.start"])
+        self.assertEqual(messages[0]["status"], 200)
+
+    def test_post_package_file(self):
+        uploaded = []
+        self.mock_packagestore.find_package.return_value = None
+        self.mock_packagestore.add_file.side_effect = lambda package, filename, content, **kwargs: uploaded.append((package, filename, b"".join(content), kwargs))
+        headers, body = self.multipart("sdist", "mypackage-1.0.tar.gz", b"--package-data--")
+        response = self.request("/uploadpackage/", method="POST", headers=headers, body=body)
+        self.assertEqual(response.json, {"uploaded": "ok", "files": ["mypackage-1.0.tar.gz"]})
+        self.assertEqual(uploaded, [("mypackage", "mypackage-1.0.tar.gz", b"--package-data--", {"pinned": True, "expected": None})])
+
+    def test_post_missing_package_data(self):
+        response = self.request("/uploadpackage/", method="POST")
+        self.assertEqual(response.status, 400)
+        self.assertEqual(response.json, {"error": True, "message": "Missing package data."})
+
+    def test_post_requirements_txt(self):
+        self.mock_packagecache.cache_requirements_txt.return_value = {"processed": "requirements"}
+        headers, body = self.multipart("requirements", "requirements.txt", b"mypackage==1.0")
+        response = self.request("/requirements.txt", method="POST", headers=headers, body=body)
+        self.assertEqual(response.json, {"processed": "requirements"})
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.request("/uploadpackage/").status, 405)
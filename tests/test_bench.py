@@ -0,0 +1,38 @@
+import hashlib
+import unittest
+
+from pypicache import bench
+
+class PercentileTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 0.5), 50)
+        self.assertEqual(bench.percentile(values, 0.99), 99)
+        self.assertEqual(bench.percentile([3], 0.99), 3)
+        self.assertIsNone(bench.percentile([], 0.5))
+
+class FakeUpstreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.package = bench.FakePackage("mypackage", "1.0", 100000)
+        self.upstream = bench.FakeUpstream([self.package]).start()
+
+    def tearDown(self):
+        self.upstream.stop()
+
+    def test_pip_install(self):
+        load = bench.LoadGenerator(2)
+        result = load.run([bench.pip_install(self.upstream.url, "mypackage"), bench.pip_install(self.upstream.url, "missing")])
+        self.assertEqual((result["requests"], result["errors"]), (3, 1))
+        self.assertGreater(result["bytes"], 100000)
+        self.assertEqual(self.upstream.stats(), dict(simple=1, json=0, files=1, bytes=100000, not_found=1))
+
+    def test_file_content(self):
+        load = bench.LoadGenerator(1)
+        body = load.get("{0}packages/source/m/mypackage/mypackage-1.0.tar.gz".format(self.upstream.url))
+        self.assertEqual(hashlib.sha256(body).hexdigest(), self.package.sha256)
+
+    def test_json(self):
+        load = bench.LoadGenerator(1)
+        body = load.get("{0}pypi/mypackage/1.0/json".format(self.upstream.url))
+        self.assertIn(self.package.sha256.encode("ascii"), body)
+        self.assertIsNone(load.get("{0}pypi/mypackage/2.0/json".format(self.upstream.url)))
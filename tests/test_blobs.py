@@ -0,0 +1,90 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import blobs
+from pypicache import disk
+from pypicache import exceptions
+
+class BlobStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp("pypicache")
+        self.blob_store = blobs.BlobStore(os.path.join(self.root, "blobs"))
+        self.store = disk.DiskPackageStore(os.path.join(self.root, "packages"), blob_store=self.blob_store)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def blob_path(self, content):
+        return self.blob_store.get_path(hashlib.sha256(content).hexdigest())
+
+    def test_add_file_links_blob(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.store.add_file("MyPackage", "MyPackage-1.0.tar.gz", b"--package-data--")
+        blob_path = self.blob_path(b"--package-data--")
+        for package, filename in [("mypackage", "mypackage-1.0.tar.gz"), ("MyPackage", "MyPackage-1.0.tar.gz")]:
+            self.assertTrue(os.path.samefile(self.store.get_file_path(package, filename), blob_path))
+        self.assertEqual(len(list(self.blob_store.iter_blob_paths())), 1)
+        self.assertEqual(os.stat(blob_path).st_nlink, 3)
+        self.assertEqual(os.listdir(os.path.join(self.blob_store.root, "tmp")), [])
+
+    def test_abandoned_write_leaves_nothing(self):
+        chunks = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", [b"--package", b"-data--"])
+        next(chunks)
+        chunks.close()
+        self.assertEqual(list(self.blob_store.iter_blob_paths()), [])
+        self.assertEqual(os.listdir(os.path.join(self.blob_store.root, "tmp")), [])
+
+    def test_blob_released_while_adding(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        make_link = blobs.make_link
+        def release_first(source, path, replace=True):
+            # The only other file with the content goes just before we link
+            if not released:
+                released.append(source)
+                self.assertTrue(self.store.remove_file("mypackage", "mypackage-1.0.tar.gz"))
+            return make_link(source, path, replace)
+        released = []
+        with mock.patch.object(blobs, "make_link", side_effect=release_first):
+            self.store.add_file("mypackage", "mypackage-1.0.zip", b"--package-data--")
+        self.assertEqual(released, [self.blob_path(b"--package-data--")])
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.zip").read(), b"--package-data--")
+        self.assertEqual(os.stat(self.blob_path(b"--package-data--")).st_nlink, 2)
+        self.assertEqual(os.listdir(os.path.join(self.blob_store.root, "tmp")), [])
+
+    def test_not_overwriting_concurrent_write(self):
+        first = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", [b"--package", b"-data--"])
+        second = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", [b"--other", b"-data--"])
+        next(first)
+        next(second)
+        self.assertEqual(list(first), [b"-data--"])
+        self.assertRaises(exceptions.NotOverwritingError, list, second)
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+        self.assertEqual(os.listdir(os.path.join(self.blob_store.root, "tmp")), [])
+
+    def test_gc_removes_replaced_snapshots(self):
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--old-data--")
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--new-data--")
+        self.assertEqual(self.blob_store.gc(grace=0), (1, len(b"--old-data--")))
+        self.assertFalse(os.path.exists(self.blob_path(b"--old-data--")))
+        self.assertTrue(os.path.exists(self.blob_path(b"--new-data--")))
+
+    def test_migrate(self):
+        stores = [disk.DiskPackageStore(os.path.join(self.root, prefix)) for prefix in ("one", "two")]
+        for store in stores:
+            store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        stores[0].add_file("mypackage", "mypackage-1.0.zip", b"--package-data--")
+        results = []
+        for store in stores:
+            store.blob_store = self.blob_store
+            results.append(store.migrate_to_blobs())
+        self.assertEqual(results, [(2, len(b"--package-data--")), (1, len(b"--package-data--"))])
+        blob_path = self.blob_path(b"--package-data--")
+        self.assertEqual(os.stat(blob_path).st_nlink, 4)
+        # Running again changes nothing
+        self.assertEqual(stores[0].migrate_to_blobs(), (2, 0))
+        self.assertEqual(list(stores[0].list_files("mypackage"))[0]["sha256"], hashlib.sha256(b"--package-data--").hexdigest())
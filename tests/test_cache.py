@@ -1,9 +1,16 @@
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import mock
+import requests
 
 from pypicache import cache
 from pypicache import disk
+from pypicache import exceptions
+from pypicache import negative
 from pypicache import pypi
 
 class CacheTestCase(unittest.TestCase):
@@ -12,10 +19,164 @@ class CacheTestCase(unittest.TestCase):
         self.mock_packages = mock.Mock(spec=disk.DiskPackageStore)
         self.cache = cache.PackageCache(self.mock_packages, self.mock_pypi)
 
-    @unittest.skip("TODO")
     def test_get_sdist(self):
-        raise NotImplementedError()
+        cached = mock.Mock()
+        self.mock_packages.get_file.return_value = cached
+        self.assertIs(self.cache.get_file("mypackage", "mypackage-1.0.tar.gz"), cached)
+        self.assertFalse(self.mock_pypi.get_file.called)
+
+    def test_get_sdist_from_pypi(self):
+        self.mock_packages.get_file.side_effect = exceptions.NotFound("Not cached")
+        self.mock_pypi.get_file.return_value = iter([b"--package-data--"])
+        self.mock_packages.tee_file.return_value = iter([b"--package-data--"])
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(list(content), [b"--package-data--"])
+        self.mock_pypi.get_file.assert_called_with("mypackage", "mypackage-1.0.tar.gz", python_version=None, url=None)
+        self.mock_packages.tee_file.assert_called_with("mypackage", "mypackage-1.0.tar.gz", self.mock_pypi.get_file.return_value, expected=None)
+
+    def test_package_count_cached(self):
+        self.mock_packages.list_packages.return_value = ["apackage", "bpackage"]
+        for i in range(2):
+            gauges = dict((name, samples) for name, kind, help, samples in self.cache.collect_metrics())
+            self.assertEqual(gauges["pypicache_store_packages"], [({}, 2)])
+        self.assertEqual(self.mock_packages.list_packages.call_count, 1)
 
-    @unittest.skip("TODO")
     def test_cache_requirements_txt(self):
-        raise NotImplementedError()
+        def get_urls(package, version):
+            if package == "missing":
+                raise exceptions.NotFound("Unknown package")
+            return [
+                dict(packagetype="sdist", filename="{0}-{1}.tar.gz".format(package, version)),
+                dict(packagetype="bdist_egg", filename="{0}-{1}-py2.7.egg".format(package, version)),
+            ]
+        self.mock_pypi.get_urls.side_effect = get_urls
+        self.mock_pypi.pypi_server = "http://pypi.python.org/"
+        report = self.cache.cache_requirements_txt([
+            b"mypackage==1.0\n",
+            b"otherpackage==2.0\n",
+            b"mypackage==1.0\n",
+            b"missing==1.0\n",
+            b"relative>=1.0\n",
+        ])
+        self.assertEqual(sorted(report["cached"]), ["mypackage-1.0.tar.gz", "otherpackage-2.0.tar.gz"])
+        self.assertEqual(report["failed"], ["missing==1.0"])
+        self.assertEqual(report["unparseable"], ["relative>=1.0"])
+        self.assertEqual(self.mock_pypi.get_urls.call_count, 3)
+
+    def test_cache_requirements_txt_upstream_fails_mid_body(self):
+        self.mock_pypi.get_urls.return_value = [dict(packagetype="sdist", filename="mypackage-1.0.tar.gz")]
+        self.mock_pypi.pypi_server = "http://pypi.python.org/"
+        self.mock_packages.get_file.side_effect = exceptions.NotFound("Not cached")
+        response = mock.Mock()
+        response.url = "http://pypi.python.org/packages/mypackage-1.0.tar.gz"
+        def iter_content(chunk_size):
+            yield b"--package"
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+        response.iter_content.side_effect = iter_content
+        self.mock_pypi.get_file.return_value = pypi.iter_response(response)
+        self.mock_packages.tee_file.side_effect = lambda package, filename, content, expected: content
+        report = self.cache.cache_requirements_txt([b"mypackage==1.0\n"])
+        self.assertEqual(report["cached"], [])
+        self.assertEqual(report["failed"], ["mypackage==1.0"])
+        response.close.assert_called_once_with()
+
+    def test_start_requirements_txt(self):
+        self.mock_pypi.get_urls.return_value = [dict(packagetype="sdist", filename="mypackage-1.0.tar.gz")]
+        self.mock_pypi.pypi_server = "http://pypi.python.org/"
+        job = self.cache.start_requirements_txt([b"mypackage==1.0"])
+        job.wait(5)
+        status = self.cache.get_requirements_job(job.id)
+        self.assertEqual(status["status"], "finished")
+        self.assertEqual(status["files_done"], 1)
+        self.assertEqual(status["report"], {"cached": ["mypackage-1.0.tar.gz"], "unparseable": [], "failed": []})
+        self.assertRaises(exceptions.NotFound, self.cache.get_requirements_job, "unknown")
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.cache = cache.PackageCache(disk.DiskPackageStore(self.prefix), self.mock_pypi)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def test_concurrent_misses_fetch_once(self):
+        def slow_download(*args, **kwargs):
+            time.sleep(0.1)
+            return iter([b"--package", b"-data--"])
+        self.mock_pypi.get_file.side_effect = slow_download
+        results = []
+        def fetch():
+            content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz")
+            if hasattr(content, "read"):
+                results.append(content.read())
+                content.close()
+            else:
+                results.append(b"".join(content))
+        threads = [threading.Thread(target=fetch) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b"--package-data--"] * 10)
+        self.assertEqual(self.mock_pypi.get_file.call_count, 1)
+
+    def test_abandoned_download_releases_lock(self):
+        response = mock.Mock()
+        response.iter_content.return_value = iter([b"--package", b"-data--"])
+        self.mock_pypi.get_file.return_value = pypi.iter_response(response)
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz")
+        next(content)
+        content.close()
+        lock = self.cache.package_store.lock("mypackage", "mypackage-1.0.tar.gz")
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+        response.close.assert_called_once_with()
+
+class NegativeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.package_store = disk.DiskPackageStore(self.prefix)
+        self.negative_cache = negative.NegativeCache(ttl=60)
+        self.cache = cache.PackageCache(self.package_store, self.mock_pypi, negative_cache=self.negative_cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def test_missing_file(self):
+        self.mock_pypi.get_file.side_effect = exceptions.NotFound("Can't locate mypackage-1.0.tar.gz")
+        for i in range(3):
+            self.assertRaises(exceptions.NotFound, self.cache.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(self.mock_pypi.get_file.call_count, 1)
+        self.assertEqual(self.cache.stats()["misses"]["hits"], 2)
+
+        self.package_store.add_file("MyPackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        with self.cache.get_file("mypackage", "mypackage-1.0.tar.gz") as fp:
+            self.assertEqual(fp.read(), b"--package-data--")
+
+    def test_missing_file_keyed_by_location(self):
+        self.mock_pypi.get_file.side_effect = exceptions.NotFound("Can't locate mypackage-1.0.tar.gz")
+        self.assertRaises(exceptions.NotFound, self.cache.get_file, "mypackage", "mypackage-1.0.tar.gz", python_version="2.7")
+        self.assertRaises(exceptions.NotFound, self.cache.get_file, "mypackage", "mypackage-1.0.tar.gz", python_version="2.7")
+        self.assertEqual(self.mock_pypi.get_file.call_count, 1)
+
+        self.mock_pypi.get_file.side_effect = None
+        self.mock_pypi.get_file.return_value = iter([b"--package-data--"])
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz", python_version="source")
+        self.assertEqual(b"".join(content), b"--package-data--")
+        self.mock_pypi.get_file.side_effect = exceptions.NotFound("Can't locate mypackage-1.0.tar.gz")
+        self.package_store.remove_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertRaises(exceptions.NotFound, self.cache.get_file, "mypackage", "mypackage-1.0.tar.gz", python_version="2.7")
+
+        self.mock_pypi.get_file.side_effect = None
+        self.mock_pypi.get_file.return_value = iter([b"--package-data--"])
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz", python_version="2.7", url="https://mirror.example.com/mypackage-1.0.tar.gz")
+        self.assertEqual(b"".join(content), b"--package-data--")
+        self.assertEqual(self.mock_pypi.get_file.call_count, 4)
+
+    def test_missing_package_page(self):
+        self.mock_pypi.get_simple_package_info.side_effect = exceptions.NotFound("Unknown package")
+        for i in range(3):
+            self.assertRaises(exceptions.NotFound, self.cache.get_simple_page, "mypackage")
+        self.assertEqual(self.mock_pypi.get_simple_package_info.call_count, 1)
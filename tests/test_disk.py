@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import digests
+from pypicache import disk
+from pypicache import exceptions
+
+class DiskPackageStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.store = disk.DiskPackageStore(self.prefix)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def test_list_files_digests(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        files = list(self.store.list_files("mypackage"))
+        self.assertEqual(files, [dict(
+            package="mypackage",
+            firstletter="m",
+            filename="mypackage-1.0.tar.gz",
+            md5=hashlib.md5(b"--package-data--").hexdigest(),
+            sha256=hashlib.sha256(b"--package-data--").hexdigest(),
+        )])
+
+    def test_list_files_uses_index(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        with mock.patch.object(digests, "hash_file") as hash_file:
+            list(self.store.list_files("mypackage"))
+            list(self.store.list_files("mypackage"))
+        self.assertFalse(hash_file.called)
+
+    def test_list_files_rehashes_changed_file(self):
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--package-data--")
+        path = self.store.get_file_path("mypackage", "mypackage-1.0-dev.tar.gz")
+        with open(path, "wb") as fp:
+            fp.write(b"--changed-package-data--")
+        [info] = self.store.list_files("mypackage")
+        self.assertEqual(info["md5"], hashlib.md5(b"--changed-package-data--").hexdigest())
+
+    def test_get_file_different_case(self):
+        self.store.add_file("MyPackage", "MyPackage-1.0.tar.gz", b"--package-data--")
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-2.0.tar.gz")
+
+    def test_list_files_normalized_name(self):
+        self.store.add_file("My_Package", "My_Package-1.0.tar.gz", b"--package-data--")
+        self.assertEqual([f["filename"] for f in self.store.list_files("my-package")], ["My_Package-1.0.tar.gz"])
+        self.assertEqual(list(self.store.list_files("otherpackage")), [])
+
+    def test_list_packages(self):
+        self.store.add_file("zpackage", "zpackage-1.0.tar.gz", b"--package-data--")
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        self.assertEqual(self.store.list_packages(), ["apackage", "zpackage"])
+
+    def test_tee_file(self):
+        chunks = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", iter([b"--package", b"-data--"]))
+        self.assertEqual(next(chunks), b"--package")
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(list(chunks), [b"-data--"])
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+
+    def test_tee_file_abandoned(self):
+        chunks = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", iter([b"--package", b"-data--"]))
+        next(chunks)
+        chunks.close()
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(os.listdir(os.path.join(self.prefix, "tmp")), [])
+
+    def test_tee_file_corrupt(self):
+        expected = dict(sha256=hashlib.sha256(b"--package-data--").hexdigest())
+        chunks = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", iter([b"--package", b"-dat"]), expected=expected)
+        self.assertRaises(exceptions.CorruptFileError, list, chunks)
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(os.listdir(os.path.join(self.prefix, "tmp")), [])
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--", expected=expected)
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+
+    def test_quarantine_file(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.assertTrue(self.store.quarantine_file("mypackage", "mypackage-1.0.tar.gz", "bit rot"))
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(self.store.digests.lookup(os.path.join("packages", "m", "mypackage", "mypackage-1.0.tar.gz")), None)
+        quarantined = os.listdir(os.path.join(self.prefix, "quarantine", "packages", "m", "mypackage"))
+        self.assertEqual(len(quarantined), 1)
+        self.assertTrue(quarantined[0].startswith("mypackage-1.0.tar.gz."))
+        self.assertFalse(self.store.quarantine_file("mypackage", "mypackage-1.0.tar.gz", "bit rot"))
+
+    def test_lock_ignores_spelling(self):
+        lock = self.store.lock("Foo_Bar", "foo_bar-1.0.tar.gz")
+        self.assertTrue(lock.acquire(blocking=False))
+        self.assertFalse(self.store.lock("foo.bar", "foo_bar-1.0.tar.gz").acquire(blocking=False))
+        self.assertTrue(os.path.exists(lock.path))
+        lock.release()
+        self.assertFalse(os.path.exists(lock.path))
+        with self.store.lock("foo-bar", "foo_bar-1.0.tar.gz") as lock:
+            self.assertTrue(os.path.exists(lock.path))
+
+    def test_lock_replaced_while_waiting(self):
+        first = self.store.lock("mypackage", "mypackage-1.0.tar.gz")
+        first.acquire()
+        waiting = self.store.lock("mypackage", "mypackage-1.0.tar.gz")
+        real_flock = disk.fcntl.flock
+        calls = []
+        def flock(fd, flags):
+            # Let the first holder finish just as we get to the file
+            if not calls:
+                calls.append(fd)
+                first.release()
+            return real_flock(fd, flags)
+        with mock.patch.object(disk.fcntl, "flock", side_effect=flock):
+            self.assertTrue(waiting.acquire())
+        self.assertTrue(os.path.exists(waiting.path))
+        self.assertFalse(self.store.lock("mypackage", "mypackage-1.0.tar.gz").acquire(blocking=False))
+        waiting.release()
+
+    def test_add_file_not_overwriting(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.assertRaises(exceptions.NotOverwritingError, self.store.add_file, "mypackage", "mypackage-1.0.tar.gz", b"--other-data--")
+
+    def test_tee_file_not_overwriting_concurrent_write(self):
+        first = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", iter([b"--package", b"-data--"]))
+        second = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", iter([b"--other", b"-data--"]))
+        next(first)
+        next(second)
+        self.assertEqual(list(first), [b"-data--"])
+        self.assertRaises(exceptions.NotOverwritingError, list, second)
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+        self.assertEqual(os.listdir(os.path.join(self.prefix, "tmp")), [])
+
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--old-data--")
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--new-data--")
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0-dev.tar.gz").read(), b"--new-data--")
+
+    def test_rebuild_index(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.store.add_file("otherpackage", "otherpackage-1.0.tar.gz", b"--other-data--")
+        os.remove(os.path.join(self.prefix, "digests.sqlite"))
+        store = disk.DiskPackageStore(self.prefix)
+        self.assertEqual(store.rebuild_index(), 2)
+        with mock.patch.object(digests, "hash_file") as hash_file:
+            list(store.list_files("mypackage"))
+        self.assertFalse(hash_file.called)
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import disk
+from pypicache import eviction
+
+class ParseSizeTestCase(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(eviction.parse_size("100"), 100)
+        self.assertEqual(eviction.parse_size("2k"), 2048)
+        self.assertEqual(eviction.parse_size("1.5G"), 1536 * 1024 ** 2)
+        self.assertEqual(eviction.parse_size("10MiB"), 10 * 1024 ** 2)
+        self.assertRaises(ValueError, eviction.parse_size, "lots")
+
+class EvictionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.access_log = eviction.AccessLog(os.path.join(self.prefix, "access.sqlite"))
+        self.store = disk.DiskPackageStore(self.prefix, access_log=self.access_log)
+        for name in ("apackage", "bpackage", "cpackage"):
+            self.store.add_file(name, "{0}-1.0.tar.gz".format(name), b"0123456789")
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def read(self, package, times=1):
+        for i in range(times):
+            self.store.get_file(package, "{0}-1.0.tar.gz".format(package)).close()
+
+    def stored(self):
+        return sorted(os.path.basename(path) for path in self.store.iter_file_paths())
+
+    def test_accesses_batched(self):
+        self.read("apackage", 3)
+        self.assertEqual(self.access_log.get_all(), {})
+        self.assertEqual(self.access_log.flush(), 1)
+        hits, last_access, pinned = self.access_log.get_all()[os.path.join("packages", "a", "apackage", "apackage-1.0.tar.gz")]
+        self.assertEqual((hits, pinned), (3, False))
+        self.read("apackage")
+        self.access_log.flush()
+        self.assertEqual(self.access_log.get_all()[os.path.join("packages", "a", "apackage", "apackage-1.0.tar.gz")][0], 4)
+
+    def test_under_quota(self):
+        evictor = eviction.Evictor(self.store, 30)
+        self.assertEqual(evictor.run_once(), (0, 0))
+        self.assertEqual(evictor.stats()["size"], 30)
+
+    def test_lru(self):
+        with mock.patch.object(eviction.time, "time", side_effect=[3, 1, 2]):
+            self.read("apackage")
+            self.read("bpackage")
+            self.read("cpackage")
+        evictor = eviction.Evictor(self.store, 25, policy="lru")
+        self.assertEqual(evictor.run_once(), (1, 10))
+        self.assertEqual(self.stored(), ["apackage-1.0.tar.gz", "cpackage-1.0.tar.gz"])
+
+    def test_lfu(self):
+        self.read("apackage", 3)
+        self.read("bpackage", 1)
+        self.read("cpackage", 2)
+        evictor = eviction.Evictor(self.store, 25, policy="lfu", low_watermark=0.5)
+        self.assertEqual(evictor.run_once(), (2, 20))
+        self.assertEqual(self.stored(), ["apackage-1.0.tar.gz"])
+
+    def test_pinned_files_kept(self):
+        self.store.add_file("upload", "upload-1.0.tar.gz", b"0123456789", pinned=True)
+        evictor = eviction.Evictor(self.store, 5)
+        self.assertEqual(evictor.run_once(), (3, 30))
+        self.assertEqual(self.stored(), ["upload-1.0.tar.gz"])
+
+    def test_store_only_walked_when_over_quota(self):
+        evictor = eviction.Evictor(self.store, 45)
+        self.assertEqual(evictor.run_once(), (0, 0))
+        with mock.patch.object(self.store, "iter_file_paths") as iter_file_paths:
+            self.assertEqual(evictor.run_once(), (0, 0))
+        self.assertFalse(iter_file_paths.called)
+        self.assertEqual(evictor.stats()["size"], 30)
+        self.store.add_file("dpackage", "dpackage-1.0.tar.gz", b"0123456789")
+        self.store.add_file("epackage", "epackage-1.0.tar.gz", b"0123456789")
+        self.assertEqual(evictor.run_once(), (1, 10))
+        self.store.remove_file("epackage", "epackage-1.0.tar.gz")
+        self.assertEqual(evictor.run_once(), (0, 0))
+        self.assertEqual(evictor.stats()["size"], 30)
+
+    def test_remove_file_notifies_listeners(self):
+        listener = mock.Mock()
+        self.store.add_listener(listener)
+        self.assertTrue(self.store.remove_file("apackage", "apackage-1.0.tar.gz"))
+        listener.assert_called_with("apackage", "apackage-1.0.tar.gz")
+        self.assertFalse(self.store.remove_file("apackage", "apackage-1.0.tar.gz"))
+        self.assertEqual(list(self.store.list_files("apackage")), [])
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import cache
+from pypicache import disk
+from pypicache import hot
+from pypicache import pypi
+
+class HotFileCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.store = disk.DiskPackageStore(self.prefix)
+        for name in ("apackage", "bpackage", "cpackage"):
+            self.store.add_file(name, "{0}-1.0.tar.gz".format(name), b"0123456789")
+        self.hot_files = hot.HotFileCache(25, admit_hits=2)
+
+    def tearDown(self):
+        self.hot_files.clear()
+        shutil.rmtree(self.prefix)
+
+    def offer(self, package):
+        with self.store.get_file(package, "{0}-1.0.tar.gz".format(package)) as fp:
+            return self.hot_files.offer(package, "{0}-1.0.tar.gz".format(package), fp)
+
+    def test_admitted_after_hits(self):
+        self.assertIsNone(self.offer("apackage"))
+        self.assertIsNone(self.hot_files.get("apackage", "apackage-1.0.tar.gz"))
+        with self.offer("apackage") as fp:
+            self.assertEqual(fp.read(4), b"0123")
+        with self.hot_files.get("APackage", "APACKAGE-1.0.tar.gz") as fp:
+            fp.seek(-3, os.SEEK_END)
+            self.assertEqual(fp.read(), b"789")
+            self.assertEqual(os.fstat(fp.fileno()).st_size, 10)
+        stats = self.hot_files.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["admitted"]), (1, 1, 1))
+
+    def test_size_limit(self):
+        for package in ("apackage", "bpackage", "cpackage"):
+            self.offer(package)
+            self.offer(package).close()
+        self.assertEqual(list(self.hot_files.entries), [("bpackage", "bpackage-1.0.tar.gz"), ("cpackage", "cpackage-1.0.tar.gz")])
+        self.assertEqual(self.hot_files.stats()["evicted"], 1)
+
+    def test_evicted_while_reading(self):
+        self.offer("apackage")
+        fp = self.offer("apackage")
+        self.hot_files.invalidate("apackage", "apackage-1.0.tar.gz")
+        self.assertIsNone(self.hot_files.get("apackage", "apackage-1.0.tar.gz"))
+        self.assertEqual(fp.read(), b"0123456789")
+        fp.close()
+        self.assertTrue(fp.entry.mapping.closed)
+
+    def test_snapshots_not_admitted(self):
+        self.store.add_file("apackage", "apackage-1.0-dev.tar.gz", b"0123456789")
+        for i in range(3):
+            with self.store.get_file("apackage", "apackage-1.0-dev.tar.gz") as fp:
+                self.assertIsNone(self.hot_files.offer("apackage", "apackage-1.0-dev.tar.gz", fp))
+
+    def test_package_cache_tiers(self):
+        package_cache = cache.PackageCache(self.store, mock.Mock(spec=pypi.PyPI), hot_files=self.hot_files)
+        for i in range(3):
+            package_cache.get_file("apackage", "apackage-1.0.tar.gz").close()
+        self.assertEqual(package_cache.stats()["tiers"], dict(memory=1, disk=2, upstream=0))
+        self.store.remove_file("apackage", "apackage-1.0.tar.gz")
+        self.assertEqual(self.hot_files.stats()["entries"], 0)
@@ -0,0 +1,104 @@
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+
+from pypicache import launcher
+from pypicache import server
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def pid_app(environ, start_response):
+    if environ["PATH_INFO"] == "/slow":
+        time.sleep(1)
+    body = str(os.getpid()).encode("ascii")
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+
+def wait_for(func, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return func()
+        except Exception:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+class PooledWSGIServerTestCase(unittest.TestCase):
+    def test_serves_and_drains(self):
+        port = free_port()
+        server = launcher.PooledWSGIServer("127.0.0.1", port, pid_app, threads=2)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        results = []
+        slow = threading.Thread(target=lambda: results.append(requests.get("http://127.0.0.1:{0}/slow".format(port)).text))
+        slow.start()
+        self.assertEqual(requests.get("http://127.0.0.1:{0}/".format(port)).text, str(os.getpid()))
+        time.sleep(0.2)
+        server.shutdown()
+        thread.join()
+        self.assertTrue(server.drain(5))
+        slow.join()
+        server.server_close()
+        self.assertEqual(results, [str(os.getpid())])
+
+    def test_sendfile(self):
+        def sendfile_app(environ, start_response):
+            fp = tempfile.TemporaryFile()
+            fp.write(b"--package-data--")
+            fp.flush()
+            start_response("200 OK", [("Content-Type", "application/x-tar"), ("Content-Length", "7")])
+            return server.SendfileBody(environ["pypicache.sendfile"], fp, 2, 7)
+        port = free_port()
+        wsgi_server = launcher.PooledWSGIServer("127.0.0.1", port, sendfile_app, threads=1)
+        thread = threading.Thread(target=wsgi_server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(requests.get("http://127.0.0.1:{0}/".format(port)).content, b"package")
+        finally:
+            wsgi_server.shutdown()
+            thread.join()
+            wsgi_server.drain(5)
+            wsgi_server.server_close()
+
+class LauncherTestCase(unittest.TestCase):
+    def test_reload_and_stop(self):
+        port = free_port()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                launcher.Launcher(lambda: pid_app, host="127.0.0.1", port=port, workers=2, threads=2, graceful_timeout=5).run()
+            finally:
+                os._exit(0)
+        try:
+            uri = "http://127.0.0.1:{0}/".format(port)
+            first = wait_for(lambda: requests.get(uri).text)
+            self.assertNotEqual(first, str(pid))
+            results = []
+            slow = threading.Thread(target=lambda: results.append(requests.get(uri + "slow").status_code))
+            slow.start()
+            time.sleep(0.2)
+            os.kill(pid, signal.SIGHUP)
+            def new_worker():
+                response = requests.get(uri, headers={"Connection": "close"}).text
+                assert response != first
+                return response
+            wait_for(new_worker)
+            slow.join()
+            self.assertEqual(results, [200])
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertRaises(requests.ConnectionError, requests.get, "http://127.0.0.1:{0}/".format(port))
@@ -0,0 +1,80 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pypicache import metrics
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.requests = metrics.Counter("test_requests_total", "Requests", ["result"], registry=self.registry)
+        self.in_progress = metrics.Gauge("test_in_progress", "In progress", registry=self.registry)
+        self.seconds = metrics.Histogram("test_seconds", "Seconds", buckets=(0.1, 1), registry=self.registry)
+
+    def test_render(self):
+        self.requests.labels("hit").inc()
+        self.requests.labels("hit").inc(2)
+        self.requests.labels('mi"ss').inc()
+        self.in_progress.set(3)
+        self.in_progress.dec()
+        for value in (0.05, 0.5, 5):
+            self.seconds.observe(value)
+        self.registry.set_collector("test", lambda: [("test_packages", "gauge", "Packages", [({}, 7)])])
+        self.assertEqual(self.registry.render().splitlines(), [
+            "# HELP test_in_progress In progress",
+            "# TYPE test_in_progress gauge",
+            "test_in_progress 2",
+            "# HELP test_requests_total Requests",
+            "# TYPE test_requests_total counter",
+            'test_requests_total{result="hit"} 3',
+            'test_requests_total{result="mi\\"ss"} 1',
+            "# HELP test_seconds Seconds",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            "test_seconds_sum 5.55",
+            "test_seconds_count 3",
+            "# HELP test_packages Packages",
+            "# TYPE test_packages gauge",
+            "test_packages 7",
+        ])
+
+    def test_wrong_labels(self):
+        self.assertRaises(ValueError, self.requests.labels, "hit", "extra")
+
+    def test_shared_between_processes(self):
+        path = tempfile.mkdtemp("pypicache")
+        self.addCleanup(shutil.rmtree, path)
+        # A worker which has exited
+        with open(os.path.join(path, "999999999.json"), "w") as fp:
+            json.dump({
+                "test_requests_total": [[["hit"], 4]],
+                "test_in_progress": [[[], 5]],
+                "test_seconds": [[[], [[1, 0, 0], 0.05, 1]]],
+            }, fp)
+        self.registry.share(path)
+        self.requests.labels("hit").inc()
+        self.in_progress.inc()
+        self.seconds.observe(0.5)
+        lines = self.registry.render().splitlines()
+        self.assertIn('test_requests_total{result="hit"} 5', lines)
+        self.assertIn("test_in_progress 1", lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn("test_seconds_count 2", lines)
+        self.assertIn("{0}.json".format(os.getpid()), os.listdir(path))
+        self.registry.share(path, clear=True)
+        self.assertEqual(os.listdir(path), [])
+
+    def test_counted_chunks(self):
+        bytes_total = metrics.Counter("test_bytes_total", "Bytes", registry=self.registry)
+        chunks = metrics.CountedChunks(iter([b"abc", b"de"]), bytes_total, self.in_progress)
+        self.assertEqual(next(chunks), b"abc")
+        self.assertEqual(self.in_progress.values[()], 1)
+        self.assertEqual(list(chunks), [b"de"])
+        self.assertEqual(bytes_total.values[()], 5)
+        self.assertEqual(self.in_progress.values[()], 0)
+        chunks.close()
+        self.assertEqual(self.in_progress.values[()], 0)
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pypicache import names
+
+class NormalizeTestCase(unittest.TestCase):
+    def test_normalize(self):
+        for name in ["Foo.Bar", "foo_bar", "FOO--bar", "foo-_.bar"]:
+            self.assertEqual(names.normalize(name), "foo-bar")
+
+class PackageIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp("pypicache")
+        self.index = names.PackageIndex(self.root, refresh_interval=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, package, filename):
+        path = os.path.join(self.root, package[0], package)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        open(os.path.join(path, filename), "w").close()
+
+    def test_find_package(self):
+        self.make_file("My_Package", "My_Package-1.0.tar.gz")
+        self.assertEqual(self.index.find_package("my-package"), "My_Package")
+        self.assertEqual(self.index.find_package("mypackage"), None)
+
+    def test_find_file(self):
+        self.make_file("MyPackage", "MyPackage-1.0.tar.gz")
+        self.assertEqual(self.index.find_file("mypackage", "mypackage-1.0.tar.gz"), ("MyPackage", "MyPackage-1.0.tar.gz"))
+        self.assertEqual(self.index.find_file("mypackage", "mypackage-2.0.tar.gz"), None)
+
+    def test_picks_up_external_changes(self):
+        self.assertEqual(self.index.list_packages(), [])
+        self.make_file("zpackage", "zpackage-1.0.tar.gz")
+        self.make_file("apackage", "apackage-1.0.tar.gz")
+        self.assertEqual(self.index.list_packages(), ["apackage", "zpackage"])
+        self.make_file("zpackage", "zpackage-2.0.tar.gz")
+        self.assertEqual(self.index.find_file("ZPackage", "ZPACKAGE-2.0.tar.gz"), ("zpackage", "zpackage-2.0.tar.gz"))
+
+    def test_add(self):
+        index = names.PackageIndex(self.root, refresh_interval=3600)
+        self.assertEqual(index.list_packages(), [])
+        self.make_file("mypackage", "mypackage-1.0.tar.gz")
+        index.add("mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(index.list_packages(), ["mypackage"])
+        self.assertEqual(index.find_package("MyPackage"), "mypackage")
+
+    def test_query(self):
+        for package in ["Django", "django_extensions", "docutils", "flask", "DjangoRestFramework"]:
+            self.make_file(package, "{0}-1.0.tar.gz".format(package))
+        self.assertEqual(self.index.query(), ["Django", "django_extensions", "DjangoRestFramework", "docutils", "flask"])
+        self.assertEqual(self.index.query("DJANGO"), ["Django", "django_extensions", "DjangoRestFramework"])
+        self.assertEqual(self.index.query("django-"), ["django_extensions"])
+        self.assertEqual(self.index.query("django", offset=1, limit=1), ["django_extensions"])
+        self.assertEqual(self.index.query("django", offset=5), [])
+        self.assertEqual(self.index.query("zope"), [])
+
+    def test_fingerprint(self):
+        fingerprint = self.index.fingerprint()
+        self.assertEqual(self.index.fingerprint(), fingerprint)
+        self.make_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertNotEqual(self.index.fingerprint(), fingerprint)
+        self.assertEqual(names.PackageIndex(self.root).fingerprint(), self.index.fingerprint())
@@ -0,0 +1,37 @@
+import time
+import unittest
+
+from pypicache import negative
+
+class NegativeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.misses = negative.NegativeCache(ttl=60, max_entries=3)
+
+    def test_get(self):
+        self.assertIsNone(self.misses.get("file", "mypackage", "mypackage-1.0.tar.gz"))
+        self.misses.add("file", "mypackage", "mypackage-1.0.tar.gz", "Not found")
+        self.assertEqual(self.misses.get("file", "MyPackage", "MYPACKAGE-1.0.tar.gz"), "Not found")
+        self.assertIsNone(self.misses.get("page", "mypackage", "mypackage-1.0.tar.gz"))
+
+    def test_expiry(self):
+        self.misses.add("page", "mypackage", message="Not found")
+        self.misses.items[("page", "mypackage", "")] = (time.time() - 1, "Not found")
+        self.assertIsNone(self.misses.get("page", "mypackage"))
+        self.assertEqual(self.misses.stats()["entries"], 0)
+
+    def test_bounded(self):
+        for name in ("a", "b", "c", "d"):
+            self.misses.add("page", name)
+        self.assertIsNone(self.misses.get("page", "a"))
+        self.assertEqual(self.misses.get("page", "d"), "")
+        self.assertEqual(sorted(self.misses.packages), ["b", "c", "d"])
+
+    def test_invalidate(self):
+        self.misses.add("page", "mypackage")
+        self.misses.add("file", "mypackage", "mypackage-1.0.tar.gz")
+        self.misses.add("page", "otherpackage")
+        self.misses.invalidate("MyPackage", "mypackage-2.0.tar.gz")
+        self.assertIsNone(self.misses.get("page", "mypackage"))
+        self.assertIsNone(self.misses.get("file", "mypackage", "mypackage-1.0.tar.gz"))
+        self.assertEqual(self.misses.get("page", "otherpackage"), "")
+        self.assertEqual(self.misses.stats()["invalidated"], 2)
@@ -0,0 +1,67 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+
+from pypicache import exceptions
+from pypicache import pages
+from pypicache import pypi
+
+def make_response(content, status_code=200, etag='"abc"'):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.content = content
+    response.headers = {"ETag": etag, "Last-Modified": "Sat, 01 Jan 2000 00:00:00 GMT"}
+    return response
+
+class PageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.pages = pages.PageCache(self.mock_pypi, self.prefix, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def expire(self, page_cache):
+        for key, (expires, page) in page_cache.memory.items.items():
+            page["fetched"] = time.time() - 3600
+
+    def test_fresh_page_served_from_cache(self):
+        self.mock_pypi.get_simple_package_page.return_value = make_response(b"<html>links</html>")
+        self.assertEqual(self.pages.get("MyPackage"), b"<html>links</html>")
+        self.assertEqual(self.pages.get("mypackage"), b"<html>links</html>")
+        self.assertEqual(self.mock_pypi.get_simple_package_page.call_count, 1)
+        self.assertEqual(self.pages.stats()["hits"], 1)
+        self.assertEqual(self.pages.stats()["misses"], 1)
+
+    def test_page_persisted_to_disk(self):
+        self.mock_pypi.get_simple_package_page.return_value = make_response(b"<html>links</html>")
+        self.pages.get("mypackage")
+        other = pages.PageCache(self.mock_pypi, self.prefix, ttl=60)
+        self.assertEqual(other.get("mypackage"), b"<html>links</html>")
+        self.assertEqual(self.mock_pypi.get_simple_package_page.call_count, 1)
+
+    def test_revalidate(self):
+        self.mock_pypi.get_simple_package_page.return_value = make_response(b"<html>links</html>")
+        self.pages.get("mypackage")
+        self.expire(self.pages)
+        self.mock_pypi.get_simple_package_page.return_value = make_response(b"", status_code=304)
+        self.assertEqual(self.pages.get("mypackage"), b"<html>links</html>")
+        self.mock_pypi.get_simple_package_page.assert_called_with(
+            "mypackage", "", etag='"abc"', last_modified="Sat, 01 Jan 2000 00:00:00 GMT")
+        self.assertEqual(self.pages.stats()["revalidated"], 1)
+
+    def test_stale_on_error(self):
+        self.mock_pypi.get_simple_package_page.return_value = make_response(b"<html>links</html>")
+        self.pages.get("mypackage")
+        self.expire(self.pages)
+        self.mock_pypi.get_simple_package_page.side_effect = exceptions.RemoteError("PyPI is down")
+        self.assertEqual(self.pages.get("mypackage"), b"<html>links</html>")
+        self.assertEqual(self.pages.stats()["stale"], 1)
+
+    def test_error_without_cached_page(self):
+        self.mock_pypi.get_simple_package_page.side_effect = exceptions.RemoteError("PyPI is down")
+        self.assertRaises(exceptions.RemoteError, self.pages.get, "mypackage")
@@ -0,0 +1,84 @@
+import threading
+import unittest
+
+import mock
+import requests
+
+from pypicache import bench
+from pypicache import exceptions
+from pypicache import pypi
+
+class HTTPPoolTestCase(unittest.TestCase):
+    def test_session_per_thread(self):
+        pool = pypi.HTTPPool()
+        sessions = []
+        thread = threading.Thread(target=lambda: sessions.append(pool.session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(sessions[0], pool.session)
+        self.assertIs(sessions[0].get_adapter("http://example.com/"), pool.session.get_adapter("http://example.com/"))
+
+    def test_retry_configuration(self):
+        pool = pypi.HTTPPool(pool_size=4, retries=5, backoff=2.0)
+        retry = pool.adapter.max_retries
+        self.assertEqual(retry.total, 5)
+        self.assertEqual(retry.backoff_factor, 2.0)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertEqual(pool.stats(), [])
+
+    def test_get_uri_timeout(self):
+        pool = pypi.HTTPPool(connect_timeout=1.0, read_timeout=2.0)
+        with mock.patch.object(requests.Session, "get") as get:
+            get.return_value.status_code = 200
+            pool.get_uri("http://example.com/")
+        get.assert_called_with("http://example.com/", stream=False, headers=None, timeout=(1.0, 2.0))
+
+    def test_get_uri_connection_error(self):
+        pool = pypi.HTTPPool()
+        with mock.patch.object(requests.Session, "get") as get:
+            get.side_effect = requests.ConnectionError("refused")
+            self.assertRaises(exceptions.RemoteError, pool.get_uri, "http://example.com/")
+
+class ProjectMetadataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upstream = bench.FakeUpstream([
+            bench.FakePackage("mypackage", "1.0", 10),
+            bench.FakePackage("mypackage", "1.10", 10),
+            bench.FakePackage("mypackage", "1.9", 10),
+            bench.FakePackage("otherpackage", "2.0", 10),
+        ]).start()
+        self.pypi = pypi.PyPI(pypi_server=self.upstream.url)
+
+    def tearDown(self):
+        self.upstream.stop()
+
+    def test_one_request_per_project(self):
+        self.assertEqual(self.pypi.get_versions("mypackage"), ["1.10", "1.9", "1.0"])
+        self.assertEqual([url["filename"] for url in self.pypi.get_urls("MyPackage", "1.9")], ["mypackage-1.9.tar.gz"])
+        self.assertEqual(self.upstream.stats()["json"], 1)
+        self.assertEqual(self.pypi.stats()["metadata"], dict(hits=1, misses=1, entries=1))
+
+    def test_yanked_versions(self):
+        releases = {"1.0": [dict(yanked=False)], "1.1": [dict(yanked=True)], "1.2": []}
+        with mock.patch.object(self.pypi.metadata, "get", return_value=dict(name="mypackage", releases=releases)):
+            self.assertEqual(self.pypi.get_versions("mypackage"), ["1.2", "1.0"])
+            self.assertEqual(self.pypi.get_versions("mypackage", include_yanked=True), ["1.2", "1.1", "1.0"])
+
+    def test_unknown_version_refetches(self):
+        self.pypi.get_versions("mypackage")
+        self.assertRaises(exceptions.NotFound, self.pypi.get_urls, "mypackage", "3.0")
+        self.assertEqual(self.upstream.stats()["json"], 2)
+        self.assertRaises(exceptions.NotFound, self.pypi.get_urls, "missing", "1.0")
+
+    def test_get_many(self):
+        found = self.pypi.get_many_releases(["mypackage", "otherpackage", "missing"])
+        self.assertEqual(sorted(found["otherpackage"]), ["2.0"])
+        self.assertEqual(len(found["mypackage"]), 3)
+        self.assertIsInstance(found["missing"], exceptions.NotFound)
+        self.assertEqual(self.upstream.stats()["json"], 2)
+
+    def test_expiry(self):
+        self.pypi.metadata.projects.ttl = -1
+        self.pypi.get_releases("mypackage")
+        self.pypi.get_releases("mypackage")
+        self.assertEqual(self.upstream.stats()["json"], 2)
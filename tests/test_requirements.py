@@ -0,0 +1,72 @@
+import unittest
+
+from pypicache import requirements
+
+class ParseRequirementsTestCase(unittest.TestCase):
+    def parse(self, lines, include=None):
+        return list(requirements.parse_requirements(lines, include=include))
+
+    def test_pinned(self):
+        [(line, requirement)] = self.parse(["MyPackage==1.0\n"])
+        self.assertEqual((requirement.name, requirement.version), ("MyPackage", "1.0"))
+
+    def test_extras_markers_and_hashes(self):
+        [(line, requirement)] = self.parse([
+            'mypackage[security,socks]==1.0 ; python_version < "3" \\\n',
+            "    --hash=sha256:abcd --hash=sha256:ef01  # a comment\n",
+        ])
+        self.assertEqual(requirement.extras, ["security", "socks"])
+        self.assertEqual(requirement.marker, 'python_version < "3"')
+        self.assertEqual(requirement.hashes, ["sha256:abcd", "sha256:ef01"])
+
+    def test_unparseable(self):
+        results = self.parse(["# comment\n", "\n", "relative>=1.0\n", "-e git+https://example.com/repo.git\n", "wild==1.*\n"])
+        self.assertEqual(results, [
+            ("relative>=1.0", None),
+            ("-e git+https://example.com/repo.git", None),
+            ("wild==1.*", None),
+        ])
+
+    def test_includes(self):
+        files = {
+            "base.txt": ["basepackage==1.0\n", "-r requirements.txt\n"],
+        }
+        results = self.parse(["mypackage==1.0\n", "-r base.txt\n", "-r missing.txt\n"], include=files.get)
+        self.assertEqual([(line, r and r.name) for line, r in results], [
+            ("mypackage==1.0", "mypackage"),
+            ("basepackage==1.0", "basepackage"),
+            ("-r requirements.txt", None),
+            ("-r missing.txt", None),
+        ])
+
+class ArtifactFilterTestCase(unittest.TestCase):
+    urls = [
+        dict(packagetype="sdist", filename="mypackage-1.0.tar.gz", digests=dict(sha256="aaaa")),
+        dict(packagetype="bdist_wheel", filename="mypackage-1.0-py2.py3-none-any.whl", digests=dict(sha256="bbbb")),
+        dict(packagetype="bdist_wheel", filename="mypackage-1.0-cp311-cp311-manylinux_2_17_x86_64.whl", digests=dict(sha256="cccc")),
+        dict(packagetype="bdist_wheel", filename="mypackage-1.0-cp311-cp311-win_amd64.whl", digests=dict(sha256="dddd")),
+        dict(packagetype="bdist_egg", filename="mypackage-1.0-py2.7.egg", digests=dict(sha256="eeee")),
+    ]
+
+    def filenames(self, artifact_filter, hashes=None):
+        return [url["filename"] for url in artifact_filter.select(self.urls, hashes=hashes)]
+
+    def test_default(self):
+        self.assertEqual(self.filenames(requirements.ArtifactFilter()), [
+            "mypackage-1.0.tar.gz",
+            "mypackage-1.0-py2.py3-none-any.whl",
+        ])
+
+    def test_platform_patterns(self):
+        artifact_filter = requirements.ArtifactFilter(
+            python_tags=requirements.parse_patterns("cp311"),
+            abis=requirements.parse_patterns("*"),
+            platforms=requirements.parse_patterns("manylinux*"),
+            sdist=False,
+        )
+        self.assertEqual(self.filenames(artifact_filter), ["mypackage-1.0-cp311-cp311-manylinux_2_17_x86_64.whl"])
+
+    def test_hashes(self):
+        self.assertEqual(self.filenames(requirements.ArtifactFilter(), hashes=["sha256:bbbb"]), [
+            "mypackage-1.0-py2.py3-none-any.whl",
+        ])
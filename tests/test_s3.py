@@ -0,0 +1,173 @@
+import datetime
+import hashlib
+import io
+import unittest
+
+from pypicache import exceptions
+from pypicache import s3
+
+class ClientError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.response = {"Error": {"Code": code}}
+
+def etag(body):
+    return '"{0}"'.format(hashlib.md5(body).hexdigest())
+
+class FakeS3Client(object):
+    """Just enough of boto3's S3 client, keeping objects in memory
+
+    """
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append("head_object")
+        if Key not in self.objects:
+            raise ClientError("404")
+        body, metadata = self.objects[Key]
+        return dict(ContentLength=len(body), LastModified=datetime.datetime(2020, 1, 1), ETag=etag(body), Metadata=dict(metadata))
+
+    def get_object(self, Bucket, Key):
+        self.calls.append("get_object")
+        if Key not in self.objects:
+            raise ClientError("NoSuchKey")
+        return dict(Body=io.BytesIO(self.objects[Key][0]))
+
+    def put_object(self, Bucket, Key, Body, Metadata):
+        self.calls.append("put_object")
+        self.objects[Key] = (Body, Metadata)
+
+    def delete_object(self, Bucket, Key):
+        self.calls.append("delete_object")
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key, Metadata):
+        self.calls.append("create_multipart_upload")
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = ({}, Metadata)
+        return dict(UploadId=upload_id)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.calls.append("upload_part")
+        self.uploads[UploadId][0][PartNumber] = Body
+        return dict(ETag="etag-{0}".format(PartNumber))
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append("complete_multipart_upload")
+        parts, metadata = self.uploads.pop(UploadId)
+        body = b"".join(parts[part["PartNumber"]] for part in MultipartUpload["Parts"])
+        self.objects[Key] = (body, metadata)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append("abort_multipart_upload")
+        del self.uploads[UploadId]
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, ContinuationToken=None):
+        self.calls.append("list_objects_v2")
+        found = set()
+        for key in self.objects:
+            if key.startswith(Prefix):
+                rest = key[len(Prefix):]
+                if Delimiter in rest:
+                    found.add((rest.split(Delimiter)[0] + Delimiter, True))
+                else:
+                    found.add((rest, False))
+        found = sorted(found)
+        # One entry per page, to exercise continuation
+        start = int(ContinuationToken or 0)
+        response = dict(IsTruncated=start + 1 < len(found), NextContinuationToken=str(start + 1))
+        for name, is_dir in found[start:start + 1]:
+            if is_dir:
+                response["CommonPrefixes"] = [dict(Prefix=Prefix + name)]
+            else:
+                response["Contents"] = [dict(Key=Prefix + name, ETag=etag(self.objects[Prefix + name][0]))]
+        return response
+
+class S3PackageStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.store = s3.S3PackageStore("bucket", prefix="cache/", client=self.client, part_size=s3.MIN_PART_SIZE)
+
+    def test_small_file(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        body, metadata = self.client.objects["cache/packages/m/mypackage/mypackage-1.0.tar.gz"]
+        self.assertEqual(body, b"--package-data--")
+        self.assertEqual(metadata["sha256"], hashlib.sha256(b"--package-data--").hexdigest())
+        self.assertNotIn("create_multipart_upload", self.client.calls)
+        self.assertEqual(b"".join(self.store.get_file("MyPackage", "MyPackage-1.0.tar.gz")), b"--package-data--")
+        stat = self.store.stat("mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual((stat["size"], stat["md5"]), (16, hashlib.md5(b"--package-data--").hexdigest()))
+
+    def test_multipart(self):
+        chunks = [b"a" * s3.MIN_PART_SIZE, b"b" * s3.MIN_PART_SIZE, b"c"]
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", chunks)
+        self.assertEqual(self.client.calls.count("upload_part"), 3)
+        body, metadata = self.client.objects["cache/packages/m/mypackage/mypackage-1.0.tar.gz"]
+        self.assertEqual(body, b"".join(chunks))
+        self.assertEqual(metadata["md5"], hashlib.md5(body).hexdigest())
+
+    def test_multipart_with_expected_digests(self):
+        chunks = [b"a" * s3.MIN_PART_SIZE, b"b"]
+        expected = dict(md5=hashlib.md5(b"".join(chunks)).hexdigest(), sha256=hashlib.sha256(b"".join(chunks)).hexdigest())
+        written = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", chunks, expected=expected)
+        next(written)
+        # Streamed straight through, with the digests from the start
+        self.assertEqual(self.client.calls, ["head_object", "create_multipart_upload", "upload_part"])
+        self.assertEqual(list(written), [b"b"])
+        self.assertEqual(self.client.objects["cache/packages/m/mypackage/mypackage-1.0.tar.gz"], (b"".join(chunks), expected))
+
+    def test_abandoned_multipart_aborted(self):
+        chunks = [b"a" * s3.MIN_PART_SIZE, b"b"]
+        expected = dict(md5=hashlib.md5(b"".join(chunks)).hexdigest(), sha256=hashlib.sha256(b"".join(chunks)).hexdigest())
+        written = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", chunks, expected=expected)
+        next(written)
+        written.close()
+        self.assertIn("abort_multipart_upload", self.client.calls)
+        self.assertEqual((self.client.objects, self.client.uploads), ({}, {}))
+
+    def test_corrupt_multipart_aborted(self):
+        chunks = [b"a" * s3.MIN_PART_SIZE, b"b"]
+        written = self.store.tee_file("mypackage", "mypackage-1.0.tar.gz", chunks, expected=dict(md5="0" * 32, sha256="0" * 64))
+        self.assertRaises(exceptions.CorruptFileError, list, written)
+        self.assertNotIn("complete_multipart_upload", self.client.calls)
+        self.assertEqual((self.client.objects, self.client.uploads), ({}, {}))
+
+    def test_not_overwriting(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.assertRaises(exceptions.NotOverwritingError, self.store.add_file, "mypackage", "mypackage-1.0.tar.gz", b"--new-data--")
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--package-data--")
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--new-data--")
+
+    def test_listing(self):
+        for package in ("Django", "django-extensions", "requests"):
+            self.store.add_file(package, "{0}-1.0.tar.gz".format(package), b"--package-data--")
+        self.assertEqual(self.store.list_packages(), ["Django", "django-extensions", "requests"])
+        self.assertEqual(self.store.list_packages(prefix="django", offset=1), ["django-extensions"])
+        self.assertEqual(self.store.find_package("DJANGO"), "Django")
+        self.assertEqual(self.store.list_filenames("Django"), ["Django-1.0.tar.gz"])
+        self.assertEqual([info["filename"] for info in self.store.list_files("django")], ["Django-1.0.tar.gz"])
+        etag = self.store.packages_etag()
+        self.assertTrue(self.store.remove_file("requests", "requests-1.0.tar.gz"))
+        self.assertEqual(self.store.list_packages(), ["Django", "django-extensions"])
+        self.assertNotEqual(self.store.packages_etag(), etag)
+
+    def test_list_files_caches_digests(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--package-data--")
+        self.assertEqual(list(self.store.list_files("mypackage"))[1]["sha256"], hashlib.sha256(b"--package-data--").hexdigest())
+        del self.client.calls[:]
+        self.store.listings.clear()
+        list(self.store.list_files("mypackage"))
+        self.assertNotIn("head_object", self.client.calls)
+        # Replaced snapshots get an ETag of their own
+        self.store.add_file("mypackage", "mypackage-1.0-dev.tar.gz", b"--new-data--")
+        files = dict((info["filename"], info) for info in self.store.list_files("mypackage"))
+        self.assertEqual(files["mypackage-1.0-dev.tar.gz"]["sha256"], hashlib.sha256(b"--new-data--").hexdigest())
+
+    def test_missing_file(self):
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertRaises(exceptions.NotFound, self.store.stat, "mypackage", "mypackage-1.0.tar.gz")
+        self.assertFalse(self.store.remove_file("mypackage", "mypackage-1.0.tar.gz"))
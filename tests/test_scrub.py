@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from pypicache import blobs
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import scrub
+
+class ScrubberTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp("pypicache")
+        self.blob_store = blobs.BlobStore(os.path.join(self.root, "blobs"))
+        self.store = disk.DiskPackageStore(os.path.join(self.root, "packages"), blob_store=self.blob_store)
+        self.scrubber = scrub.Scrubber(self.store)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def corrupt(self, package, filename, content):
+        """Changes a file's content behind the store's back, keeping its mtime
+
+        """
+        path = self.store.get_file_path(package, filename)
+        stat = os.stat(path)
+        os.chmod(path, 0o644)
+        with open(path, "r+b") as fp:
+            fp.write(content)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+
+    def test_scrub(self):
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        self.store.add_file("bpackage", "bpackage-1.0.tar.gz", b"--other-data--")
+        self.corrupt("apackage", "apackage-1.0.tar.gz", b"--rotten")
+        self.assertEqual(self.scrubber.run_once(), [("apackage", "apackage-1.0.tar.gz")])
+        self.assertEqual(self.scrubber.stats()["corrupt"], 1)
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "apackage", "apackage-1.0.tar.gz")
+        self.assertEqual(self.store.get_file("bpackage", "bpackage-1.0.tar.gz").read(), b"--other-data--")
+        # A fresh download doesn't link to the rotten blob
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        self.assertEqual(self.store.get_file("apackage", "apackage-1.0.tar.gz").read(), b"--package-data--")
+        self.assertEqual(self.scrubber.run_once(), [])
+
+    def test_unrecorded_files_are_recorded(self):
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        key = os.path.join("packages", "a", "apackage", "apackage-1.0.tar.gz")
+        self.store.digests.remove(key)
+        self.assertEqual(self.scrubber.run_once(), [])
+        self.assertEqual(self.store.digests.lookup(key)["size"], 16)
+
+    def test_skips_files_being_written(self):
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        self.corrupt("apackage", "apackage-1.0.tar.gz", b"--rotten")
+        with self.store.lock("apackage", "apackage-1.0.tar.gz"):
+            self.assertEqual(self.scrubber.run_once(), [])
+        self.assertEqual(self.scrubber.stats()["files"], 0)
@@ -2,14 +2,24 @@ import unittest
 
 import logging
 import mock
+import shutil
+import tempfile
 
 from webtest import TestApp
 
 from pypicache import cache
 from pypicache import disk
 from pypicache import exceptions
+from pypicache import metrics
 from pypicache import pypi
 from pypicache import server
+from pypicache import simple
+
+def make_file(content):
+    fp = tempfile.TemporaryFile()
+    fp.write(content)
+    fp.seek(0)
+    return fp
 
 class ServerTestCase(unittest.TestCase):
     def setUp(self):
@@ -29,11 +39,58 @@ class ServerTestCase(unittest.TestCase):
         response = self.app.get("/simple")
         self.assertIn(b"simple", response.body)
 
+    def test_simple_root(self):
+        self.mock_packagecache.get_simple_root.return_value = simple.Page(b"<html>mypackage</html>")
+        response = self.app.get("/simple/")
+        self.assertEqual(response.body, b"<html>mypackage</html>")
+        self.mock_packagecache.get_simple_root.assert_called_with(simple.HTML)
+
     def test_simple_package(self):
-        content = """<html><a href="mypackage">mypackage-1.0</a></html>"""
-        self.mock_pypi.get_simple_package_info.return_value = content
+        content = b"""<html><a href="mypackage">mypackage-1.0</a></html>"""
+        self.mock_packagecache.get_simple_page.return_value = simple.Page(content)
         response = self.app.get("/simple/mypackage/")
         self.assertEqual(response.body, content)
+        self.mock_packagecache.get_simple_page.assert_called_with("mypackage", "", simple.HTML)
+        self.app.get("/simple/mypackage/", headers={"If-None-Match": response.headers["ETag"]}, status=304)
+
+    def test_simple_package_json(self):
+        self.mock_packagecache.get_simple_page.return_value = simple.Page(b"{}", content_type=simple.JSON_V1)
+        response = self.app.get("/simple/mypackage/", headers={
+            "Accept": "application/vnd.pypi.simple.v1+json, text/html;q=0.01",
+            "Accept-Encoding": "gzip",
+        })
+        self.mock_packagecache.get_simple_page.assert_called_with("mypackage", "", simple.JSON_V1)
+        self.assertEqual(response.content_type, simple.JSON_V1)
+        # webtest decodes the body, the ETag shows what was sent
+        self.assertEqual(response.body, b"{}")
+        self.assertTrue(response.headers["ETag"].endswith('-gzip"'))
+        self.assertIn("Accept", response.headers["Vary"])
+
+    def test_simple_package_notfound(self):
+        self.mock_packagecache.get_simple_page.side_effect = exceptions.NotFound("Unknown package")
+        self.app.get("/simple/mypackage/", status=404)
+
+    def test_stats(self):
+        self.mock_packagecache.stats.return_value = {"simple_pages": {"hits": 1}}
+        response = self.app.get("/stats/")
+        self.assertDictEqual(response.json, {"simple_pages": {"hits": 1}})
+
+    def test_local_index(self):
+        self.mock_packagestore.packages_etag.return_value = "abc"
+        self.mock_packagestore.list_packages.return_value = ["apackage", "bpackage"]
+        response = self.app.get("/local/")
+        self.assertIn(b'<a href="/local/bpackage/">bpackage</a>', response.body)
+        self.mock_packagestore.list_packages.assert_called_with("")
+        self.app.get("/local/", headers={"If-None-Match": response.headers["ETag"]}, status=304)
+
+    def test_local_index_paginated(self):
+        self.mock_packagestore.packages_etag.return_value = "abc"
+        self.mock_packagestore.list_packages.return_value = ["apackage", "bpackage", "cpackage"]
+        response = self.app.get("/local/?prefix=a&page=2&per_page=2")
+        self.mock_packagestore.list_packages.assert_called_with("a", 2, 3)
+        self.assertNotIn(b"cpackage", response.body)
+        self.assertIn(b"page=3&amp;per_page=2\">Next</a>", response.body)
+        self.assertIn(b"page=1&amp;per_page=2\">Previous</a>", response.body)
 
     def test_local_package(self):
         self.mock_packagestore.list_files.return_value = [dict(
@@ -52,13 +109,80 @@ class ServerTestCase(unittest.TestCase):
             "/packages/MyPackage/MyPackage-1.0.tar.gz",
         ]:
             logging.info("Testing url {0}".format(url))
-            self.mock_packagecache.get_file.return_value = "--package-data--"
+            self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
             response = self.app.get(url)
             self.assertEqual("application/x-tar", response.headers["Content-Type"])
             self.assertEqual(b"--package-data--", response.body)
 
             self.mock_packagecache.get_file.assert_called_with("MyPackage", "MyPackage-1.0.tar.gz", python_version=None)
 
+    def test_packages_streamed_from_upstream(self):
+        self.mock_packagecache.get_file.return_value = iter([b"--package", b"-data--"])
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertEqual("application/x-tar", response.headers["Content-Type"])
+        self.assertEqual(b"--package-data--", response.body)
+
+    def test_metrics(self):
+        served = server.BYTES_SERVED.values.get((), 0)
+        self.mock_packagecache.get_file.return_value = iter([b"--package", b"-data--"])
+        self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers={"Range": "bytes=2-8"}, status=206)
+        self.assertEqual(server.BYTES_SERVED.values[()] - served, 23)
+        response = self.app.get("/metrics")
+        self.assertEqual(response.headers["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn(
+            'pypicache_http_request_seconds_count{route="/packages/source/<firstletter>/<package>/<filename>",method="GET",status="206"}',
+            response.text,
+        )
+
+    def test_packages_cached_headers(self):
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertEqual("16", response.headers["Content-Length"])
+        self.assertEqual("bytes", response.headers["Accept-Ranges"])
+        etag = response.headers["ETag"]
+
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers={"If-None-Match": etag}, status=304)
+
+    def test_packages_range(self):
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers={"Range": "bytes=2-8"}, status=206)
+        self.assertEqual(b"package", response.body)
+        self.assertEqual("bytes 2-8/16", response.headers["Content-Range"])
+
+    def test_packages_sendfile(self):
+        sent = []
+        def sendfile(fp, offset, count):
+            fp.seek(offset)
+            sent.append(fp.read(count))
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz", extra_environ={"pypicache.sendfile": sendfile})
+        self.assertEqual(response.body, b"")
+        self.assertEqual(response.headers["Content-Length"], "16")
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz", headers={"Range": "bytes=2-8"}, extra_environ={"pypicache.sendfile": sendfile}, status=206)
+        self.assertEqual(sent, [b"--package-data--", b"package"])
+
+    def test_packages_offloaded(self):
+        root = tempfile.mkdtemp("pypicache")
+        self.addCleanup(shutil.rmtree, root)
+        store = disk.DiskPackageStore(root)
+        store.add_file("mypackage", "mypackage 1.0.tar.gz", b"--package-data--")
+        offload = server.FileOffload("x-accel-redirect", root)
+        self.app = TestApp(server.configure_app(self.mock_pypi, self.mock_packagestore, self.mock_packagecache, testing=True, offload=offload))
+        self.mock_packagecache.get_file.return_value = store.get_file("mypackage", "mypackage 1.0.tar.gz")
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertEqual(response.headers["X-Accel-Redirect"], "/_pypicache/packages/m/mypackage/mypackage%201.0.tar.gz")
+        self.assertEqual(response.headers["Content-Type"], "application/x-tar")
+        self.assertEqual(response.body, b"")
+        # Files outside the store are sent as usual
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
+        response = self.app.get("/packages/source/m/mypackage/mypackage-1.0.tar.gz")
+        self.assertNotIn("X-Accel-Redirect", response.headers)
+        self.assertEqual(response.body, b"--package-data--")
+
     def test_packages_source_notfound(self):
         def fail(*args, **kwargs):
             raise exceptions.NotFound("Unknown package")
@@ -76,14 +200,26 @@ class ServerTestCase(unittest.TestCase):
         self.assertEqual(args[2].getvalue(), b"--package-data--")
 
     def test_post_packge_file(self):
+        uploaded = []
+        self.mock_packagestore.find_package.return_value = None
+        self.mock_packagestore.add_file.side_effect = lambda package, filename, content, **kwargs: uploaded.append((package, filename, b"".join(content), kwargs))
         response = self.app.post("/uploadpackage/",
-            upload_files=[("sdist", "mypackage-1.0.tar.gz", b"--package-data--")]
+            upload_files=[("sdist", "mypackage-1.0.tar.gz", b"--package-data--"), ("sdist", "My_Package-1.1-py3-none-any.whl", b"--wheel-data--")]
         )
-        self.assertDictEqual(response.json, {"uploaded": "ok"})
-        self.assertTrue(self.mock_packagestore.add_file.called)
-        args, kwargs = self.mock_packagestore.add_file.call_args
-        self.assertEqual(args[:2], ("mypackage", "mypackage-1.0.tar.gz"))
-        self.assertEqual(args[2].getvalue(), b"--package-data--")
+        self.assertDictEqual(response.json, {"uploaded": "ok", "files": ["mypackage-1.0.tar.gz", "My_Package-1.1-py3-none-any.whl"]})
+        self.assertEqual(uploaded, [
+            ("mypackage", "mypackage-1.0.tar.gz", b"--package-data--", dict(pinned=True, expected=None)),
+            ("My_Package", "My_Package-1.1-py3-none-any.whl", b"--wheel-data--", dict(pinned=True, expected=None)),
+        ])
+
+    def test_post_existing_package_file(self):
+        self.mock_packagestore.find_package.return_value = "mypackage"
+        self.mock_packagestore.add_file.side_effect = exceptions.NotOverwritingError("Not overwriting mypackage-1.0.tar.gz")
+        response = self.app.post("/uploadpackage/",
+            upload_files=[("content", "mypackage-1.0.tar.gz", b"--package-data--")],
+            status=409,
+        )
+        self.assertDictEqual(response.json, {"error": True, "message": "Not overwriting mypackage-1.0.tar.gz"})
 
     def test_post_missing_package_data(self):
         """Test a post with no pacakge data
@@ -93,13 +229,32 @@ class ServerTestCase(unittest.TestCase):
         self.assertDictEqual(response.json, {"error": True, "message": "Missing package data."})
 
     def test_post_requirements_txt(self):
-        self.mock_packagecache.cache_requirements_txt.return_value = {"processed": "requirements"}
+        received = []
+        def cache_requirements_txt(requirements_fp, include=None):
+            # The upload is closed once the request is over
+            received.append(requirements_fp.read())
+            return {"processed": "requirements"}
+        self.mock_packagecache.cache_requirements_txt.side_effect = cache_requirements_txt
         response = self.app.post("/requirements.txt",
             upload_files=[("requirements", "requirements.txt", b"mypackage==1.0")]
         )
         self.assertDictEqual(response.json, {"processed": "requirements"})
-        args, kwargs = self.mock_packagecache.cache_requirements_txt.call_args
-        self.assertEqual(args[0].getvalue(), b"mypackage==1.0")
+        self.assertEqual(received, [b"mypackage==1.0"])
+
+    def test_post_requirements_txt_async(self):
+        self.mock_packagecache.start_requirements_txt.return_value.id = "abc123"
+        response = self.app.post("/requirements.txt?async=1",
+            upload_files=[("requirements", "requirements.txt", b"mypackage==1.0")],
+            status=202,
+        )
+        self.assertDictEqual(response.json, {"job": "abc123", "status": "/requirements.txt/abc123"})
+
+    def test_get_requirements_txt_job(self):
+        self.mock_packagecache.get_requirements_job.return_value = {"status": "running"}
+        response = self.app.get("/requirements.txt/abc123")
+        self.assertDictEqual(response.json, {"status": "running"})
+        self.mock_packagecache.get_requirements_job.side_effect = exceptions.NotFound("Unknown job")
+        self.app.get("/requirements.txt/unknown", status=404)
 
     def test_post_no_requirements_txt(self):
         """Test a post to requirements.txt without a upload_files
@@ -109,7 +264,7 @@ class ServerTestCase(unittest.TestCase):
         self.assertDictEqual(response.json, {"error": True, "message": "Missing requirements data."})
 
     def test_packages_bdist(self):
-        self.mock_packagecache.get_file.return_value = "--package-data--"
+        self.mock_packagecache.get_file.return_value = make_file(b"--package-data--")
         response = self.app.get("/packages/2.7/m/mypackage/mypackage-1.0-py2.7.egg")
         self.assertEqual("application/zip", response.headers["Content-Type"])
         self.assertEqual(b"--package-data--", response.body)
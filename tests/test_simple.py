@@ -0,0 +1,168 @@
+import gzip
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import cache
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import pages
+from pypicache import pypi
+from pypicache import simple
+
+UPSTREAM_PAGE = b"""<html><body>
+<a href="https://files.example.com/packages/ab/cd/mypackage-1.0.tar.gz#sha256=f8175496647e8ffb8d262a2c76f4045c1df17d013692b9eae087c3d5f17ab9cd">mypackage-1.0.tar.gz</a><br>
+<a href="../../packages/mypackage-1.1-py3-none-any.whl#sha256=wheelsha" data-requires-python="&gt;=3.6">mypackage-1.1-py3-none-any.whl</a><br>
+<a href="https://files.example.com/packages/mypackage-1.10.tar.gz#md5=oldmd5" data-yanked="">mypackage-1.10.tar.gz</a><br>
+</body></html>
+"""
+
+def make_response(content, status_code=200):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.content = content
+    response.headers = {}
+    return response
+
+class ParseLinksTestCase(unittest.TestCase):
+    def test_parse_links(self):
+        links = simple.parse_links(UPSTREAM_PAGE, "https://pypi.example.com/simple/mypackage/")
+        self.assertEqual(links[0], dict(
+            filename="mypackage-1.0.tar.gz",
+            url="https://files.example.com/packages/ab/cd/mypackage-1.0.tar.gz",
+            md5=None,
+            sha256="f8175496647e8ffb8d262a2c76f4045c1df17d013692b9eae087c3d5f17ab9cd",
+            requires_python=None,
+            yanked=None,
+        ))
+        self.assertEqual(links[1]["url"], "https://pypi.example.com/packages/mypackage-1.1-py3-none-any.whl")
+        self.assertEqual(links[1]["requires_python"], ">=3.6")
+        self.assertEqual(links[2]["md5"], "oldmd5")
+        self.assertEqual(links[2]["yanked"], "")
+
+    def test_version_matches(self):
+        self.assertTrue(simple.version_matches("mypackage-1.0.tar.gz", "1.0"))
+        self.assertTrue(simple.version_matches("mypackage-1.0-py3-none-any.whl", "1.0"))
+        self.assertFalse(simple.version_matches("mypackage-1.0.1.tar.gz", "1.0"))
+        self.assertFalse(simple.version_matches("mypackage-1.10.tar.gz", "1.1"))
+
+class NegotiationTestCase(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(simple.negotiate(None), simple.HTML)
+        self.assertEqual(simple.negotiate("*/*"), simple.HTML)
+        self.assertEqual(simple.negotiate("application/vnd.pypi.simple.v1+json, application/vnd.pypi.simple.v1+html;q=0.1, text/html;q=0.01"), simple.JSON_V1)
+        self.assertEqual(simple.negotiate("application/vnd.pypi.simple.latest+json"), simple.JSON_V1)
+        self.assertEqual(simple.negotiate("application/vnd.pypi.simple.v1+html"), simple.HTML_V1)
+
+    def test_page_encode(self):
+        page = simple.Page(b"<html>links</html>")
+        self.assertEqual(page.encode(None), (None, b"<html>links</html>", page.etag))
+        encoding, body, etag = page.encode("gzip, deflate")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(), b"<html>links</html>")
+        self.assertNotEqual(etag, page.etag)
+
+    @unittest.skipIf(simple.brotli is None, "brotli not installed")
+    def test_page_encode_brotli(self):
+        page = simple.Page(b"<html>links</html>")
+        encoding, body, etag = page.encode("gzip, br")
+        self.assertEqual(encoding, "br")
+        self.assertEqual(simple.brotli.decompress(body), b"<html>links</html>")
+
+class SimpleIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.mock_pypi = mock.Mock(spec=pypi.PyPI)
+        self.mock_pypi.get_simple_package_uri.return_value = "https://pypi.example.com/simple/mypackage/"
+        self.mock_pypi.get_simple_package_page.return_value = make_response(UPSTREAM_PAGE)
+        self.store = disk.DiskPackageStore(self.prefix)
+        self.cache = cache.PackageCache(self.store, self.mock_pypi, page_cache=pages.PageCache(self.mock_pypi, self.prefix, ttl=60))
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def test_merged_page(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        body = self.cache.get_simple_page("MyPackage").body
+        local_sha256 = hashlib.sha256(b"--package-data--").hexdigest()
+        self.assertIn('<a href="/packages/mypackage/mypackage-1.0.tar.gz#sha256={0}">'.format(local_sha256).encode("utf-8"), body)
+        self.assertIn(b'<a href="/packages/mypackage/mypackage-1.1-py3-none-any.whl#sha256=wheelsha" data-requires-python="&gt;=3.6">', body)
+        self.assertIn(b'<a href="/packages/mypackage/mypackage-1.10.tar.gz#md5=oldmd5" data-yanked="">', body)
+        self.assertNotIn(b"files.example.com", body)
+
+    def test_page_cached_until_add_file(self):
+        page = self.cache.get_simple_page("mypackage")
+        self.assertIs(self.cache.get_simple_page("mypackage"), page)
+        self.assertEqual(self.mock_pypi.get_simple_package_page.call_count, 1)
+        self.store.add_file("mypackage", "mypackage-2.0.tar.gz", b"--package-data--")
+        page = self.cache.get_simple_page("mypackage")
+        self.assertIn(b"mypackage-2.0.tar.gz", page.body)
+        self.assertEqual(self.mock_pypi.get_simple_package_page.call_count, 1)
+
+    def test_version_page(self):
+        body = self.cache.get_simple_page("mypackage", "1.1").body
+        self.assertIn(b"mypackage-1.1-py3-none-any.whl", body)
+        self.assertNotIn(b"mypackage-1.0.tar.gz", body)
+        self.assertNotIn(b"mypackage-1.10.tar.gz", body)
+
+    def test_local_only_package(self):
+        self.mock_pypi.get_simple_package_page.side_effect = exceptions.NotFound("Unknown package")
+        self.store.add_file("private", "private-1.0.tar.gz", b"--package-data--")
+        self.assertIn(b"/packages/private/private-1.0.tar.gz#sha256=", self.cache.get_simple_page("private").body)
+        self.assertRaises(exceptions.NotFound, self.cache.get_simple_page, "missing")
+
+    def test_local_files_served_when_upstream_down(self):
+        self.mock_pypi.get_simple_package_page.side_effect = exceptions.RemoteError("PyPI is down")
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.assertIn(b"mypackage-1.0.tar.gz", self.cache.get_simple_page("mypackage").body)
+        self.assertRaises(exceptions.RemoteError, self.cache.get_simple_page, "otherpackage")
+
+    def test_get_file_uses_upstream_url(self):
+        self.mock_pypi.get_file.return_value = iter([b"--package-data--"])
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(list(content), [b"--package-data--"])
+        self.mock_pypi.get_file.assert_called_with(
+            "mypackage",
+            "mypackage-1.0.tar.gz",
+            python_version=None,
+            url="https://files.example.com/packages/ab/cd/mypackage-1.0.tar.gz",
+        )
+
+    def test_get_file_rejects_corrupt_download(self):
+        self.mock_pypi.get_file.return_value = iter([b"--truncated"])
+        content = self.cache.get_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertRaises(exceptions.CorruptFileError, list, content)
+        self.assertEqual(self.store.list_filenames("mypackage"), [])
+
+    def test_json_page(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        page = self.cache.get_simple_page("MyPackage", media_type=simple.JSON_V1)
+        self.assertEqual(page.content_type, simple.JSON_V1)
+        data = json.loads(page.body.decode("utf-8"))
+        self.assertEqual(data["meta"], {"api-version": "1.0"})
+        self.assertEqual(data["name"], "mypackage")
+        files = dict((f["filename"], f) for f in data["files"])
+        self.assertEqual(files["mypackage-1.0.tar.gz"], dict(
+            filename="mypackage-1.0.tar.gz",
+            url="/packages/mypackage/mypackage-1.0.tar.gz",
+            hashes=dict(
+                md5=hashlib.md5(b"--package-data--").hexdigest(),
+                sha256=hashlib.sha256(b"--package-data--").hexdigest(),
+            ),
+        ))
+        self.assertEqual(files["mypackage-1.1-py3-none-any.whl"]["requires-python"], ">=3.6")
+        self.assertIs(files["mypackage-1.10.tar.gz"]["yanked"], True)
+
+    def test_root_regenerated_when_packages_change(self):
+        self.store.add_file("apackage", "apackage-1.0.tar.gz", b"--package-data--")
+        page = self.cache.get_simple_root(simple.JSON_V1)
+        self.assertIs(self.cache.get_simple_root(simple.JSON_V1), page)
+        self.assertEqual(json.loads(page.body.decode("utf-8"))["projects"], [{"name": "apackage"}])
+        self.store.add_file("bpackage", "bpackage-1.0.tar.gz", b"--package-data--")
+        self.assertIn(b"bpackage", self.cache.get_simple_root(simple.HTML).body)
+        self.assertIn(b"bpackage", self.cache.get_simple_root(simple.JSON_V1).body)
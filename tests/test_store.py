@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import store
+
+class KeyedLocksTestCase(unittest.TestCase):
+    def test_lock(self):
+        locks = store.KeyedLocks()
+        first = locks.lock("key")
+        self.assertTrue(first.acquire(blocking=False))
+        self.assertFalse(locks.lock("key").acquire(blocking=False))
+        self.assertTrue(locks.lock("other").acquire(blocking=False))
+        first.release()
+        with locks.lock("key"):
+            pass
+        self.assertNotIn("key", locks.locks)
+
+class CachingPackageStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp("pypicache")
+        self.backend = disk.DiskPackageStore(os.path.join(self.root, "shared"))
+        self.local = disk.DiskPackageStore(os.path.join(self.root, "local"))
+        self.store = store.CachingPackageStore(self.backend, self.local)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_add_file_writes_both(self):
+        listener = mock.Mock()
+        self.store.add_listener(listener)
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        for package_store in (self.backend, self.local):
+            self.assertEqual(package_store.stat("mypackage", "mypackage-1.0.tar.gz")["size"], 16)
+        listener.assert_called_once_with("mypackage", "mypackage-1.0.tar.gz")
+
+    def test_reads_through(self):
+        self.backend.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        content = self.store.get_file("MyPackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(b"".join(content), b"--package-data--")
+        content.close()
+        fp = self.local.get_file("mypackage", "mypackage-1.0.tar.gz")
+        self.assertEqual(fp.read(), b"--package-data--")
+        fp.close()
+        self.assertEqual(self.local.list_packages(), ["mypackage"])
+
+    def test_remove_file(self):
+        self.store.add_file("mypackage", "mypackage-1.0.tar.gz", b"--package-data--")
+        self.assertTrue(self.store.remove_file("mypackage", "mypackage-1.0.tar.gz"))
+        self.assertRaises(exceptions.NotFound, self.store.get_file, "mypackage", "mypackage-1.0.tar.gz")
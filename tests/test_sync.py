@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pypicache import bench
+from pypicache import cache
+from pypicache import disk
+from pypicache import pypi
+from pypicache import sync
+
+class LockFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp("pypicache")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fp:
+            fp.write(content)
+        return path
+
+    def test_requirements_file(self):
+        self.write("base.txt", "six==1.16.0\n")
+        path = self.write("requirements.txt", "-r base.txt\nrequests==2.31.0 --hash=sha256:abc\ndjango>=4.2,<5\n-e .\n")
+        specs, unparseable = sync.read_lock_file(path)
+        self.assertEqual([spec.source for spec in specs], ["six==1.16.0", "requests==2.31.0 --hash=sha256:abc", "django>=4.2,<5"])
+        self.assertEqual(specs[1].hashes, ["sha256:abc"])
+        self.assertEqual(unparseable, ["-e ."])
+
+    def test_pipfile_lock(self):
+        path = self.write("Pipfile.lock", json.dumps({
+            "default": {"requests": {"version": "==2.31.0", "hashes": ["sha256:abc"]}},
+            "develop": {"editable": {"editable": True, "path": "."}},
+        }))
+        specs, unparseable = sync.read_lock_file(path)
+        self.assertEqual([(spec.name, str(spec.specifier), spec.hashes) for spec in specs], [("requests", "==2.31.0", ["sha256:abc"])])
+
+    def test_find_lock_files(self):
+        self.write("b/requirements.txt", "")
+        self.write("a/Pipfile.lock", "{}")
+        self.write("a/README.md", "")
+        self.assertEqual(sync.find_lock_files(self.root), [
+            os.path.join(self.root, "a", "Pipfile.lock"),
+            os.path.join(self.root, "b", "requirements.txt"),
+        ])
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.upstream = bench.FakeUpstream([
+            bench.FakePackage("apackage", version, 1000)
+            for version in ("1.0", "1.1", "2.0", "2.1rc1")
+        ] + [bench.FakePackage("bpackage", "1.0", 1000)]).start()
+        self.pypi = pypi.PyPI(pypi_server=self.upstream.url)
+        self.package_store = disk.DiskPackageStore(self.prefix)
+        self.package_cache = cache.PackageCache(self.package_store, self.pypi)
+        self.planner = sync.Planner(self.pypi, workers=2)
+        self.checkpoint = sync.Checkpoint(os.path.join(self.prefix, "checkpoint.jsonl"))
+
+    def tearDown(self):
+        self.upstream.stop()
+        shutil.rmtree(self.prefix)
+
+    def test_select_versions(self):
+        releases = dict.fromkeys(["1.0", "1.1", "2.0", "2.1rc1", "not-a-version"])
+        specs = [sync.parse_spec("apackage>=1.1")]
+        self.assertEqual(self.planner.select_versions(specs, releases), ["1.1", "2.0"])
+        self.assertEqual(self.planner.select_versions([sync.parse_spec("apackage==2.1rc1")], releases), ["2.1rc1"])
+        self.planner.latest = 1
+        self.assertEqual(self.planner.select_versions(specs + [sync.parse_spec("apackage<2")], releases), ["2.0", "1.1"])
+
+    def test_sync(self):
+        self.package_store.add_file("apackage", "apackage-1.1.tar.gz", b"already here")
+        specs = [sync.parse_spec("apackage>=1.1"), sync.parse_spec("bpackage"), sync.parse_spec("missing")]
+        report = sync.Sync(self.package_cache, workers=2, checkpoint=self.checkpoint).run(self.planner, specs)
+        self.assertEqual((report["planned"], report["present"], report["fetched"], report["bytes"]), (3, 1, 2, 2000))
+        self.assertEqual((report["failed"], report["unresolved"]), ([], ["missing"]))
+        self.assertEqual(self.package_store.list_filenames("apackage"), ["apackage-1.1.tar.gz", "apackage-2.0.tar.gz"])
+        self.assertEqual(self.upstream.stats()["files"], 2)
+
+        # Nothing left to do, and the plan comes from the checkpoint
+        report = sync.Sync(self.package_cache, workers=2, checkpoint=self.checkpoint).run(self.planner, specs)
+        self.assertEqual((report["planned"], report["present"], report["fetched"]), (3, 3, 0))
+        self.assertEqual(self.upstream.stats()["json"], 2)
+        self.assertEqual(self.upstream.stats()["files"], 2)
+
+    def test_resume(self):
+        specs = [sync.parse_spec("apackage<2")]
+        artifacts, unresolved = self.planner.plan(specs)
+        self.checkpoint.start(["apackage<2"], artifacts)
+        self.checkpoint.record("apackage-1.0.tar.gz")
+        self.checkpoint.record("apackage-1.1.tar.gz", "Unexpected response")
+        self.checkpoint.close()
+        with open(self.checkpoint.path, "a") as fp:
+            fp.write('{"done": "apack')
+        report = sync.Sync(self.package_cache, workers=2, checkpoint=self.checkpoint).run(self.planner, specs)
+        self.assertEqual((report["planned"], report["present"], report["fetched"]), (2, 1, 1))
+        self.assertEqual(self.package_store.list_filenames("apackage"), ["apackage-1.1.tar.gz"])
+        specs, artifacts, done = self.checkpoint.load()
+        self.assertEqual(done, set(["apackage-1.0.tar.gz", "apackage-1.1.tar.gz"]))
@@ -0,0 +1,134 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pypicache import disk
+from pypicache import exceptions
+from pypicache import uploads
+
+BOUNDARY = "----pypicacheboundary"
+CONTENT_TYPE = "multipart/form-data; boundary={0}".format(BOUNDARY)
+
+def make_body(parts):
+    """Builds a multipart body from (name, filename or None, content)
+
+    """
+    body = b"preamble"
+    for name, filename, content in parts:
+        disposition = 'form-data; name="{0}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{0}"'.format(filename)
+        body += "\r\n--{0}\r\nContent-Disposition: {1}\r\n\r\n".format(BOUNDARY, disposition).encode("latin-1") + content
+    return body + "\r\n--{0}--\r\n".format(BOUNDARY).encode("latin-1")
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+class ParsePackageNameTestCase(unittest.TestCase):
+    def test_parse_package_name(self):
+        self.assertEqual(uploads.parse_package_name("mypackage-1.0.tar.gz"), "mypackage")
+        self.assertEqual(uploads.parse_package_name("My_Package-1.0-py3-none-any.whl"), "My_Package")
+        self.assertEqual(uploads.parse_package_name("my-package-1.0.zip"), "my-package")
+        self.assertEqual(uploads.parse_package_name("my-package-1.0-dev.tar.gz"), "my-package")
+        self.assertEqual(uploads.parse_package_name("mypackage-1.0-py2.7.egg"), "mypackage")
+
+    def test_invalid_names(self):
+        for filename in ("mypackage.tar.gz", "mypackage-1.0.whl", "README"):
+            self.assertRaises(exceptions.InvalidUploadError, uploads.parse_package_name, filename)
+
+class MultipartParserTestCase(unittest.TestCase):
+    def parse(self, chunks):
+        parts = []
+        for part in uploads.MultipartParser(chunks, BOUNDARY.encode("latin-1")):
+            parts.append((part.name, part.filename, b"".join(part.iter_data())))
+        return parts
+
+    def test_any_chunk_size(self):
+        parts = [("name", None, b"mypackage"), ("content", "../dist/mypackage-1.0.tar.gz", b"\r\n--" + b"x" * 100 + b"\r\n")]
+        body = make_body(parts)
+        for size in (1, 7, 64, len(body)):
+            self.assertEqual(self.parse(split(body, size)), [
+                ("name", None, b"mypackage"),
+                ("content", "mypackage-1.0.tar.gz", b"\r\n--" + b"x" * 100 + b"\r\n"),
+            ])
+
+    def test_unread_parts_are_skipped(self):
+        body = make_body([("a", "a-1.0.tar.gz", b"aaa"), ("b", None, b"bbb")])
+        names = [part.name for part in uploads.MultipartParser(split(body, 5), BOUNDARY.encode("latin-1"))]
+        self.assertEqual(names, ["a", "b"])
+
+    def test_truncated(self):
+        body = make_body([("content", "mypackage-1.0.tar.gz", b"--package-data--")])
+        self.assertRaises(exceptions.InvalidUploadError, self.parse, [body[:-20]])
+
+class UploadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp("pypicache")
+        self.store = disk.DiskPackageStore(self.prefix)
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix)
+
+    def upload(self, parts, content_type=CONTENT_TYPE):
+        return uploads.handle_upload(self.store, content_type, split(make_body(parts), 10))
+
+    def test_several_files(self):
+        self.store.add_file("my-package", "my-package-0.9.tar.gz", b"--old-data--")
+        status, data = self.upload([
+            ("sdist", "my_package-1.0.tar.gz", b"--package-data--"),
+            ("sdist", "my_package-1.0-py3-none-any.whl", b"--wheel-data--"),
+        ])
+        self.assertEqual((status, data), (200, {"uploaded": "ok", "files": ["my_package-1.0.tar.gz", "my_package-1.0-py3-none-any.whl"]}))
+        self.assertEqual(self.store.list_filenames("my-package"), ["my-package-0.9.tar.gz", "my_package-1.0-py3-none-any.whl", "my_package-1.0.tar.gz"])
+        self.assertEqual(self.store.get_file("my-package", "my_package-1.0.tar.gz").read(), b"--package-data--")
+
+    def test_twine(self):
+        status, data = self.upload([
+            (":action", None, b"file_upload"),
+            ("name", None, b"mypackage"),
+            ("md5_digest", None, hashlib.md5(b"--package-data--").hexdigest().encode("ascii")),
+            ("sha256_digest", None, hashlib.sha256(b"--package-data--").hexdigest().encode("ascii")),
+            ("content", "mypackage-1.0.tar.gz", b"--package-data--"),
+            ("gpg_signature", "mypackage-1.0.tar.gz.asc", b"--signature--"),
+        ])
+        self.assertEqual((status, data), (200, {"uploaded": "ok", "files": ["mypackage-1.0.tar.gz"]}))
+
+    def test_corrupt_upload(self):
+        status, data = self.upload([
+            ("sha256_digest", None, hashlib.sha256(b"--package-data--").hexdigest().encode("ascii")),
+            ("content", "mypackage-1.0.tar.gz", b"--truncated"),
+        ])
+        self.assertEqual(status, 400)
+        self.assertIn("expected", data["message"])
+        self.assertEqual(self.store.list_filenames("mypackage"), [])
+
+    def test_existing_file(self):
+        self.upload([("content", "mypackage-1.0.tar.gz", b"--package-data--")])
+        status, data = self.upload([
+            ("content", "mypackage-1.1.tar.gz", b"--new-data--"),
+            ("content", "mypackage-1.0.tar.gz", b"--other-data--"),
+        ])
+        self.assertEqual(status, 409)
+        self.assertEqual(data["files"], ["mypackage-1.1.tar.gz"])
+        self.assertEqual(self.store.get_file("mypackage", "mypackage-1.0.tar.gz").read(), b"--package-data--")
+
+    def test_holds_file_lock(self):
+        add_file = self.store.add_file
+        locked = []
+        def check_lock(package, filename, content, **kwargs):
+            locked.append(not self.store.lock(package, filename).acquire(blocking=False))
+            return add_file(package, filename, content, **kwargs)
+        with mock.patch.object(self.store, "add_file", side_effect=check_lock):
+            self.upload([("content", "mypackage-1.0.tar.gz", b"--package-data--")])
+        self.assertEqual(locked, [True])
+        self.assertTrue(self.store.lock("mypackage", "mypackage-1.0.tar.gz").acquire(blocking=False))
+
+    def test_bad_requests(self):
+        self.assertEqual(self.upload([], content_type="text/plain"), (400, {"error": True, "message": "Missing package data."}))
+        self.assertEqual(self.upload([("name", None, b"mypackage")]), (400, {"error": True, "message": "Missing package data."}))
+        status, data = self.upload([(":action", None, b"remove_pkg"), ("content", "mypackage-1.0.tar.gz", b"")])
+        self.assertEqual((status, data["message"]), (400, "Unsupported action 'remove_pkg'"))
+        self.assertEqual(self.upload([("content", "README", b"")])[0], 400)